@@ -10,16 +10,26 @@ from pickle import dump
 from math import sqrt, log
 
 # Local packages
-from febid.Structure import Structure
+from febid.Structure import Structure, CellMask, SURFACE, SEMI_SURFACE, GHOST, FROZEN
 import febid.diffusion as diffusion
 import febid.heat_transfer as heat_transfer
 from febid.libraries.rolling.roll import surface_temp_av
+from febid.libraries.pde.reaction_diffusion import run_until_filled, run_until_filled_2d, run_adaptive_until_filled
 from mcca import MixedCellCellularAutomata as MCCA
-from slice_trics import get_3d_slice
+from slice_trics import get_3d_slice, get_neighbors_index
 from expressions import cache_numexpr_expressions
 
 from timeit import default_timer as df
 
+# Dormand-Prince 5(4) Runge-Kutta pair: coefficients of the stages 2-7 and the error estimate
+_DP_A = ((1 / 5,),
+         (3 / 40, 9 / 40),
+         (44 / 45, -56 / 15, 32 / 9),
+         (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+         (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+         (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+_DP_E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
 
 # TODO: look into k-d trees
 
@@ -401,33 +411,52 @@ class Process:
         # Their role is to serve as pipes on steps, where regular surface cells are not in contact.
         # Therefore, these cells take part in diffusion process, but are not taken into account when calculating
         # other terms in the FEBID equation or deposit increment.
-        self.beam_matrix = None  # contains values of the SE surface flux
+        self.__beam_index = None  # irradiated cells, sorted in the C-order
+        self.__beam_flux = None  # values of the SE surface flux in the irradiated cells
+        self.__deposit_error = None  # rounding error of the deposit in the irradiated cells in single precision
         self.surface_temp = None
 
         # Cellular automata engine
         self.local_mcca = MCCA()
+        self.__offsets_1st = np.argwhere(np.ones((3, 3, 3))) - 1  # positions of the nearest neighbors
+        self.__offsets_2nd = np.argwhere(np.ones((5, 5, 5))) - 2  # positions of the 2nd nearest neighbors
 
         # Working arrays
         self.__deposit_reduced_3d = None
         self.__precursor_reduced_3d = None
+        self.__flags_reduced_3d = None
+        self.__flags_reduced_2d = None
         self.__surface_reduced_3d = None
-        self.__semi_surface_reduced_3d = None
-        self.__ghosts_reduced_3d = None
         self.__temp_reduced_3d = None
-        self.__beam_matrix_reduced_2d = None
-        self.D_temp = None
-        self.tau_temp = None
+        self.__irradiated_area_3d = None
 
         # Helpers
         self._surface_all = None
+        self._frozen = None  # cells excluded from the solution
         self.__beam_matrix_surface = None
         self.__beam_matrix_effective = None
         self.__deposition_index = None
+        self.__deposition_index_2d = None
         self.__surface_index = None
         self.__semi_surface_index = None
         self._solid_index = None
         self.__surface_all_index = None
+        self.__surface_cells = None  # indices of all the surface cells, maintained on every cell update
+        self.__semi_surface_cells = None
+        self.__surface_all_cells = None
+        self.__surface_active = None  # solved cells among all the surface cells
+        self.__surface_all_active = None
+        self.__surface_pos = None  # positions of the solved cells in the surface+semi-surface index
+        self.__surface_all_pos = None
+        self.__surface_rows = None  # positions of the solved surface cells among the solved cells
+        self.__surface_neighbors = None  # neighbor table of all the surface+semi-surface cells
+        self.__D_cells = None  # diffusion coefficient of all the surface+semi-surface cells
+        self.__tau_cells = None  # residence time of all the surface cells
+        self.__D_flat = None
         self.__tau_flat = None
+        self.__diffusion_lines = None
+        self.__multirate_classes = None
+        self.__adaptive_rate = None  # coverage and its rate of change at the end of the last adaptive step
 
         # Monte Carlo simulation instance
         self.sim = None
@@ -441,12 +470,34 @@ class Process:
         # self.t_desorption = 0
         # self.dt = 0
         self.t = 0
+        self._dt = None  # current time step
+        self._dt_max = None  # maximal stable time step
 
         # Accuracy
         self.solution_accuracy = 1e-8
 
         # Utility variables
         self.deposition_scaling = deposition_scaling  # multiplier of the deposit increment; used to speed up the process
+        self.compiled_stepping = True  # advance the model with the compiled time-stepping kernel
+        self.reaction_integrator = 'rk4'  # integration method of the reaction term: 'rk4' or 'exponential'
+        self.diffusion_solver = 'explicit'  # solution method of the diffusion term: 'explicit' or 'implicit'
+        self.implicit_dt_factor = 10  # time step of the implicit diffusion solution relative to the stability limit
+        self.adaptive_time_step = False  # adjust the time step to the local error estimate
+        self.time_step_tolerance = 1e-4  # relative error tolerance of a time step in the adaptive and multirate modes
+        self.multirate = False  # update slowly changing cells with longer local time steps
+        self.multirate_levels = 5  # number of local time step classes, each next class doubles the time step
+        self.active_set = False  # exclude cells with a steady precursor coverage from the solution
+        self.local_equilibration = False  # bring coverage around a filled cell to a steady state
+        self.height_field = False  # solve the surface as a 2D grid while the structure has no overhangs
+        self.single_precision = False  # store deposit and precursor coverage in single precision
+        self.brick_size = 0  # size of a storage brick of the structure arrays in KiB, 0 stores them densely
+        self.__height_field = False  # height field mode is active
+        self.freeze_tolerance = 1e-4  # max. relative coverage change over a probing interval for a cell to be frozen
+        self.__active_set_time = 0
+        self.skip_ahead = False  # skip time steps to the next cell filling event under steady precursor coverage
+        self.steady_state_tolerance = 1e-6  # max. relative coverage change over a probing interval to consider it steady
+        self.steady_state_probe = 100  # number of time steps in a coverage probing interval
+        self.__steady_state = False
         self.redraw = True  # flag for external functions saying that surface has been updated
         self.t_prev = 0
         self.vol_prev = 0
@@ -480,9 +531,18 @@ class Process:
         # Initialization sequence
         self.__set_structure(structure)
         self.__set_constants(equation_values)
+        if self.single_precision:
+            self.structure.set_dtype(np.float32)
+        if self.brick_size:
+            self.structure.set_brick_size(self.brick_size * 1024)
+            self.__set_structure(self.structure)  # cell masks refer to the replaced flags array
         self.__update_views_2d()
+        self.__index_surface_cells()
         self.__generate_surface_index()
         self._get_solid_index()
+        if self.height_field:
+            self.__height_field = True
+            self.__check_height_field()
         self.temp_step_cells = self.temp_step / self.cell_V
         self.structure.precursor[self.structure.surface_bool] = self.model.nr
         if self.temperature_tracking:
@@ -490,15 +550,15 @@ class Process:
             self.residence_time()
             self.diffusion_coefficient()
         self.__expressions()
+        self.reset_dt()
 
     # Initialization methods
     def __set_structure(self, structure: Structure):
         self.structure = structure
-        self._surface_all = np.logical_or(self.structure.surface_bool, self.structure.semi_surface_bool)
-        self.beam_matrix = np.zeros_like(structure.deposit, dtype=np.int32)
-        self.surface_temp = np.zeros_like(self.structure.temperature)
-        self.D_temp = np.zeros_like(self.structure.precursor)
-        self.tau_temp = np.zeros_like(self.structure.precursor)
+        self._surface_all = CellMask(self.structure.cell_flags, SURFACE | SEMI_SURFACE)
+        self._frozen = CellMask(self.structure.cell_flags, FROZEN)
+        self._frozen[...] = False
+        self.surface_temp = np.zeros(self.structure.shape)  # allocated lazily, only surface cells are written
         self.cell_size = self.structure.cell_size
         self.cell_V = self.cell_size ** 3
         self.__set_max_z()
@@ -519,6 +579,26 @@ class Process:
         self.precursor.Ed = params.get('Ed', 0)
         self.heat_cond = params['heat_cond']
         self.deposition_scaling = params['deposition_scaling']
+        self.skip_ahead = params.get('skip_ahead', False)
+        self.reaction_integrator = params.get('reaction_integrator', 'rk4')
+        if self.reaction_integrator not in ('rk4', 'exponential'):
+            raise ValueError(f'Unknown reaction integrator: {self.reaction_integrator}. '
+                             f'Available options are \'rk4\' and \'exponential\'.')
+        self.diffusion_solver = params.get('diffusion_solver', 'explicit')
+        if self.diffusion_solver not in ('explicit', 'implicit'):
+            raise ValueError(f'Unknown diffusion solver: {self.diffusion_solver}. '
+                             f'Available options are \'explicit\' and \'implicit\'.')
+        self.implicit_dt_factor = params.get('implicit_dt_factor', 10)
+        self.adaptive_time_step = params.get('adaptive_time_step', False)
+        self.time_step_tolerance = params.get('time_step_tolerance', 1e-4)
+        self.multirate = params.get('multirate', False)
+        self.multirate_levels = params.get('multirate_levels', 5)
+        self.active_set = params.get('active_set', False)
+        self.freeze_tolerance = params.get('freeze_tolerance', 1e-4)
+        self.local_equilibration = params.get('local_equilibration', False)
+        self.height_field = params.get('height_field', False)
+        self.single_precision = params.get('single_precision', False)
+        self.brick_size = params.get('brick_size', 0)
         if self.temperature_tracking:
             if not all([self.precursor.k0, self.precursor.Ea, self.precursor.D0, self.precursor.Ed]):
                 warnings.warn('Some of the temperature dependent parameters were not found! \n '
@@ -569,71 +649,62 @@ class Process:
         # What here actually done is marking the filled cell as a solid and a ghost cell and then updating surface,
         # semi-surface, ghosts and precursor to describe the surface geometry around the newly filled cell.
         # The approach is cell-centric, which means all the surroundings are processed
-
-        nd = (self.__deposit_reduced_3d >= 1).nonzero()
-        new_deposits = [(nd[0][i], nd[1][i], nd[2][i]) for i in range(nd[0].shape[0])]
-        self.filled_cells += len(new_deposits)
-        for cell in new_deposits:
-            self.update_cell_config(cell)
-            # Updating temperature in the new cell
-            self.update_cell_temperature(cell)
+        # All the cells filled during a step are processed together
+
+        new_deposits = (self.__deposit_reduced_3d >= 1).nonzero()
+        self.filled_cells += new_deposits[0].shape[0]
+        self.__steady_state = False
+        if new_deposits[0].shape[0] > 0:
+            self.update_cell_config(new_deposits)
+            # Updating temperature in the new cells
+            self.update_cell_temperature(new_deposits)
             # Updating nearest neighbors profile
-            self.update_nearest_neighbors(cell)
-        if len(new_deposits) > 0:
+            self.update_nearest_neighbors(new_deposits)
             # Post cell update routines
             self.__set_max_z()
             self.__update_views_2d()
+            if self.__height_field:
+                self.__check_height_field()
             if self.temperature_tracking and self.max_z - self.substrate_height - 3 > 2:
                 self.request_temp_recalc = self.filled_cells > self.temp_calc_count * self.temp_step_cells
-                if self.request_temp_recalc:
-                    self._get_solid_index()
 
         if self.max_z + 5 > self.structure.shape[0]:
             # Here the Structure is extended in height
             return self.extend_structure()
         return False
 
-    def update_cell_config(self, cell):
+    def update_cell_config(self, cells):
         """
-        Updates all data arrays after a cell is filled.
+        Updates all data arrays after cells are filled.
 
-        :param cell: filled cell indices
+        :param cells: filled cells index
         :return:
         """
-        # What here actually done is marking the filled cell as a solid and a ghost cell and then updating surface,
-        # semi-surface, ghosts and precursor to describe the surface geometry around the newly filled cell.
+        # What here actually done is marking the filled cells as a solid and a ghost cells and then updating surface,
+        # semi-surface, ghosts and precursor to describe the surface geometry around the newly filled cells.
         # The approach is cell-centric, which means all the surroundings are processed
-        surplus_deposit = self.__deposit_reduced_3d[
-                              cell] - 1  # saving deposit overfill to distribute among the neighbors later
-        precursor_cov = self.__precursor_reduced_3d[cell]
-        self.__deposit_reduced_3d[cell] = -1  # a fully deposited cell is always a minus unity
-        self.__temp_reduced_3d[cell] = self.room_temp
-        self.__precursor_reduced_3d[cell] = 0
-        self.__ghosts_reduced_3d[cell] = True  # deposited cell belongs to ghost shell
-        self.__surface_reduced_3d[cell] = False  # deposited cell is not a surface cell
-        self.__semi_surface_reduced_3d[cell] = False  # deposited cell is not a semi-surface cell
+        surplus_deposit = self.__deposit_reduced_3d[cells] - 1  # saving deposit overfill to distribute among the neighbors later
+        precursor_cov = self.__precursor_reduced_3d[cells]
+        self.__deposit_reduced_3d[cells] = -1  # a fully deposited cell is always a minus unity
+        if self.__deposit_error is not None:
+            position = self.__find_cells(self.__deposition_index, cells)
+            self.__deposit_error[position[position >= 0]] = 0
+        self.__temp_reduced_3d[cells] = self.room_temp
+        self.__precursor_reduced_3d[cells] = 0
+        # Deposited cell belongs to ghost shell and is neither a surface nor a semi-surface cell
+        self.__flags_reduced_3d[cells] = self.__flags_reduced_3d[cells] & ~np.uint8(SURFACE | SEMI_SURFACE) | GHOST
         # Getting new converged configuration
-        updated_slice, surface_bool, semi_s_bool, ghosts_bool = self.local_mcca.get_converged_configuration(
-            cell, self.__deposit_reduced_3d.astype(bool),
-            self.__surface_reduced_3d,
-            self.__semi_surface_reduced_3d,
-            self.__ghosts_reduced_3d)
-        surf_bool_prev = self.__surface_reduced_3d[updated_slice].copy()
-        semi_s_bool_prev = self.__semi_surface_reduced_3d[updated_slice].copy()
-        # Updating data arrays
-        deposit_kern = self.__deposit_reduced_3d[updated_slice]
-        precursor_kern = self.__precursor_reduced_3d[updated_slice]
-        surf_kern = self.__surface_reduced_3d[updated_slice]
-        surf_semi_kern = self.__semi_surface_reduced_3d[updated_slice]
-        ghosts_kern = self.__ghosts_reduced_3d[updated_slice]
-        surf_kern[:] = surface_bool
-        surf_semi_kern[:] = semi_s_bool
-        ghosts_kern[:] = ghosts_bool
-        surf_diff = surf_bool_prev ^ surf_kern  # difference in surface
-        semi_s_diff = semi_s_bool_prev ^ surf_semi_kern  # difference in semi-surface
-        deposit_kern[surf_diff] += surplus_deposit / np.count_nonzero(surf_diff)  # redistribute excess deposit
-        condition = (semi_s_diff | surf_diff) & (precursor_kern < 1e-6)
-        precursor_kern[condition] = precursor_cov  # assign average precursor coverage to new surface cells
+        self.local_mcca.converge_cells(cells, self.__deposit_reduced_3d, self.__precursor_reduced_3d,
+                                       self.__flags_reduced_3d, surplus_deposit, precursor_cov)
+        # Surroundings of the new cells are solved again
+        updated, _ = get_neighbors_index(cells, self.__offsets_2nd, self.__frozen_reduced_3d.shape)
+        self.__frozen_reduced_3d[updated] = False
+        self.__update_cell_indices(cells)
+        z_slice, y_slice, x_slice = self.__irradiated_area_3d
+        self.structure.update_height_map((cells[0] + z_slice.start, cells[1] + y_slice.start, cells[2] + x_slice.start))
+        if self.local_equilibration:
+            for cell in zip(*cells):
+                self.__equilibrate_local(get_3d_slice(cell, self.__precursor_reduced_3d.shape, 2)[0])
 
     def extend_structure(self):
         """
@@ -642,52 +713,65 @@ class Process:
 
         :return: True if the structure was resized
         """
+        # New layers are empty, thus surface neighbors, that are solid cells, do not change
         with self.lock:  # blocks run with Lock should exclude calls of decorated functions, otherwise the thread will hang
-            shape_old = self.structure.shape
             self.structure.resize_structure(200)
-            self.structure.define_surface_neighbors(self.max_neib)
-            beam_matrix = self.beam_matrix  # taking care of the beam_matrix, because __set_structure creates it empty
         self.__set_structure(self.structure)
-        self.beam_matrix[:shape_old[0], :shape_old[1], :shape_old[2]] = beam_matrix
+        self.__update_views_2d()
         self.redraw = True
         # Basically, none of the slices have to be updated, because they use indexes, not references.
         return True
 
-    def update_cell_temperature(self, cell):
+    def update_cell_temperature(self, cells):
         """
-        Update temperature of the cell by assigning it an average of the surrounding cells.
+        Update temperature of the cells by assigning them an average of the surrounding cells.
 
-        :param cell: cell indices
+        :param cells: cells index
         :return:
         """
-        temp_slice, _ = get_3d_slice(cell, self.__temp_reduced_3d.shape, 2)
-        temp_kern = self.__temp_reduced_3d[temp_slice]
-        condition = (temp_kern > self.room_temp)
+        neighbors, source = get_neighbors_index(cells, self.__offsets_2nd, self.__temp_reduced_3d.shape)
+        temp = self.__temp_reduced_3d[neighbors]
+        condition = temp > self.room_temp
+        count = np.bincount(source, condition, cells[0].shape[0])
+        temp_sum = np.bincount(source, temp * condition, cells[0].shape[0])
+        condition = count > 0
         if np.any(condition):
-            self.__temp_reduced_3d[cell] = temp_kern[condition].sum() / np.count_nonzero(condition)
+            self.__temp_reduced_3d[tuple(index[condition] for index in cells)] = temp_sum[condition] / count[condition]
 
-    def update_nearest_neighbors(self, cell):
+    def update_nearest_neighbors(self, cells):
         """
-        Update surface nearest neighbors surrounding the cell.
+        Update surface nearest neighbors surrounding the cells.
 
         This updates the Hausdroff distances used for electron escape depth estimation.
 
-        :param cell: cell indices
+        :param cells: cells index
         :return:
         """
-        n_3d, _ = get_3d_slice(cell, self.__deposit_reduced_3d.shape, self.max_neib)
-        neighbors_neighbs = self.__surface_neighbors_reduced_3d[n_3d]
-        deposit_neighbs = self.__deposit_reduced_3d[n_3d]
-        surface_neighbs = self.__surface_reduced_3d[n_3d]
-        self.structure.define_surface_neighbors(self.max_neib,
-                                                deposit_neighbs,
-                                                surface_neighbs,
-                                                neighbors_neighbs)
-
-    def deposition(self):
+        shape = self.__deposit_reduced_3d.shape
+        # Processing the common region of all the cells at once, unless it is larger than their separate regions
+        union = tuple(slice(max(index.min() - self.max_neib, 0), min(index.max() + self.max_neib + 1, length))
+                      for index, length in zip(cells, shape))
+        if np.prod([s.stop - s.start for s in union]) <= cells[0].shape[0] * (2 * self.max_neib + 1) ** 3:
+            regions = [union]
+        else:
+            regions = [get_3d_slice(cell, shape, self.max_neib)[0] for cell in zip(*cells)]
+        for n_3d in regions:
+            neighbors_neighbs = self.__surface_neighbors_reduced_3d[n_3d]
+            deposit_neighbs = self.__deposit_reduced_3d[n_3d]
+            surface_neighbs = self.__surface_reduced_3d[n_3d]
+            self.structure.define_surface_neighbors(self.max_neib,
+                                                    deposit_neighbs,
+                                                    surface_neighbs,
+                                                    neighbors_neighbs)
+
+    def deposition(self, precursor=None):
         """
         Calculate an increment of a deposited volume for all irradiated cells over a time step
 
+        :param precursor: precursor coverage of the irradiated cells at the beginning of the step. If given,
+            the current coverage is taken as the one at the end of the step and the deposit is calculated
+            from their average (trapezoidal rule), otherwise from the current coverage or, if the reaction term
+            is split from diffusion, from its average over the step.
         :return:
         """
         # Instead of processing cell by cell and on the whole surface, it is implemented to process only (effectively)
@@ -695,8 +779,17 @@ class Process:
         # np.float32 — ~1E-7, produced value — ~1E-10
         const = (self.precursor.sigma * self.precursor.V * self.dt * 1e6 *
                  self.deposition_scaling / self.cell_V * self.cell_size ** 2)  # multiplying by 1e6 to preserve accuracy
-        self.__deposit_reduced_3d[self.__deposition_index] += (
-                self.__precursor_reduced_3d[self.__deposition_index] * self.__beam_matrix_effective * const / 1e6)
+        if precursor is not None:
+            precursor = (precursor + self.__precursor_reduced_3d[self.__deposition_index]) / 2
+        else:
+            precursor = self.__precursor_reduced_3d[self.__deposition_index]
+            if self.reaction_integrator == 'exponential' or self.diffusion_solver == 'implicit':
+                # The reaction term is split from diffusion, then its exact solution is averaged over the step
+                precursor = self.__exponential(precursor, self.__beam_matrix_effective,
+                                               self.__get_tau_deposition(), mean=True)
+        deposit = self.__get_deposit()
+        deposit += precursor * self.__beam_matrix_effective * const / 1e6
+        self.__set_deposit(deposit)
 
     def precursor_density(self):
         """
@@ -707,70 +800,875 @@ class Process:
         # Here, surface_all represents surface+semi_surface cells.
         # It is only used in diffusion calculation, because semi_surface cells cannot take part in deposition process
         precursor = self.__precursor_reduced_2d
-        surface_all = self.__surface_all_reduced_2d
-        surface = self.__surface_reduced_2d
-        diffusion_matrix = self.__rk4_diffusion(precursor,
-                                                surface_all)  # Diffusion term is calculated separately and added in the end
-        precursor[surface] += self.__rk4(precursor[surface],
-                                         self.__beam_matrix_surface)  # An increment is calculated through Runge-Kutta method without the diffusion term
-        precursor[surface_all] += diffusion_matrix[surface_all]  # finally adding diffusion term
+        surface_all = self.__surface_all_index
+        surface = self.__surface_index
+        if self.adaptive_time_step:
+            # The step is adjusted until the error estimate meets the tolerance
+            n = np.asarray(precursor[self.__surface_all_cells], dtype=np.float64)
+            precursor[surface_all] = self.__step_adaptive(n, np.inf)[0]
+            return
+        if self.diffusion_solver == 'implicit':
+            # Operator splitting: the reaction term is advanced first, then diffusion is solved implicitly
+            if self.reaction_integrator == 'exponential':
+                precursor[surface] = self.__exponential(precursor[surface], self.__beam_matrix_surface,
+                                                        self.get_tau())
+            else:
+                precursor[surface] += self.__rk4(precursor[surface], self.__beam_matrix_surface)
+            self.__diffusion_implicit(precursor)
+            return
+        # Coverage of all the surface cells is gathered into a flat array, frozen cells keep their value
+        n = np.asarray(precursor[self.__surface_all_cells], dtype=np.float64)
+        surface = self.__surface_pos
+        surface_all = self.__surface_all_pos
+        if self.reaction_integrator == 'exponential':
+            # Operator splitting: the reaction term is advanced by its exact solution first,
+            # then the diffusion term is calculated from the updated coverage
+            n[surface] = self.__exponential(n[surface], self.__beam_matrix_surface, self.get_tau())
+            n[surface_all] += self.__rk4_diffusion(n)
+        else:
+            # Reaction and diffusion terms are integrated together, every Runge-Kutta stage includes both
+            n[surface_all] += self.__rk4_reaction_diffusion(n)
+        precursor[self.__surface_all_index] = n[surface_all]
+
+    def advance(self, time_limit):
+        """
+        Calculate deposition and precursor coverage step by step until a cell is filled or the time limit is reached.
+
+        The step, at which a cell got filled, is completed.
+        If skip-ahead is enabled and precursor coverage has reached a steady state, the time is advanced
+        directly to the moment when the next cell is filled.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        if self.skip_ahead:
+            time_passed = self.__advance_skipping(time_limit)
+        else:
+            time_passed = self.__advance_steps(time_limit)
+        if self.active_set:
+            self.__update_active_set(time_passed)
+        return time_passed
+
+    def __advance_steps(self, time_limit):
+        """
+        Advance deposition and precursor coverage by a time step until a cell is filled or the time limit is reached.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        if self.__height_field:
+            return self.__advance_height_field(time_limit)
+        if self.adaptive_time_step:
+            return self.__advance_adaptive(time_limit)
+        if self.multirate:
+            return self.__advance_multirate(time_limit)
+        if self.compiled_stepping and self.diffusion_solver == 'explicit':
+            return self.__advance_compiled(time_limit)
+        time_passed = 0
+        dt = self.dt
+        while True:
+            last = time_passed + self.dt >= time_limit
+            if last:  # stepping only for remaining time to avoid accumulating of excess deposit
+                self.dt = time_limit - time_passed
+            if self.reaction_integrator == 'exponential' or self.diffusion_solver == 'implicit':
+                self.deposition()
+                self.precursor_density()
+            else:
+                precursor = self.__precursor_reduced_3d[self.__deposition_index]
+                self.precursor_density()
+                self.deposition(precursor)
+            if last:
+                time_passed = time_limit
+                break
+            time_passed += self.dt
+            if self.check_cells_filled():
+                break
+        self.dt = dt
+        return time_passed
+
+    def __advance_height_field(self, time_limit):
+        """
+        Advance deposition and precursor coverage of a height field until a cell is filled or the time limit is reached.
+
+        Every column of the structure has a single surface cell on top, thus the surface is solved as a 2D grid.
+        Semi-surface cells are not solved. The 3D arrays are still used for storage, only the solution is 2D.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        index = self.__get_height_field_index()
+        precursor = np.asarray(self.__precursor_reduced_2d[index], dtype=np.float64)
+        deposit = np.asarray(self.__deposit_reduced_2d[index], dtype=np.float64)
+        # Only the irradiated cells on top of their columns are solved
+        z, y, x = self.__deposition_index_2d
+        top = (index[0][y, x] == z).nonzero()[0]
+        y, x = y[top], x[top]
+        deposit_irradiated = self.__get_deposit()
+        deposit[y, x] = deposit_irradiated[top]
+        beam_matrix = self.__get_beam_flux(index)
+        tau = self.get_tau()
+        if type(tau) is np.ndarray:
+            tau = self.__get_cell_values(self.__tau_cells, self.__surface_cells, index)
+        D = self.get_D()
+        if type(D) is np.ndarray:
+            D = self.__get_cell_values(self.__D_cells, self.__surface_all_cells, index)
+        k_dep = (self.precursor.sigma * self.precursor.V * self.deposition_scaling / self.cell_V *
+                 self.cell_size ** 2)
+        exponential = self.reaction_integrator == 'exponential'
+        if self.compiled_stepping:
+            beam_matrix = np.asarray(beam_matrix, dtype=np.float64)
+            tau = np.broadcast_to(tau, precursor.shape).astype(np.float64)
+            D = np.broadcast_to(D, precursor.shape).astype(np.float64)
+            time_passed, _, _ = run_until_filled_2d(precursor, deposit, beam_matrix, tau, D,
+                                                    self.precursor.F, self.precursor.n0, self.precursor.sigma, k_dep,
+                                                    self.cell_size, self.dt, time_limit, exponential)
+            self.__precursor_reduced_2d[index] = precursor
+            self.__deposit_reduced_2d[index] = deposit
+            deposit_irradiated[top] = deposit[y, x]
+            self.__set_deposit(deposit_irradiated)
+            return time_passed
+        time_passed = 0
+        while True:
+            dt = self.dt
+            last = time_passed + dt >= time_limit
+            if last:  # stepping only for remaining time to avoid accumulating of excess deposit
+                dt = time_limit - time_passed
+            if exponential:
+                deposit += self.__exponential(precursor, beam_matrix, tau, mean=True, dt=dt) * beam_matrix * k_dep * dt
+                precursor = self.__exponential(precursor, beam_matrix, tau, dt=dt)
+                precursor += self.__rk4_diffusion_2d(precursor, D, dt)
+            else:
+                # Reaction and diffusion terms are integrated together, deposit by the trapezoidal rule
+                precursor_start = precursor.copy()
+                precursor += self.__rk4_diffusion_2d(precursor, D, dt, beam_matrix, tau)
+                deposit += (precursor_start + precursor) / 2 * beam_matrix * k_dep * dt
+            if last:
+                time_passed = time_limit
+                break
+            time_passed += dt
+            if deposit.max() >= 1:
+                break
+        self.__precursor_reduced_2d[index] = precursor
+        self.__deposit_reduced_2d[index] = deposit
+        deposit_irradiated[top] = deposit[y, x]
+        self.__set_deposit(deposit_irradiated)
+        return time_passed
+
+    def __get_height_field_index(self):
+        """
+        Get index of the surface cells on top of every column in the 2D view.
+
+        :return: tuple of 2D arrays
+        """
+        _, ydim, xdim = self.structure.shape
+        z = self.structure.height_map + 1 - self.irradiated_area_2D[0].start
+        y, x = np.indices((ydim, xdim), dtype=np.intc)
+        return np.intc(z), y, x
+
+    def __check_height_field(self):
+        """
+        Check if the structure is still a height field, otherwise switch to the full 3D solution.
+
+        A height field has no overhangs and no steps higher than a cell, so that every surface cell is on top of
+        its column.
 
-    def equilibrate(self, max_it=10000):
+        :return:
+        """
+        z, y, x = self.__surface_cells
+        top = self.structure.height_map[y, x] + 1 - self.irradiated_area_2D[0].start
+        if z.shape[0] == self.structure.height_map.size and np.all(z == top):
+            return
+        print('Structure is no longer a height field, switching to the 3D solution.')
+        self.__height_field = False
+        # Semi-surface cells are not solved in the height field mode, they receive coverage of the cell below
+        z, y, x = self.__semi_surface_cells
+        below = self.__has_flags((z - 1, y, x), SURFACE)
+        self.__precursor_reduced_2d[z[below], y[below], x[below]] = \
+            self.__precursor_reduced_2d[z[below] - 1, y[below], x[below]]
+
+    def __advance_compiled(self, time_limit):
+        """
+        Run the compiled time-stepping kernel.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        tau, D = self.__get_compiled_coefficients()
+        k_dep = (self.precursor.sigma * self.precursor.V * self.deposition_scaling / self.cell_V *
+                 self.cell_size ** 2)
+        n = np.asarray(self.__precursor_reduced_2d[self.__surface_all_cells], dtype=np.float64)
+        deposit = self.__get_deposit()
+        time_passed, _, _ = run_until_filled(n, deposit,
+                                             self.__surface_all_pos, D, *self.__get_surface_neighbors(),
+                                             self.__surface_pos,
+                                             np.asarray(self.__beam_matrix_surface, dtype=np.float64), tau,
+                                             self.__find_cells(self.__surface_all_cells, self.__deposition_index_2d),
+                                             np.asarray(self.__beam_matrix_effective, dtype=np.float64),
+                                             self.__get_tau_deposition(),
+                                             self.precursor.F, self.precursor.n0, self.precursor.sigma, k_dep,
+                                             self.cell_size, self.dt, time_limit,
+                                             self.reaction_integrator == 'exponential')
+        self.__precursor_reduced_2d[self.__surface_all_index] = n[self.__surface_all_pos]
+        self.__set_deposit(deposit)
+        return time_passed
+
+    def __get_compiled_coefficients(self):
+        """
+        Get residence time at the surface cells and diffusion coefficient at the solved cells as arrays
+        for the compiled kernels.
+
+        :return: tau, D
+        """
+        n_s = self.__surface_index[0].shape[0]
+        n_a = self.__surface_all_index[0].shape[0]
+        tau = self.get_tau()
+        if type(tau) is np.ndarray:
+            if tau.shape[0] != n_s:
+                self.residence_time()
+            tau = self.__tau_flat
+        else:
+            tau = np.full(n_s, tau)
+        D = self.get_D()
+        if type(D) is not np.ndarray:
+            D = np.full(n_a, D, dtype=np.float64)
+        return tau, D
+
+    def __advance_adaptive(self, time_limit):
+        """
+        Advance deposition and precursor coverage with error-controlled time steps
+        until a cell is filled or the time limit is reached.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        k_dep = (self.precursor.sigma * self.precursor.V * self.deposition_scaling / self.cell_V *
+                 self.cell_size ** 2)
+        surface_all = self.__surface_all_pos
+        n = np.asarray(self.__precursor_reduced_2d[self.__surface_all_cells], dtype=np.float64)
+        d_pos = self.__find_cells(self.__surface_all_cells, self.__deposition_index_2d)
+        if self.compiled_stepping:
+            tau, D = self.__get_compiled_coefficients()
+            deposit = self.__get_deposit()
+            time_passed, _, _, self._dt = run_adaptive_until_filled(
+                n, deposit, surface_all, D, *self.__get_surface_neighbors(), self.__surface_pos,
+                np.asarray(self.__beam_matrix_surface, dtype=np.float64), tau,
+                d_pos, np.asarray(self.__beam_matrix_effective, dtype=np.float64),
+                self.precursor.F, self.precursor.n0, self.precursor.sigma, k_dep, self.cell_size,
+                min(self._dt, self._dt_max), self._dt_max, time_limit, self.time_step_tolerance)
+            self.__precursor_reduced_2d[self.__surface_all_index] = n[surface_all]
+            self.__set_deposit(deposit)
+            return time_passed
+        present = d_pos >= 0  # irradiated cells without precursor do not grow
+        time_passed = 0
+        while True:
+            time_remaining = time_limit - time_passed
+            dt = self._dt
+            precursor, precursor_mean, time_step = self.__step_adaptive(n, time_remaining)
+            last = time_step >= time_remaining
+            if last and self._dt < dt:  # the step was only limited by the remaining time
+                self._dt = dt
+            # Deposition is calculated with the coverage averaged over the step
+            n[surface_all] = precursor_mean
+            deposit = self.__get_deposit()
+            deposit += np.where(present, n[d_pos], 0) * self.__beam_matrix_effective * k_dep * time_step
+            self.__set_deposit(deposit)
+            n[surface_all] = precursor
+            self.__precursor_reduced_2d[self.__surface_all_index] = precursor
+            if last:
+                return time_limit
+            time_passed += time_step
+            if self.check_cells_filled():
+                return time_passed
+
+    def __step_adaptive(self, n_all, time_limit):
+        """
+        Make an error-controlled time step of the reaction-diffusion equation with the Dormand-Prince method.
+
+        The step is retried with a smaller time step until the local error meets the tolerance.
+        The current time step is then updated to the one, estimated to be optimal for the next step.
+        Precursor coverage array is not changed.
+
+        :param n_all: precursor coverage of all the surface and semi-surface cells
+        :param time_limit: maximum time step, s
+        :return: precursor coverage of the solved cells after the step and averaged over the step, time step
+        """
+        n = n_all[self.__surface_all_pos]
+        # The last stage is evaluated at the solution, thus it is the first stage of the next step
+        if self.__adaptive_rate is not None and np.array_equal(self.__adaptive_rate[0], n):
+            k = [self.__adaptive_rate[1]]
+        else:
+            k = [self.__precursor_derivative(n, n_all)]
+        while True:
+            dt = min(self._dt, time_limit)
+            del k[1:]
+            stages = [n]
+            for a in _DP_A:
+                stages.append(n + dt * sum(a_i * k_i for a_i, k_i in zip(a, k) if a_i))
+                k.append(self.__precursor_derivative(stages[-1], n_all))
+            # 5th order solution, the last stage is evaluated at it
+            n_new = stages[-1]
+            error = dt * sum(e_i * k_i for e_i, k_i in zip(_DP_E, k))
+            scale = self.time_step_tolerance * (np.maximum(np.abs(n), np.abs(n_new)) + self.precursor.n0 * 1e-3)
+            error = np.abs(error / scale).max() if n.shape[0] > 0 else 0
+            # Standard step size controller with a safety factor and limited change
+            factor = 5 if error == 0 else min(5, max(0.2, 0.9 * error ** -0.2))
+            self._dt = min(dt * factor, self._dt_max)
+            if error <= 1:
+                self.__adaptive_rate = (n_new, k[-1])
+                # Coverage is averaged over the step with the same weights as the solution
+                n_mean = sum(b_i * n_i for b_i, n_i in zip(_DP_A[-1], stages) if b_i)
+                return n_new, n_mean, dt
+
+    def __precursor_derivative(self, n, n_all):
+        """
+        Calculate the rate of change of precursor coverage in the solved surface and semi-surface cells.
+
+        :param n: precursor coverage of the solved cells
+        :param n_all: precursor coverage of all the surface and semi-surface cells, the solved cells are overwritten
+        :return: flat array
+        """
+        n_all[self.__surface_all_pos] = n
+        rate = diffusion.diffusion_csr(n_all, self.get_D(), 1, self.cell_size, self.__surface_all_pos,
+                                       self.__get_surface_neighbors())
+        surface = self.__surface_rows
+        rate[surface] += self.__precursor_density_increment(n[surface], self.__beam_matrix_surface, 1)
+        return rate
+
+    def __advance_multirate(self, time_limit):
+        """
+        Advance deposition and precursor coverage with local time steps until a cell is filled
+        or the time limit is reached.
+
+        The step, at which a cell got filled, is completed.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        # Surface cells are sorted into classes by their local time step, see __prepare_multirate_classes.
+        # Each next class has twice as long time step. Cells are updated only once per their time step,
+        # thus slowly changing cells far from the beam are updated rarely.
+        # A class is advanced with the same discretization as the whole surface in the regular mode,
+        # only diffusion is restricted to the connections of the class. Exchange between two neighboring cells
+        # is calculated with the time step of the faster cell and is applied to both cells at once.
+        # Both cells of a connection share the same diffusion coefficient, the mean of the two,
+        # this way, no precursor is lost or gained neither at the borders of the classes nor between cells
+        # with different temperature.
+        # With a single class and uniform diffusion coefficient, the solution is the same as in the regular mode.
+        if self.__multirate_classes is None:
+            self.__multirate_classes = self.__prepare_multirate_classes()
+        precursor = self.__precursor_reduced_2d
+        deposit = self.__get_deposit()
+        n = np.asarray(precursor[self.__surface_all_cells], dtype=np.float64)
+        groups = {}
+        time_passed = 0
+        while True:
+            time_remaining = time_limit - time_passed
+            dt = self.dt
+            # The longest local time step has to fit into the remaining time
+            levels = self.multirate_levels
+            while levels > 1 and dt * 2 ** (levels - 1) > time_remaining:
+                levels -= 1
+            dt = min(dt, time_remaining)
+            time_step = dt * 2 ** (levels - 1)
+            if levels not in groups:
+                groups[levels] = self.__group_multirate_classes(levels)
+            for j in range(2 ** (levels - 1)):
+                # The first class is updated every substep, the others in the middle of their time steps,
+                # which is where the slowly changing cells are best represented by a single update.
+                active = [0]
+                level = (j & -j).bit_length()
+                if 0 < level < levels:
+                    active.append(level)
+                for level in active:
+                    self.__step_multirate_class(n, deposit, groups[levels][level], dt * 2 ** level)
+            precursor[self.__surface_all_index] = n[self.__surface_all_pos]
+            self.__set_deposit(deposit)
+            if time_step >= time_remaining:
+                return time_limit
+            time_passed += time_step
+            if self.check_cells_filled():
+                return time_passed
+
+    def __step_multirate_class(self, n, deposit, group, dt):
+        """
+        Advance deposition and precursor coverage of a time step class.
+
+        Deposition and the reaction term are calculated for the cells of the class,
+        the diffusion term for the connections of the class. Deposit is calculated from the coverage
+        averaged over the step.
+
+        :param n: precursor coverage of the surface and semi-surface cells, changed in place
+        :param deposit: deposit of the irradiated cells, changed in place, None to skip deposition
+        :param group: cells, irradiated cells and connections of the class, see __group_multirate_classes
+        :param dt: time step, s
+        :return:
+        """
+        cells, dep, deposition, touched, reacting, fixed, first, second, coeff = group
+        _, _, _, _, beam_matrix, tau, d_pos, d_flux, d_tau, _ = self.__multirate_classes
+        exponential = self.reaction_integrator == 'exponential'
+        deposit = deposit if deposit is not None and dep.shape[0] > 0 else None
+        if deposit is not None:
+            k_dep = (self.precursor.sigma * self.precursor.V * self.deposition_scaling / self.cell_V *
+                     self.cell_size ** 2)
+            c = n[d_pos[dep]]
+            if exponential:  # coverage averaged over the step
+                c = self.__exponential(c, d_flux[dep], d_tau[dep], mean=True, dt=dt)
+                deposit[deposition] += c * d_flux[dep] * k_dep * dt
+        if exponential:
+            # Exact reaction term, the diffusion term is then calculated from the updated coverage
+            n[cells] = self.__exponential(n[cells], beam_matrix[cells], tau[cells], dt=dt)
+
+        def stage(m):
+            increment = self.__diffusion_faces(m, dt, first, second, coeff)
+            increment[fixed] = 0
+            if not exponential:
+                increment[reacting] += self.__precursor_density_increment(m[reacting], beam_matrix[cells], dt,
+                                                                          tau=tau[cells])
+            return increment
+        if touched.shape[0] > 0:
+            n_init = n[touched]
+            k1 = stage(n_init)
+            k2 = stage(n_init + k1 / 2)
+            k3 = stage(n_init + k2 / 2)
+            k4 = stage(n_init + k3)
+            n[touched] += ne.re_evaluate("rk4", casting='same_kind')
+        if deposit is not None and not exponential:  # trapezoidal rule
+            deposit[deposition] += (c + n[d_pos[dep]]) / 2 * d_flux[dep] * k_dep * dt
+
+    def __diffusion_faces(self, n, dt, first, second, coeff):
+        """
+        Calculate diffusion term through the given connections between cells.
+
+        The exchange is the same as in the neighbor table solution with a uniform diffusion coefficient,
+        see diffusion.diffusion_csr. Whatever leaves one cell of a connection enters the other one.
+
+        :param n: precursor coverage of the connected cells
+        :param dt: time step, s
+        :param first: positions of the first cell of every connection in n
+        :param second: positions of the second cell of every connection in n
+        :param coeff: diffusion coefficient of every connection divided by the squared cell size
+        :return: flat array
+        """
+        exchange = (n[second] - n[first]) * coeff * dt
+        return np.bincount(first, exchange, n.shape[0]) - np.bincount(second, exchange, n.shape[0])
+
+    def __prepare_multirate_classes(self):
+        """
+        Sort surface cells and connections between them into classes by their local time steps.
+
+        The local time step of a cell is the longest one, that is stable and at which the local error meets
+        the time step tolerance. The error is measured by comparing a step with two steps of half the length.
+        The first of the two steps is the full step of the previous class.
+        The classes are kept until the surface, the beam or the diffusion coefficients and residence times change.
+
+        :return: class of each cell, class of each face, faces, diffusion coefficients of each face,
+            SE flux and residence time of each cell, positions of the irradiated cells with precursor
+            in the surface index, their SE flux and residence time and their positions in the deposition index
+        """
+        index = self.__surface_all_cells
+        n_cells = index[0].shape[0]
+        levels = self.multirate_levels
+        # Frozen cells are not solved, but neighboring cells still exchange precursor with them
+        D = np.zeros(n_cells)
+        D[:] = self.__D_cells if self.temperature_tracking else self.precursor.D
+        faces = diffusion.prepare_surface_faces(index, self.__precursor_reduced_2d.shape)
+        coeff = (D[faces[0]] + D[faces[1]]) / 2 / (self.cell_size * self.cell_size)
+        D = np.zeros(n_cells)
+        D[self.__surface_all_pos] = self.get_D()
+        surface = self.__surface_pos
+        beam_matrix = np.zeros(n_cells, dtype=self.__beam_matrix_surface.dtype)
+        beam_matrix[surface] = self.__beam_matrix_surface
+        if type(self.get_tau()) is np.ndarray and self.get_tau().shape[0] != surface.shape[0]:
+            self.residence_time()
+        tau = np.ones(n_cells)
+        tau[surface] = self.get_tau()
+        d_pos = self.__find_cells(index, self.__deposition_index_2d)
+        present = d_pos >= 0  # irradiated cells without precursor do not grow
+        d_pos = d_pos[present]
+        d_flux = np.asarray(self.__beam_matrix_effective, dtype=np.float64)[present]
+        d_tau = self.__get_tau_deposition()[present]
+        deposition = present.nonzero()[0]
+        # Local stability limits
+        dt_local = np.full(n_cells, np.inf)
+        diffusing = D > 0
+        dt_local[diffusing] = diffusion.get_diffusion_stability_time(D[diffusing], self.cell_size)
+        if self.reaction_integrator != 'exponential':
+            rate = 1 / tau[surface] + self.precursor.sigma * beam_matrix[surface]
+            dt_local[surface] = np.minimum(dt_local[surface], 1 / rate)
+        stable = np.floor(np.log2(dt_local / self.dt))
+        # Local errors are measured with all the cells in a single class
+        cell_class = np.zeros(n_cells, dtype=np.intc)
+        face_class = np.zeros(faces[0].shape[0], dtype=np.intc)
+        self.__multirate_classes = (cell_class, face_class, faces, coeff, beam_matrix, tau,
+                                    d_pos, d_flux, d_tau, deposition)
+        group = self.__group_multirate_classes(1)[0]
+        n = np.asarray(self.__precursor_reduced_2d[index], dtype=np.float64)
+        accepted = np.ones(n_cells, dtype=bool)
+        n_previous = n.copy()
+        self.__step_multirate_class(n_previous, None, group, self.dt)
+        for level in range(1, levels):
+            dt = self.dt * 2 ** level
+            n_full = n.copy()
+            self.__step_multirate_class(n_full, None, group, dt)
+            # The first half step is the full step of the previous level
+            n_half = n_previous
+            self.__step_multirate_class(n_half, None, group, dt / 2)
+            scale = self.time_step_tolerance * (np.maximum(np.abs(n), np.abs(n_half)) + self.precursor.n0 * 1e-3)
+            accepted &= (np.abs(n_full - n_half) <= scale) & (stable >= level)
+            if not accepted.any():
+                break
+            cell_class[accepted] = level
+            n_previous = n_full
+        face_class[:] = np.minimum(cell_class[faces[0]], cell_class[faces[1]])
+        return self.__multirate_classes
+
+    def __group_multirate_classes(self, levels):
+        """
+        Group cells, faces and irradiated cells by their time step classes.
+
+        Classes above the given number of levels are merged into the last one.
+
+        :param levels: number of time step classes
+        :return: for each class, positions of the surface cells, positions of the irradiated cells
+            among the ones with precursor and in the deposition index, positions of the touched cells,
+            positions of the surface cells, of the frozen cells and of the first and the second cell of every face
+            among them and diffusion coefficients of the faces
+        """
+        cell_class, face_class, faces, coeff, _, _, d_pos, _, _, deposition = self.__multirate_classes
+        cell_class = np.minimum(cell_class, levels - 1)
+        face_class = np.minimum(face_class, levels - 1)
+        deposition_class = cell_class[d_pos]
+        # Semi-surface cells only take part in diffusion
+        surface_class = cell_class[self.__surface_pos]
+        frozen = np.ones(cell_class.shape[0], dtype=bool)
+        frozen[self.__surface_all_pos] = False
+        groups = []
+        for i in range(levels):
+            face = (face_class == i).nonzero()[0]
+            cells = self.__surface_pos[surface_class == i]
+            # The equation is solved only for the cells of the class and the cells connected by its faces
+            touched, pairs = np.unique(np.concatenate((faces[0][face], faces[1][face], cells)), return_inverse=True)
+            first, second, reacting = np.split(np.intc(pairs), [face.shape[0], 2 * face.shape[0]])
+            fixed = frozen[touched].nonzero()[0]
+            dep = (deposition_class == i).nonzero()[0]
+            groups.append((cells, dep, deposition[dep], touched, reacting, fixed, first, second, coeff[face]))
+        return groups
+
+    def __update_active_set(self, time_passed):
+        """
+        Freeze surface cells with a steady precursor coverage and reactivate the rest.
+
+        The check is done once per probing interval.
+
+        :param time_passed: time passed since the last call, s
+        :return:
+        """
+        # The change of coverage over the probing interval is estimated from its current rate of change,
+        # which also tells, whether a frozen cell has to be reactivated due to the change of its neighbors.
+        self.__active_set_time += time_passed
+        probe_time = self.dt * self.steady_state_probe
+        if self.__active_set_time < probe_time:
+            return
+        self.__active_set_time = 0
+        index = self.__surface_all_cells
+        n = np.asarray(self.__precursor_reduced_2d[index], dtype=np.float64)
+        D = self.__D_cells if self.temperature_tracking else self.precursor.D
+        rate = diffusion.diffusion_csr(n, D, 1, self.cell_size, np.arange(n.shape[0], dtype=np.intc),
+                                       self.__get_surface_neighbors())
+        surface = self.__has_flags(index, SURFACE)
+        tau = self.__tau_cells if self.temperature_tracking else self.precursor.tau
+        beam_matrix = self.__get_beam_flux(index)
+        rate[surface] += self.__precursor_density_increment(n[surface], beam_matrix[surface], 1, tau=tau)
+        frozen = np.abs(rate) * probe_time <= self.freeze_tolerance * n
+        frozen[beam_matrix > 0] = False  # irradiated cells are always solved
+        if np.any(frozen != self.__has_flags(index, FROZEN)):
+            self.__frozen_reduced_2d[index] = frozen
+            self.__generate_surface_index()
+            self.__flatten_beam_matrix_surface()
+            if self.temperature_tracking:
+                self.residence_time()
+
+    def __advance_skipping(self, time_limit):
+        """
+        Advance deposition and precursor coverage and skip time steps, when precursor coverage is steady.
+
+        :param time_limit: maximum time to advance, s
+        :return: time passed, s
+        """
+        # While precursor coverage is changing, the solution is stepped in short probing intervals.
+        # The change of coverage over such an interval tells if the coverage has reached a steady state.
+        # Under a steady coverage the deposition rate in every irradiated cell is constant, thus the time
+        # when each cell gets filled is known in advance and all the steps in between can be skipped.
+        time_passed = 0
+        while True:
+            time_remaining = time_limit - time_passed
+            if self.__steady_state:
+                time_step = self.__skip_to_fill(time_remaining)
+                return time_limit if time_step >= time_remaining else time_passed + time_step
+            probe_time = min(time_remaining, self.dt * self.steady_state_probe)
+            precursor_prev = self.__precursor_reduced_2d[self.__surface_all_index]
+            time_step = self.__advance_steps(probe_time)
+            if time_step >= time_remaining:
+                return time_limit
+            time_passed += time_step
+            if self.check_cells_filled():
+                return time_passed
+            precursor = self.__precursor_reduced_2d[self.__surface_all_index]
+            change = np.abs(precursor - precursor_prev).max()
+            self.__steady_state = change <= self.steady_state_tolerance * precursor.max()
+
+    def __skip_to_fill(self, time_limit):
+        """
+        Deposit with the current rates until the first cell is filled or the time limit is reached.
+
+        Precursor coverage is assumed steady.
+
+        :param time_limit: maximum time to skip, s
+        :return: time skipped, s
+        """
+        precursor = self.__precursor_reduced_3d[self.__deposition_index]
+        deposit = self.__get_deposit()
+        const = (self.precursor.sigma * self.precursor.V * self.deposition_scaling / self.cell_V *
+                 self.cell_size ** 2)
+        rate = precursor * self.__beam_matrix_effective * const
+        rate[deposit < 0] = 0  # solid cells do not grow
+        growing = (rate > 0).nonzero()[0]
+        time_skip = time_limit
+        first = None
+        if growing.shape[0] > 0:
+            time_fill = (1 - deposit[growing]) / rate[growing]
+            i = time_fill.argmin()
+            if time_fill[i] < time_limit:
+                time_skip = max(time_fill[i], 0)
+                first = growing[i]
+        deposit = deposit + rate * time_skip
+        if first is not None:  # ensuring that the cell is marked as filled despite the rounding error
+            deposit[first] = max(deposit[first], 1)
+        self.__set_deposit(deposit)
+        return time_skip
+
+    def equilibrate(self, max_it=10000, eps=1e-8):
         """
         Bring precursor coverage to a steady state with a given accuracy
 
         It is advised to run this method after updating the surface in order to determine a more accurate precursor
         density value for newly acquired cells
 
-        :param max_it: number of iterations
+        :param max_it: maximum number of iterations
+        :param eps: desired relative residual
+        :return: number of iterations, achieved relative residual
         """
+        # In a steady state, the reaction-diffusion equation is a linear system on the graph of the surface cells.
+        # Each row is divided by the diffusion coefficient of its cell, which makes the system symmetric:
+        # (deg(i) - sum of neighbors) * n_i + (F/n0 + 1/tau + sigma*f) * dx**2 / D * n_i = F * dx**2 / D
+        # Semi-surface cells only take part in diffusion, thus they have no reaction terms.
         start = df()
-        for i in range(max_it):
-            # p_prev = self.__precursor_reduced_2d.copy()
-            self.precursor_density()
-            # norm = np.linalg.norm(self.__precursor_reduced_2d - p_prev)/ np.linalg.norm(self.__precursor_reduced_2d)
-            # if norm < eps:
-            #     print(f'Took {i+1} iteration(s) to equilibrate, took {df() - start}')
-            #     return 1
+        precursor = self.__precursor_reduced_2d
+        index = self.__surface_all_cells
+        n = np.asarray(precursor[index], dtype=np.float64)
+        surface = self.__has_flags(index, SURFACE)
+        tau = self.__tau_cells if self.temperature_tracking else self.precursor.tau
+        beam_matrix = self.__get_beam_flux(index)[surface]
+        a = self.precursor.F / self.precursor.n0 + 1 / tau + self.precursor.sigma * beam_matrix
+        if self.temperature_tracking:
+            D = self.__D_cells
+        elif self.precursor.D <= 0:  # no diffusion, every cell is on its own
+            n[surface] = self.precursor.F / a
+            precursor[index] = n
+            print(f'Took 0 iteration(s) to equilibrate, took {df() - start}')
+            return 0, 0
         else:
-            # acc = str(norm)[:int(3-math.log10(eps))]
-            # warnings.warn(f'Failed to reach {eps} accuracy in {max_it} iterations in Process.equilibrate. Achieved accuracy: {acc} \n'
-            #               f'Terminating loop.', RuntimeWarning)
-            print(f'Took {i + 1} iteration(s) to equilibrate, took {df() - start}')
+            D = np.full(n.shape[0], self.precursor.D, dtype=np.float64)
+        coeff, rhs = self.__steady_state_terms(surface, beam_matrix, tau, D)
+        faces = diffusion.prepare_surface_faces(index, precursor.shape)
+        n, i, residual = diffusion.steady_state_pcg(faces, coeff, rhs, n, eps, max_it)
+        precursor[index] = n
+        if residual > eps:
+            warnings.warn(f'Failed to reach {eps} accuracy in {max_it} iterations in Process.equilibrate. '
+                          f'Achieved accuracy: {residual:.3e}', RuntimeWarning)
+        print(f'Took {i} iteration(s) to equilibrate with a residual of {residual:.3e}, took {df() - start}')
+        return i, residual
 
-    def __rk4(self, precursor, beam_matrix):
+    def __equilibrate_local(self, local_slice):
+        """
+        Bring precursor coverage in a small region to a steady state.
+
+        Coverage of the cells around the region is fixed and serves as a boundary condition.
+
+        :param local_slice: region of the 3D view
+        :return:
+        """
+        shape = self.__precursor_reduced_3d.shape
+        # Extending the region by one cell to include the boundary
+        block = tuple(slice(max(s.start - 1, 0), min(s.stop + 1, length)) for s, length in zip(local_slice, shape))
+        precursor = self.__precursor_reduced_3d[block]
+        flags = self.__flags_reduced_3d[block]
+        index = (flags & (SURFACE | SEMI_SURFACE)).nonzero()
+        index = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
+        n = np.asarray(precursor[index], dtype=np.float64)
+        inner = np.ones(n.shape[0], dtype=bool)
+        for i, s, b in zip(index, local_slice, block):
+            inner &= (i >= s.start - b.start) & (i < s.stop - b.start)
+        n_inner = np.count_nonzero(inner)
+        if n_inner == 0:
+            return
+        surface = (flags[index] & SURFACE > 0)[inner]
+        # Same cells, but indexed in the view encapsulating the whole surface
+        _, y_slice, x_slice = self.__irradiated_area_3d
+        cells = (index[0][inner] + block[0].start, index[1][inner] + block[1].start + y_slice.start,
+                 index[2][inner] + block[2].start + x_slice.start)
+        beam_matrix = self.__get_beam_flux(cells)[surface]
+        tau = self.get_tau()
+        D = self.get_D()
+        if type(tau) is np.ndarray:
+            # New cells may have not received their values yet
+            tau = self.__get_cell_values(self.__tau_cells, self.__surface_cells, cells)[surface]
+            tau[tau <= 0] = tau.max(initial=0) or self.precursor.tau
+        if type(D) is np.ndarray:
+            D = self.__get_cell_values(self.__D_cells, self.__surface_all_cells, cells)
+            D[D <= 0] = D.max(initial=0) or self.precursor.D
+        elif D <= 0:  # no diffusion, every cell is on its own
+            a = self.precursor.F / self.precursor.n0 + 1 / tau + self.precursor.sigma * beam_matrix
+            n_local = n[inner]
+            n_local[surface] = self.precursor.F / a
+            precursor[tuple(i[inner] for i in index)] = n_local
+            return
+        else:
+            D = np.full(n_inner, D, dtype=np.float64)
+        coeff, rhs = self.__steady_state_terms(surface, beam_matrix, tau, D)
+        # Connections to the fixed cells contribute to the diagonal and the right hand side
+        first, second = diffusion.prepare_surface_faces(index, precursor.shape)
+        position = np.cumsum(inner) - 1
+        solved = inner[first] & inner[second]
+        faces = (position[first[solved]], position[second[solved]])
+        boundary = inner[first] ^ inner[second]
+        solved = np.where(inner[first], first, second)[boundary]
+        fixed = np.where(inner[first], second, first)[boundary]
+        coeff += np.bincount(position[solved], minlength=n_inner)
+        rhs += np.bincount(position[solved], n[fixed], n_inner)
+        n_local, _, _ = diffusion.steady_state_pcg(faces, coeff, rhs, n[inner], 1e-8, 1000)
+        precursor[tuple(i[inner] for i in index)] = n_local
+
+    def __steady_state_terms(self, surface, beam_matrix, tau, D):
+        """
+        Get diagonal and right hand side terms of the steady state reaction-diffusion equation.
+
+        Equation rows are divided by the diffusion coefficient, see equilibrate.
+
+        :param surface: surface cells mask, the rest are semi-surface cells
+        :param beam_matrix: SE flux at the surface cells
+        :param tau: residence time at the surface cells
+        :param D: diffusion coefficient at each cell
+        :return: diagonal terms, right hand side
+        """
+        a = self.precursor.F / self.precursor.n0 + 1 / tau + self.precursor.sigma * beam_matrix
+        scale = self.cell_size ** 2 / D
+        coeff = np.zeros(D.shape[0])
+        coeff[surface] = a * scale[surface]
+        rhs = np.zeros(D.shape[0])
+        rhs[surface] = self.precursor.F * scale[surface]
+        return coeff, rhs
+
+    def __rk4(self, precursor, beam_matrix, dt=None, tau=None):
         """
         Calculates increment of precursor density by Runge-Kutta method
 
         :param precursor: flat precursor array
         :param beam_matrix: flat surface electron flux array
+        :param dt: time step, current time step by default
+        :param tau: residence time, residence time of the surface cells by default
         :return:
         """
+        if dt is None:
+            dt = self.dt
         k1 = self.__precursor_density_increment(precursor, beam_matrix,
-                                                self.dt)  # this is actually an array of k1 coefficients
-        k2 = self.__precursor_density_increment(precursor, beam_matrix, self.dt / 2, k1 / 2)
-        k3 = self.__precursor_density_increment(precursor, beam_matrix, self.dt / 2, k2 / 2)
-        k4 = self.__precursor_density_increment(precursor, beam_matrix, self.dt, k3)
+                                                dt, tau=tau)  # this is actually an array of k1 coefficients
+        k2 = self.__precursor_density_increment(precursor, beam_matrix, dt, k1 / 2, tau)
+        k3 = self.__precursor_density_increment(precursor, beam_matrix, dt, k2 / 2, tau)
+        k4 = self.__precursor_density_increment(precursor, beam_matrix, dt, k3, tau)
         return ne.re_evaluate("rk4", casting='same_kind')
 
-    def __rk4_diffusion(self, grid, surface):
+    def __exponential(self, precursor, beam_matrix, tau, mean=False, dt=None):
         """
-        Apply Runge-Kutta 4 method to the calculation of the diffusion term.
+        Calculate precursor density after a time step by the exact solution of the reaction term.
 
-        :param grid: precursor coverage array
-        :param surface: surface boolean array
+        With a fixed SE flux and residence time the reaction term is linear in the precursor density,
+        thus the coverage exponentially approaches its steady state value.
+
+        :param precursor: flat precursor array
+        :param beam_matrix: flat surface electron flux array
+        :param tau: residence time
+        :param mean: if True, return the coverage averaged over the time step instead
+        :param dt: time step, current time step by default
         :return:
         """
+        if dt is None:
+            dt = self.dt
+        k = self.precursor.F / self.precursor.n0 + 1 / tau + self.precursor.sigma * beam_matrix
+        n_inf = self.precursor.F / k
+        return ne.re_evaluate('precursor_exp_mean' if mean else 'precursor_exp',
+                              local_dict={'n': precursor, 'n_inf': n_inf, 'k': k, 'dt': dt},
+                              casting='same_kind')
+
+    def __rk4_diffusion(self, n):
+        """
+        Apply Runge-Kutta 4 method to the calculation of the diffusion term.
+
+        :param n: flat precursor coverage array of all the surface and semi-surface cells
+        :return: flat array for the solved cells
+        """
+        dt = self.dt
+        surface_all = self.__surface_all_pos
+        n_init = n[surface_all]
+        k1 = self._diffusion(n, dt)
+        n[surface_all] = n_init + k1 / 2
+        k2 = self._diffusion(n, dt)
+        n[surface_all] = n_init + k2 / 2
+        k3 = self._diffusion(n, dt)
+        n[surface_all] = n_init + k3
+        k4 = self._diffusion(n, dt)
+        n[surface_all] = n_init
+        return ne.re_evaluate("rk4", casting='same_kind')
+
+    def __rk4_reaction_diffusion(self, n):
+        """
+        Apply Runge-Kutta 4 method to the reaction-diffusion equation.
+
+        :param n: flat precursor coverage array of all the surface and semi-surface cells
+        :return: flat array for the solved cells
+        """
         dt = self.dt
-        k1 = self._diffusion(grid, surface, dt, flat=False)
-        k1[surface] /= 2
-        k2 = self._diffusion(grid, surface, dt / 2, add=k1, flat=False)
-        k2[surface] /= 2
-        k3 = self._diffusion(grid, surface, dt / 2, add=k2, flat=False)
-        k4 = self._diffusion(grid, surface, dt, add=k3, flat=False)
+        n_init = n[self.__surface_all_pos]
+        k1 = self.__precursor_derivative(n_init, n) * dt
+        k2 = self.__precursor_derivative(n_init + k1 / 2, n) * dt
+        k3 = self.__precursor_derivative(n_init + k2 / 2, n) * dt
+        k4 = self.__precursor_derivative(n_init + k3, n) * dt
+        n[self.__surface_all_pos] = n_init
         return ne.re_evaluate("rk4", casting='same_kind')
 
-    def __precursor_density_increment(self, precursor, beam_matrix, dt, addon=0.0):
+    def __rk4_diffusion_2d(self, grid, D, dt, beam_matrix=None, tau=None):
+        """
+        Apply Runge-Kutta 4 method to the calculation of the diffusion term of a height field.
+
+        :param grid: 2D precursor coverage array
+        :param D: diffusion coefficient
+        :param dt: time step
+        :param beam_matrix: SE flux, if given, the reaction term is included into every stage
+        :param tau: residence time
+        :return:
+        """
+        def stage(n):
+            increment = diffusion.diffusion_ftcs_2d(n, D, dt, self.cell_size)
+            if beam_matrix is not None:
+                increment += self.__precursor_density_increment(n, beam_matrix, dt, tau=tau)
+            return increment
+        k1 = stage(grid)
+        k2 = stage(grid + k1 / 2)
+        k3 = stage(grid + k2 / 2)
+        k4 = stage(grid + k3)
+        return ne.re_evaluate("rk4", casting='same_kind')
+
+    def __precursor_density_increment(self, precursor, beam_matrix, dt, addon=0.0, tau=None):
         """
         Calculates increment of the precursor density without a diffusion term
 
@@ -778,28 +1676,41 @@ class Process:
         :param beam_matrix: flat surface electron flux array
         :param dt: time step
         :param addon: Runge Kutta term
+        :param tau: residence time, residence time of the surface cells by default
         :return:
         """
-        tau = self.get_tau()
+        if tau is None:
+            tau = self.get_tau()
         return ne.re_evaluate('precursor_temp',
                               local_dict={'F': self.precursor.F, 'dt': dt, 'n0': self.precursor.n0,
                                           'sigma': self.precursor.sigma, 'n': precursor + addon, 'tau': tau,
                                           'se_flux': beam_matrix}, casting='same_kind')
 
-    def _diffusion(self, grid, surface, dt=0.0, add=0, flat=False):
+    def _diffusion(self, n, dt=0.0):
         """
-        Calculates diffusion term of the reaction-diffusion equation for all surface cells.
+        Calculates diffusion term of the reaction-diffusion equation for all solved surface cells.
 
-        :param grid: precursor coverage array
-        :param surface: boolean surface array
-        :param add: Runge-Kutta intermediate member
+        :param n: flat precursor coverage array of all the surface and semi-surface cells
+        :param dt: time step, current time step by default
         :return: flat ndarray
         """
         if not dt:
             dt = self.dt
         D = self.get_D()
-        return diffusion.diffusion_ftcs(grid, surface, D, dt, self.cell_size, self.__surface_all_index, flat=flat,
-                                        add=add)
+        return diffusion.diffusion_csr(n, D, dt, self.cell_size, self.__surface_all_pos,
+                                       self.__get_surface_neighbors())
+
+    def __diffusion_implicit(self, grid):
+        """
+        Solve diffusion for the surface cells implicitly over a time step.
+
+        :param grid: precursor coverage array
+        :return:
+        """
+        if self.__diffusion_lines is None:
+            self.__diffusion_lines = diffusion.prepare_diffusion_lines(self.__surface_all_index)
+        diffusion.diffusion_implicit(grid, self.get_D(), self.dt, self.cell_size, self.__surface_all_index,
+                                     self.__diffusion_lines)
 
     def heat_transfer(self, heating):
         """
@@ -826,9 +1737,15 @@ class Process:
                 print(f'New max. temperature {self.structure.temperature.max():.3f} K')
                 print(f'Temperature recalculation took {df() - start:.4f} s')
         self.structure.temperature[self.substrate_height] = self.room_temp
+        if self.active_set and self._frozen.any():
+            self._frozen[...] = False  # temperature change affects the whole surface
+            self.__generate_surface_index()
+            self.__flatten_beam_matrix_surface()
         self.__get_surface_temp()  # estimating surface temperature
         self.diffusion_coefficient()  # calculating surface diffusion coefficients
         self.residence_time()  # calculating residence times
+        self.reset_dt()
+        self.__steady_state = False
 
     def diffusion_coefficient(self):
         """
@@ -836,7 +1753,10 @@ class Process:
 
         :return:
         """
-        self.D_temp[self._surface_all] = self.precursor.diffusion_coefficient_at_T(self.surface_temp[self._surface_all])
+        surface_temp = self.__surface_temp_reduced_2d[self.__surface_all_cells]
+        self.__D_cells = self.precursor.diffusion_coefficient_at_T(surface_temp)
+        self.__D_flat = self.__D_cells[self.__surface_all_active]
+        self.__multirate_classes = None
 
     def residence_time(self):
         """
@@ -844,22 +1764,62 @@ class Process:
 
         :return:
         """
-        self.__tau_flat = self.precursor.residence_time_at_T(self.__surface_temp_reduced_2d[self.__surface_reduced_2d])
-        self.__tau_temp_reduced_2d[self.__surface_reduced_2d] = self.__tau_flat
+        self.__tau_cells = self.precursor.residence_time_at_T(self.__surface_temp_reduced_2d[self.__surface_cells])
+        self.__tau_flat = self.__tau_cells[self.__surface_active]
+        self.__multirate_classes = None
 
     def set_beam_matrix(self, beam_matrix):
         """
-        Set secondary electron flux matrix
+        Set secondary electron flux
 
-        :param beam_matrix: flux matrix array
+        :param beam_matrix: irradiated cells index and flux values in them, a flux matrix array
+            or a single flux value for all the surface cells
         :return:
         """
-        self.beam_matrix[:, :, :] = beam_matrix
-        if type(beam_matrix) is not np.ndarray:
-            beam_matrix = np.array(beam_matrix)
+        # Only the irradiated cells are stored, thus the flux is never copied into a full-size array
+        if type(beam_matrix) is tuple:
+            index, flux = beam_matrix
+            self.beam.f0 = flux.max(initial=0)
+        elif type(beam_matrix) is np.ndarray:
+            index = beam_matrix.nonzero()
+            flux = beam_matrix[index]
+            self.beam.f0 = flux.max(initial=0)
         else:
-            self.beam.f0 = beam_matrix.max()
+            z_start = self.irradiated_area_2D[0].start
+            index = (self.__surface_cells[0] + z_start, self.__surface_cells[1], self.__surface_cells[2])
+            flux = np.full(index[0].shape[0], beam_matrix)
+        # Flux outside the view encapsulating the whole surface is not used
+        z_slice = self.irradiated_area_2D[0]
+        inside = (index[0] >= z_slice.start) & (index[0] < z_slice.stop)
+        index = tuple(np.intc(i[inside]) for i in index)
+        if self.single_precision:
+            # Rounding error is carried over for the cells that are still irradiated
+            if self.__deposit_error is None:
+                self.__deposit_error = np.zeros(index[0].shape[0])
+            else:
+                self.__deposit_error = self.__get_cell_values(self.__deposit_error, self.__beam_index, index)
+        self.__beam_index = index
+        self.__beam_flux = np.asarray(flux, dtype=np.int32)[inside]
+        self.__multirate_classes = None
+        if self.active_set:
+            self._frozen[self.irradiated_area_3D] = False  # the area around the beam is solved again
         self.update_helper_arrays()
+        self.reset_dt()
+        self.__steady_state = False
+
+    @property
+    def beam_matrix(self):
+        """
+        Get secondary electron flux as a full-size array.
+
+        The array is assembled on every call, the flux itself is stored only for the irradiated cells.
+
+        :return: 3D array
+        """
+        beam_matrix = np.zeros(self.structure.shape, dtype=np.int32)
+        if self.__beam_index is not None:
+            beam_matrix[self.__beam_index] = self.__beam_flux
+        return beam_matrix
 
     # Data maintenance methods
     # These methods support an optimization path that provides up to 100x speed up
@@ -889,14 +1849,14 @@ class Process:
         #  on the necessary array.
         # '3D view' mentioned here can be referred to as a volume that encapsulates all cells that have been irradiated
         slice3d = self.irradiated_area_3D
+        self.__irradiated_area_3d = slice3d
         self.__deposit_reduced_3d = self.structure.deposit[slice3d]
         self.__precursor_reduced_3d = self.structure.precursor[slice3d]
+        self.__flags_reduced_3d = self.structure.cell_flags[slice3d]
         self.__surface_reduced_3d = self.structure.surface_bool[slice3d]
-        self.__semi_surface_reduced_3d = self.structure.semi_surface_bool[slice3d]
-        self.__ghosts_reduced_3d = self.structure.ghosts_bool[slice3d]
         self.__temp_reduced_3d = self.structure.temperature[slice3d]
-        self.__beam_matrix_reduced_3d = self.beam_matrix[slice3d]
         self.__surface_neighbors_reduced_3d = self.structure.surface_neighbors_bool[slice3d]
+        self.__frozen_reduced_3d = self._frozen[slice3d]
 
     def __update_views_2d(self):
         """
@@ -912,14 +1872,25 @@ class Process:
         slice2d = self.irradiated_area_2D
         self.__deposit_reduced_2d = self.structure.deposit[slice2d]
         self.__precursor_reduced_2d = self.structure.precursor[slice2d]
+        self.__flags_reduced_2d = self.structure.cell_flags[slice2d]
         self.__surface_reduced_2d = self.structure.surface_bool[slice2d]
         self.__semi_surface_reduced_2d = self.structure.semi_surface_bool[slice2d]
         self.__surface_all_reduced_2d = self._surface_all[slice2d]
-        self.__beam_matrix_reduced_2d = self.beam_matrix[slice2d]
         self.__temp_reduced_2d = self.structure.temperature[slice2d]
         self.__surface_temp_reduced_2d = self.surface_temp[slice2d]
-        self.__D_temp_reduced_2d = self.D_temp[slice2d]
-        self.__tau_temp_reduced_2d = self.tau_temp[slice2d]
+        self.__frozen_reduced_2d = self._frozen[slice2d]
+
+    def __has_flags(self, index, bits):
+        """
+        Check the flags of the cells in the view encapsulating the whole surface.
+
+        Reads the cell flags array directly, unlike the cell masks, that are meant for the whole volume.
+
+        :param index: cells index
+        :param bits: flags to check, a cell is marked if any of them is set
+        :return: bool array
+        """
+        return self.__flags_reduced_2d[index] & bits > 0
 
     def __generate_deposition_index(self):
         """
@@ -927,22 +1898,164 @@ class Process:
 
         :return:
         """
-        self.__deposition_index = self.__beam_matrix_reduced_3d.nonzero()
+        z_slice, y_slice, x_slice = self.__irradiated_area_3d
+        z, y, x = self.__beam_index
+        self.__deposition_index = (z - z_slice.start, y - y_slice.start, x - x_slice.start)
+        # Same cells, but indexed in the view encapsulating the whole surface
+        self.__deposition_index_2d = (z - z_slice.start, y, x)
 
-    def __generate_surface_index(self):
+    def __index_surface_cells(self):
         """
-        Generate a tuple of indices for faster indexing in 'laplace_term' method
+        Find all the surface and semi-surface cells.
+
+        Afterwards, the indices are maintained by __update_cell_indices as the cells are filled.
 
         :return:
         """
-        self.__surface_all_reduced_2d[:, :, :] = np.logical_or(self.__surface_reduced_2d,
-                                                               self.__semi_surface_reduced_2d)
-        index = self.__surface_all_reduced_2d.nonzero()
-        self.__surface_all_index = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
         index = self.__surface_reduced_2d.nonzero()
-        self.__surface_index = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
+        self.__surface_cells = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
         index = self.__semi_surface_reduced_2d.nonzero()
-        self.__semi_surface_index = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
+        self.__semi_surface_cells = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
+        index = self.__surface_all_reduced_2d.nonzero()
+        self.__surface_all_cells = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
+        self.__surface_neighbors = None
+        self.__D_cells = np.zeros(self.__surface_all_cells[0].shape[0])
+        self.__tau_cells = np.zeros(self.__surface_cells[0].shape[0])
+
+    def __update_cell_indices(self, cells):
+        """
+        Update indices of the surface, semi-surface and solid cells around the filled cells.
+
+        :param cells: filled cells index
+        :return:
+        """
+        # Only the nearest neighbors of the filled cells change their state
+        neighbors, _ = get_neighbors_index(cells, self.__offsets_1st, self.__surface_reduced_3d.shape)
+        _, y_slice, x_slice = self.__irradiated_area_3d
+        neighbors = (neighbors[0], neighbors[1] + y_slice.start, neighbors[2] + x_slice.start)
+        neighbors = np.unravel_index(np.unique(self.__get_cell_keys(neighbors)), self.structure.shape)
+        neighbors = (np.intc(neighbors[0]), np.intc(neighbors[1]), np.intc(neighbors[2]))
+        flags = self.__flags_reduced_2d[neighbors]
+        surface = flags & SURFACE > 0
+        semi_surface = flags & SEMI_SURFACE > 0
+        # Values of the new cells are defined by the next heat transfer calculation
+        self.__surface_cells, self.__tau_cells = self.__update_index(self.__surface_cells, neighbors, surface,
+                                                                     self.__tau_cells)
+        self.__semi_surface_cells, _ = self.__update_index(self.__semi_surface_cells, neighbors, semi_surface)
+        self.__surface_all_cells, self.__D_cells = self.__update_index(self.__surface_all_cells, neighbors,
+                                                                       surface | semi_surface, self.__D_cells)
+        self.__surface_neighbors = None
+        # Filled cells are added to the solid cells, the index does not include the substrate
+        z_offset = self.substrate_height + 1 - self.__irradiated_area_3d[0].start
+        solid = (cells[0] - z_offset, cells[1] + y_slice.start, cells[2] + x_slice.start)
+        solid = tuple(np.intc(index[solid[0] >= 0]) for index in solid)
+        self._solid_index, _ = self.__update_index(self._solid_index, solid, np.ones(solid[0].shape[0], dtype=bool))
+        self.__generate_surface_index()
+        self.__flatten_beam_matrix_surface()
+
+    def __update_index(self, index, cells, present, values=None):
+        """
+        Insert cells into or remove them from a sorted index.
+
+        :param index: index, sorted in the C-order
+        :param cells: unique cells, sorted in the C-order
+        :param present: True for the cells that have to be in the index
+        :param values: array with a value for each cell in the index, inserted cells get zeros
+        :return: updated index, updated values
+        """
+        keep = np.ones(index[0].shape[0], dtype=bool)
+        position = self.__find_cells(index, cells)
+        keep[position[position >= 0]] = False
+        index = tuple(i[keep] for i in index)
+        position = np.searchsorted(self.__get_cell_keys(index), self.__get_cell_keys(cells)[present])
+        if values is not None:
+            values = np.insert(values[keep], position, 0)
+        return tuple(np.insert(i, position, c[present]) for i, c in zip(index, cells)), values
+
+    def __find_cells(self, index, cells):
+        """
+        Find positions of the cells in a sorted index.
+
+        :param index: index, sorted in the C-order
+        :param cells: cells index
+        :return: array of positions, -1 for the cells that are not in the index
+        """
+        keys = self.__get_cell_keys(index)
+        cell_keys = self.__get_cell_keys(cells)
+        position = np.searchsorted(keys, cell_keys)
+        found = position < keys.shape[0]
+        found[found] = keys[position[found]] == cell_keys[found]
+        position[~found] = -1
+        return np.intc(position)
+
+    def __get_cell_values(self, values, index, cells):
+        """
+        Get values of the cells from an array, that holds a value for each cell in a sorted index.
+
+        :param values: array with a value for each cell in the index
+        :param index: index, sorted in the C-order
+        :param cells: cells index
+        :return: array of values, zeros for the cells that are not in the index
+        """
+        position = self.__find_cells(index, tuple(i.ravel() for i in cells))
+        result = np.zeros(position.shape[0], dtype=values.dtype)
+        found = position >= 0
+        result[found] = values[position[found]]
+        return result.reshape(cells[0].shape)
+
+    def __get_cell_keys(self, index):
+        """
+        Get a flat position of the cells that follows their C-order and does not depend on the height of the view.
+
+        :param index: cells index
+        :return: array of positions
+        """
+        _, ydim, xdim = self.structure.shape
+        return (np.int64(index[0]) * ydim + index[1]) * xdim + index[2]
+
+    def __generate_surface_index(self):
+        """
+        Generate a tuple of indices for faster indexing in 'laplace_term' method
+
+        :return:
+        """
+        surface_all = self.__surface_all_cells
+        surface = self.__surface_cells
+        semi_surface = self.__semi_surface_cells
+        self.__surface_all_active = slice(None)
+        self.__surface_active = slice(None)
+        if self.active_set:
+            # Frozen cells are excluded from the solution
+            self.__surface_all_active = ~self.__has_flags(surface_all, FROZEN)
+            self.__surface_active = ~self.__has_flags(surface, FROZEN)
+            surface_all = tuple(i[self.__surface_all_active] for i in surface_all)
+            surface = tuple(i[self.__surface_active] for i in surface)
+            semi_surface = tuple(i[~self.__has_flags(semi_surface, FROZEN)] for i in semi_surface)
+        self.__surface_all_index = surface_all
+        self.__diffusion_lines = None
+        self.__multirate_classes = None
+        self.__surface_index = surface
+        self.__semi_surface_index = semi_surface
+        self.__surface_all_pos = np.intc(np.arange(self.__surface_all_cells[0].shape[0])[self.__surface_all_active])
+        self.__surface_pos = self.__find_cells(self.__surface_all_cells, surface)
+        self.__surface_rows = np.searchsorted(self.__surface_all_pos, self.__surface_pos)
+        self.__adaptive_rate = None
+        if self.temperature_tracking:
+            self.__D_flat = self.__D_cells[self.__surface_all_active]
+            self.__tau_flat = self.__tau_cells[self.__surface_active]
+
+    def __get_surface_neighbors(self):
+        """
+        Get the neighbor table of all the surface and semi-surface cells.
+
+        The table is built once the cells have changed.
+
+        :return: indptr, indices
+        """
+        if self.__surface_neighbors is None:
+            self.__surface_neighbors = diffusion.prepare_surface_neighbors(self.__surface_all_cells,
+                                                                           self.__precursor_reduced_2d.shape)
+        return self.__surface_neighbors
 
     def __flatten_beam_matrix_effective(self):
         """
@@ -950,7 +2063,7 @@ class Process:
 
         :return:
         """
-        self.__beam_matrix_effective = self.__beam_matrix_reduced_3d[self.__deposition_index]
+        self.__beam_matrix_effective = self.__beam_flux
 
     def __flatten_beam_matrix_surface(self):
         """
@@ -958,9 +2071,50 @@ class Process:
 
         :return:
         """
-        self.__beam_matrix_surface = self.__beam_matrix_reduced_2d[self.__surface_reduced_2d]
+        self.__beam_matrix_surface = self.__get_beam_flux(self.__surface_index)
+
+    def __get_beam_flux(self, cells):
+        """
+        Get SE flux in the cells of the view encapsulating the whole surface.
+
+        :param cells: cells index
+        :return: array of flux values
+        """
+        return self.__get_cell_values(self.__beam_flux, self.__deposition_index_2d, cells)
+
+    def __get_deposit(self):
+        """
+        Get deposit in the irradiated cells.
+
+        In single precision, the rounding error of the stored values is added back,
+        so that small increments are not lost.
+
+        :return: flat array
+        """
+        deposit = self.__deposit_reduced_3d[self.__deposition_index]
+        if self.__deposit_error is None:
+            return deposit
+        return deposit + self.__deposit_error
+
+    def __set_deposit(self, deposit):
+        """
+        Store deposit in the irradiated cells.
+
+        In single precision, the rounding error of the stored values is kept until the next update.
+
+        :param deposit: flat array
+        :return:
+        """
+        self.__deposit_reduced_3d[self.__deposition_index] = deposit
+        if self.__deposit_error is not None:
+            self.__deposit_error = deposit - self.__deposit_reduced_3d[self.__deposition_index]
 
     def _get_solid_index(self):
+        """
+        Generate a tuple of indices of the solid cells above the substrate.
+
+        :return:
+        """
         index = self.structure.deposit[self.__irradiated_area_2D_no_sub]
         index = (index < 0).nonzero()
         self._solid_index = (np.intc(index[0]), np.intc(index[1]), np.intc(index[2]))
@@ -972,10 +2126,11 @@ class Process:
 
         :return:
         """
-        self.max_z = self.structure.deposit.nonzero()[0].max() + 3
+        # Partially filled cells are at most one cell above the highest solid cell
+        self.max_z = self.structure.max_z() + 4
 
     def __get_surface_temp(self):
-        self.__surface_temp_reduced_2d[...] = 0
+        self.__surface_temp_reduced_2d[self.__surface_temp_reduced_2d != 0] = 0
         surface_temp_av(self.__surface_temp_reduced_2d, self.__temp_reduced_2d, *self.__surface_index)
         surface_temp_av(self.__surface_temp_reduced_2d, self.__surface_temp_reduced_2d, *self.__semi_surface_index)
         self.max_T = self.max_temperature
@@ -1007,7 +2162,7 @@ class Process:
 
         :return:
         """
-        return (self.filled_cells + self.__deposit_reduced_2d[self.__surface_reduced_2d].sum()) * self.cell_V
+        return (self.filled_cells + self.__deposit_reduced_2d[self.__surface_cells].sum()) * self.cell_V
 
     @property
     def precursor_min(self):
@@ -1016,12 +2171,12 @@ class Process:
 
         :return:
         """
-        return self.__precursor_reduced_2d[self.__surface_reduced_2d].min()
+        return self.__precursor_reduced_2d[self.__surface_cells].min()
 
     def get_tau(self):
         """
         Returns single value of the residence time if temperature tracking is off
-        or returns an array of values otherwise
+        or returns an array of values for the solved surface cells otherwise
         """
         if self.temperature_tracking:
             tau = self.__tau_flat
@@ -1029,13 +2184,26 @@ class Process:
             tau = self.precursor.tau
         return tau
 
+    def __get_tau_deposition(self):
+        """
+        Returns residence time in the irradiated cells
+
+        :return:
+        """
+        tau = self.get_tau()
+        if type(tau) is np.ndarray:
+            tau = self.__get_cell_values(self.__tau_cells, self.__surface_cells, self.__deposition_index_2d)
+        else:
+            tau = np.full(self.__deposition_index[0].shape[0], tau, dtype=np.float64)
+        return tau
+
     def get_D(self):
         """
         Returns single value of the diffusion coefficient if temperature tracking is off
-        or returns an array of values otherwise
+        or returns an array of values for the solved surface and semi-surface cells otherwise
         """
         if self.temperature_tracking:
-            D = self.__D_temp_reduced_2d
+            D = self.__D_flat
         else:
             D = self.precursor.D
         return D
@@ -1047,7 +2215,7 @@ class Process:
         """
         D = self.get_D()
         if type(D) is np.ndarray:
-            D = D.max()
+            D = self.__D_cells.max(initial=0)
         if D > 0:
             return diffusion.get_diffusion_stability_time(D, self.cell_size)
         else:
@@ -1068,15 +2236,53 @@ class Process:
         """
         Return dissociation time step
         """
-        return self.model.dt_dis()
+        return self.model.dt_diss
 
     @property
     def dt(self):
         """
         Returns a time step
         """
-        dt = min(self.dt_diff, self.dt_des, self.dt_diss) * 0.9
-        return dt
+        return self._dt
+
+    @dt.setter
+    def dt(self, val):
+        if val > self._dt_max:
+            warnings.warn(f'Not allowed to increase time step. \n'
+                          f'Time step larger than {self._dt_max} s will crash the solution.')
+        else:
+            self._dt = val
+
+    def reset_dt(self):
+        """
+        Set the time step to the maximal stable value.
+
+        The stability criteria depend on the diffusion coefficients, residence times and the SE flux, thus
+        it has to be called every time these are updated.
+        The exponential reaction integrator is unconditionally stable, then only diffusion limits the time step.
+        The implicit diffusion solution is stable as well, but its accuracy deteriorates with the time step,
+        thus it is limited to a multiple of the explicit stability limit. It is also not extended beyond
+        the time scale of the reaction term, which is split from diffusion in this case.
+        In the adaptive mode, the time step is not limited.
+
+        :return: time step, s
+        """
+        dt_diff = self.dt_diff
+        dt_reaction = min(self.dt_des, self.dt_diss)
+        if self.diffusion_solver == 'implicit':
+            dt_diff = min(dt_diff * self.implicit_dt_factor, max(dt_diff, dt_reaction))
+        if self.reaction_integrator == 'exponential':
+            self._dt_max = dt_diff * 0.9
+        else:
+            self._dt_max = min(dt_diff, dt_reaction) * 0.9
+        if self._dt != self._dt_max:
+            self.__multirate_classes = None  # local time step classes are multiples of the time step
+        self._dt = self._dt_max
+        self.__adaptive_rate = None
+        if self.adaptive_time_step:
+            # The stable time step is only the initial guess, it is then adjusted to the error estimate
+            self._dt_max = np.inf
+        return self._dt
 
     @property
     def irradiated_area_2D(self):
@@ -1090,7 +2296,7 @@ class Process:
         """
         Returns a slice of the currently irradiated area
         """
-        indices = np.nonzero(self.__beam_matrix_reduced_2d)
+        indices = self.__beam_index
         y_start, y_end, x_start, x_end = indices[1].min(), indices[1].max() + 1, indices[2].min(), indices[2].max() + 1
         irradiated_area_3D = np.s_[self.structure.substrate_height-1:self.max_z, y_start:y_end,
                              x_start:x_end]  # a slice of the currently irradiated area
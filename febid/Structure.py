@@ -1,4 +1,5 @@
 import sys
+import mmap
 
 import numpy as np
 import pyvista as pv
@@ -13,6 +14,168 @@ import pyvista as pv
 
 # 1. Cell dimension is always in absolute units (nm)
 # 2. Volume dimensions are always in relative units (array cells along each dimension)
+# 3. Boolean cell attributes are packed as bits into a single byte per cell (cell flags)
+# 4. When the volume is extended in height, arrays are allocated with a spare height of 'growth_factor' times
+#    the new height, so the allocated volume is up to 1.5x the used one by default. The spare layers are never
+#    written until the structure grows into them, thus on systems with lazy page allocation they do not take
+#    physical memory. A growth factor of 1 allocates exactly the used height.
+# 5. Arrays can be stored in bricks, fixed-size chunks of their memory, see set_brick_size(). The arrays are then
+#    allocated in private anonymous memory maps, where a brick takes memory only after a value is written into it.
+#    Bricks holding only empty cells, like the void beside and above the structure, are not allocated, reading them
+#    returns zeros. The arrays are still ordinary Numpy arrays, thus the views and MC grids built on them are unchanged.
+
+# Bits of the cell flags array
+SURFACE = 1
+SEMI_SURFACE = 2
+GHOST = 4
+SURFACE_NEIGHBOR = 8
+FROZEN = 16  # cells excluded from the solution by the Process
+
+
+class CellMask:
+    """
+    Boolean mask of the cells stored as a bit of the cell flags array.
+
+    The mask is indexed and assigned like a boolean Numpy array. Basic indexing (slices) returns a mask on a view
+    of the flags array, while advanced indexing returns a boolean array.
+    If several bits are given, a cell is marked if any of them is set.
+    """
+
+    def __init__(self, flags, bits):
+        self.flags = flags
+        self.bits = np.uint8(bits)
+
+    @property
+    def shape(self):
+        return self.flags.shape
+
+    @property
+    def ndim(self):
+        return self.flags.ndim
+
+    @property
+    def size(self):
+        return self.flags.size
+
+    def __array__(self, dtype=None, copy=None):
+        mask = np.bitwise_and(self.flags, self.bits) != 0
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __getitem__(self, key):
+        flags = self.flags[key]
+        if isinstance(flags, np.ndarray) and _is_basic_index(key):
+            return CellMask(flags, self.bits)
+        return np.bitwise_and(flags, self.bits) != 0
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value, dtype=bool)
+        if value.ndim == 0:
+            if value:
+                self.flags[key] |= self.bits
+            else:
+                flags = self.flags[key]
+                if isinstance(flags, np.ndarray) and _is_basic_index(key):
+                    # Writing only the marked cells keeps the empty bricks unallocated, see note 5
+                    np.bitwise_and(flags, ~self.bits, out=flags, where=flags & self.bits != 0)
+                else:
+                    self.flags[key] &= ~self.bits
+        else:
+            flags = self.flags[key]
+            self.flags[key] = np.where(value, flags | self.bits, flags & ~self.bits)
+
+    def __eq__(self, other):
+        return np.asarray(self) == other
+
+    def __ne__(self, other):
+        return np.asarray(self) != other
+
+    def __invert__(self):
+        return np.bitwise_and(self.flags, self.bits) == 0
+
+    def nonzero(self):
+        return np.bitwise_and(self.flags, self.bits).nonzero()
+
+    def any(self):
+        return bool(np.bitwise_and(self.flags, self.bits).any())
+
+    def sum(self):
+        return np.count_nonzero(np.bitwise_and(self.flags, self.bits))
+
+    def copy(self):
+        return np.asarray(self)
+
+    def ravel(self):
+        return np.asarray(self).ravel()
+
+
+def _is_basic_index(key):
+    """
+    Check if the index selects a view of an array.
+
+    :param key: index
+    :return: bool
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    return all(k is Ellipsis or k is None or isinstance(k, (slice, int, np.integer)) for k in key)
+
+
+def _get_owner(array):
+    """
+    Get the array holding the memory of a view.
+
+    :param array: array or view
+    :return: array
+    """
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+def _get_memory_map(array):
+    """
+    Get the memory map the array is stored in.
+
+    :param array: array
+    :return: memory map, None if the array is not stored in a memory map or does not start at its beginning
+    """
+    base = _get_owner(array).base
+    if isinstance(base, memoryview):
+        base = base.obj
+    if not isinstance(base, mmap.mmap):
+        return None
+    if np.frombuffer(base, dtype=np.uint8, count=1).ctypes.data != array.ctypes.data:
+        return None
+    return base
+
+
+def _get_occupied_bricks(array, cells):
+    """
+    Find bricks holding non-empty cells.
+
+    :param array: flat array
+    :param cells: number of cells in a brick
+    :return: bool array, one value per brick
+    """
+    count = -(-array.size // cells)
+    full = array.size // cells
+    occupied = np.empty(count, dtype=bool)
+    occupied[:full] = array[:full * cells].reshape(full, cells).any(axis=1)
+    if full < count:
+        occupied[full] = array[full * cells:].any()
+    return occupied
+
+
+def _get_runs(mask):
+    """
+    Find runs of consecutive True values.
+
+    :param mask: 1D bool array
+    :return: start and end indices of the runs
+    """
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return (edges > 0).nonzero()[0], (edges < 0).nonzero()[0]
+
 
 class BaseSolidStructure:
     """
@@ -109,13 +272,16 @@ class Structure(BaseSolidStructure):
         self.d_full_d = deposit_full_deponat
 
         self.room_temp = 294  # K, room temperature
+        self.dtype = np.float64  # floating point type of the deposit and precursor arrays
+        self.growth_factor = 1.5  # allocated height relative to the used one when the volume is extended, see note 4
+        self.__buffers = {}  # arrays allocated with a spare height, the structure arrays are views of them
+        self.brick_size = 0  # size of a storage brick in bytes, 0 stores the arrays densely, see note 5
 
         self.precursor = None
-        self.surface_bool = None
-        self.semi_surface_bool = None
-        self.surface_neighbors_bool = None
-        self.ghosts_bool = None
+        self.cell_flags = None  # surface, semi-surface, ghost and surface neighbor cells, see CellMask
         self.temperature = None
+        self.height_map = None  # index of the highest solid cell in every column
+        self.max_height = 0  # index of the highest solid cell
 
         self.substrate_height = 0
         self.nr = 0.000001
@@ -148,6 +314,7 @@ class Structure(BaseSolidStructure):
 
             try:
                 self.deposit = np.asarray(vtk_obj.cell_data['deposit'].reshape(shape))
+                self.cell_flags = np.zeros(shape, dtype=np.uint8)
                 cell_data_keys = vtk_obj.cell_data.keys()
                 if 'precursor' in cell_data_keys:
                     self.precursor = np.asarray(vtk_obj.cell_data['precursor'].reshape(shape))
@@ -192,7 +359,7 @@ class Structure(BaseSolidStructure):
                 print('retrieved temperature data...', end='')
             except:
                 print('failed to retrieve temperature data...', end='')
-                self.temperature = np.zeros_like(self.deposit)
+                self.temperature = np.zeros_like(self.deposit, dtype=np.float64)
                 self.temperature[self.deposit < 0] = self.room_temp
         else:
             # TODO: if a sample structure would be provided, it will be necessary to create a substrate under it
@@ -205,10 +372,7 @@ class Structure(BaseSolidStructure):
                 self.deposit = np.concatenate((self.deposit, substrate), axis=0)
                 shape = (self.zdim, self.ydim, self.xdim)
             self.precursor = np.zeros(shape, dtype=np.float64)
-
-            self.surface_bool = np.zeros(shape, dtype=bool)
-            self.semi_surface_bool = np.zeros(shape, dtype=bool)
-            self.ghosts_bool = np.zeros(shape, dtype=bool)
+            self.cell_flags = np.zeros(shape, dtype=np.uint8)
             self.define_surface()
             self.define_semi_surface()
             self.define_surface_neighbors()
@@ -217,6 +381,10 @@ class Structure(BaseSolidStructure):
         self.precursor[self.precursor < 0] = 0
         if self.substrate_height == 0:
             self.substrate_height = (self.deposit == -2).nonzero()[0].max()
+        self.define_height_map()
+        self.set_dtype(self.dtype)
+        if self.brick_size:
+            self.__store_all()
         self.initialized = True
 
     def create_from_parameters(self, cell_size=5, width=50, length=50, height=100, substrate_height=4, nr=0):
@@ -232,24 +400,185 @@ class Structure(BaseSolidStructure):
         :return:
         """
         self.cell_size = cell_size
-        self.deposit = np.zeros((height + substrate_height, length, width), dtype=np.float64)
-        self.precursor = np.zeros_like(self.deposit)  # precursor array
+        self.deposit = np.zeros((height + substrate_height, length, width), dtype=self.dtype)
+        self.precursor = np.zeros(self.deposit.shape, dtype=self.dtype)  # precursor array
         self.substrate_height = substrate_height
         self.nr = nr
         self.flush_structure()
-        self.surface_bool = np.zeros_like(self.deposit, dtype=bool)
-        self.semi_surface_bool = np.zeros_like(self.deposit, dtype=bool)
-        self.surface_neighbors_bool = np.zeros_like(self.deposit, dtype=bool)
-        self.ghosts_bool = np.zeros_like(self.deposit, dtype=bool)
-        self.temperature = np.zeros_like(self.deposit)
+        self.cell_flags = np.zeros(self.deposit.shape, dtype=np.uint8)
+        self.temperature = np.zeros(self.deposit.shape, dtype=np.float64)
         self.temperature[self.deposit < 0] = self.room_temp
         self.define_surface()
         self.define_surface_neighbors(1)
         self.define_ghosts()
+        self.define_height_map()
         self.t = 0
+        if self.brick_size:
+            self.__store_all()
 
         self.initialized = True
 
+    @property
+    def surface_bool(self):
+        """
+        Surface cells, a bit of the cell flags array.
+        """
+        return self.__get_mask(SURFACE)
+
+    @surface_bool.setter
+    def surface_bool(self, value):
+        self.__get_mask(SURFACE)[...] = value
+
+    @property
+    def semi_surface_bool(self):
+        """
+        Semi-surface cells, a bit of the cell flags array.
+        """
+        return self.__get_mask(SEMI_SURFACE)
+
+    @semi_surface_bool.setter
+    def semi_surface_bool(self, value):
+        self.__get_mask(SEMI_SURFACE)[...] = value
+
+    @property
+    def ghosts_bool(self):
+        """
+        Ghost cells, a bit of the cell flags array.
+        """
+        return self.__get_mask(GHOST)
+
+    @ghosts_bool.setter
+    def ghosts_bool(self, value):
+        self.__get_mask(GHOST)[...] = value
+
+    @property
+    def surface_neighbors_bool(self):
+        """
+        Solid cells neighboring the surface, a bit of the cell flags array.
+        """
+        return self.__get_mask(SURFACE_NEIGHBOR)
+
+    @surface_neighbors_bool.setter
+    def surface_neighbors_bool(self, value):
+        self.__get_mask(SURFACE_NEIGHBOR)[...] = value
+
+    def __get_mask(self, bits):
+        if self.cell_flags is None:
+            return None
+        return CellMask(self.cell_flags, bits)
+
+    def set_dtype(self, dtype):
+        """
+        Set floating point type of the deposit and precursor arrays.
+
+        Single precision halves the memory taken by the two largest arrays of the structure.
+        Temperature array is always kept in double precision.
+
+        :param dtype: numpy floating point type, float64 or float32
+        :return:
+        """
+        self.dtype = np.dtype(dtype).type
+        if self.precursor is not None:
+            self.deposit = self.__store(self.deposit, self.dtype)
+            self.precursor = self.__store(self.precursor, self.dtype)
+
+    def set_brick_size(self, brick_size):
+        """
+        Store the arrays in bricks, allocating memory only for the bricks holding non-empty cells.
+
+        A brick is a contiguous chunk of an array, thus it holds a run of cells along the x-axis, continuing
+        along the y-axis. Brick storage relies on releasing memory back to the system and is available only on Linux.
+
+        :param brick_size: size of a brick in bytes, rounded up to the memory page size, 0 stores the arrays densely
+        :return:
+        """
+        if brick_size and not sys.platform.startswith('linux'):
+            print('Brick storage is only available on Linux, arrays are stored densely.')
+            brick_size = 0
+        self.brick_size = -(-int(brick_size) // mmap.PAGESIZE) * mmap.PAGESIZE
+        if self.precursor is not None:
+            self.__store_all()
+
+    def __store_all(self):
+        """
+        Move the arrays of the structure to the current storage.
+
+        :return:
+        """
+        for name in ('deposit', 'precursor', 'cell_flags', 'temperature'):
+            setattr(self, name, self.__store(getattr(self, name)))
+        self.__buffers.clear()
+
+    def __allocate(self, shape, dtype):
+        """
+        Allocate an array of empty cells.
+
+        :param shape: shape of the array
+        :param dtype: data type
+        :return: array
+        """
+        if not self.brick_size:
+            return np.zeros(shape, dtype=dtype)
+        count = int(np.prod(shape))
+        # Pages of a private anonymous map are zero and take memory only when written into
+        buffer = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1), flags=mmap.MAP_PRIVATE)
+        return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+    def __store(self, array, dtype=None):
+        """
+        Put the array into the storage of the structure, copying only the non-empty bricks if bricks are used.
+
+        :param array: array to store
+        :param dtype: data type of the stored array, same as the array by default
+        :return: array
+        """
+        if dtype is None:
+            dtype = array.dtype
+        if not self.brick_size:
+            return array.astype(dtype, copy=False)
+        if array.dtype == dtype and _get_memory_map(array) is not None:
+            return array
+        stored = self.__allocate(array.shape, dtype)
+        self.__copy_bricks(array, stored)
+        return stored
+
+    def __copy_bricks(self, source, target):
+        """
+        Copy the bricks of the source array holding non-empty cells to the beginning of the target array.
+
+        :param source: array
+        :param target: contiguous array with at least as many cells as the source
+        :return:
+        """
+        source = source.reshape(-1)
+        target = target.reshape(-1)
+        cells = self.brick_size // target.itemsize
+        for start, end in zip(*_get_runs(_get_occupied_bricks(source, cells))):
+            start, end = start * cells, min(end * cells, source.size)
+            target[start:end] = source[start:end]
+
+    def release_bricks(self):
+        """
+        Release memory of the bricks holding only empty cells.
+
+        Needed only after the arrays have been written as a whole, cells are otherwise written only near
+        the structure.
+
+        :return:
+        """
+        if not self.brick_size:
+            return
+        for array in (self.deposit, self.precursor, self.cell_flags, self.temperature):
+            buffer = _get_memory_map(array)
+            if buffer is None:
+                continue
+            cells = self.brick_size // array.itemsize
+            for start, end in zip(*_get_runs(~_get_occupied_bricks(array.reshape(-1), cells))):
+                start, end = start * self.brick_size, min(end * cells, array.size) * array.itemsize
+                length = (end - start) // mmap.PAGESIZE * mmap.PAGESIZE
+                if length:
+                    buffer.madvise(mmap.MADV_DONTNEED, start, length)
+
     def flush_structure(self):
         """
         Resets and prepares initial state of the grid.
@@ -261,7 +590,7 @@ class Structure(BaseSolidStructure):
         :param volume_prefill: initial deposit in the volume, can be a predefined structure in an 3D array same size as deposit array (constant value is virtual and used for code development)
         :return:
         """
-        self.precursor[...] = 0
+        self.precursor[self.precursor != 0] = 0  # only written cells are cleared, see note 5
         self.precursor[0:self.substrate_height, :, :] = 0  # substrate surface
         if self.nr == 0:
             self.precursor[self.substrate_height, :,
@@ -269,7 +598,7 @@ class Structure(BaseSolidStructure):
         else:
             self.precursor[self.substrate_height, :,
             :] = self.nr  # filling substrate surface with initial precursor density
-        self.deposit[...] = 0
+        self.deposit[self.deposit != 0] = 0
         self.deposit[0:self.substrate_height, :, :] = -2
 
     def resize_structure(self, delta_z=0, delta_y=0, delta_x=0):
@@ -278,6 +607,9 @@ class Structure(BaseSolidStructure):
 
         If any of the data is referenced, only a warning is shown and data is resized anyway.
 
+        Extension along the z-axis only is done within the spare height allocated during the previous extensions.
+        When it is exhausted, the allocated height is increased by the growth factor.
+
         Changing dimensions along y and x axes should be done mindful, because if these require extension
         in the negative direction, that data has to be centered after the resizing.
 
@@ -288,6 +620,9 @@ class Structure(BaseSolidStructure):
         """
         d_i, d_j, d_k = np.asarray([delta_z, delta_y, delta_x], dtype=int) // self.cell_size
         shape_new = (self.zdim + d_i, self.ydim + d_j, self.xdim + d_k)
+        if d_i > 0 and d_j == 0 and d_k == 0:
+            self.__extend_z(shape_new[0])
+            return
         shape_old = self.shape
         slice_old = np.s_[0:shape_old[0], 0:shape_old[1], 0:shape_old[2]]
         slice_new = np.s_[0:shape_new[0], 0:shape_new[1], 0:shape_new[2]]
@@ -296,33 +631,29 @@ class Structure(BaseSolidStructure):
             if ref_check and sys.getrefcount(self.deposit) - 1 > 0:
                 raise ValueError
             temp = np.copy(self.deposit)
-            self.deposit = np.zeros(shape_new)
+            self.deposit = self.__allocate(shape_new, self.dtype)
             self.deposit[slice_old] = temp[:]
             temp = np.copy(self.precursor)
-            self.precursor = np.zeros(shape_new)
+            self.precursor = self.__allocate(shape_new, self.dtype)
             self.precursor[slice_old] = temp[:]
-            temp = np.copy(self.surface_bool)
-            self.surface_bool = np.zeros(shape_new, dtype=bool)
-            self.surface_bool[slice_old] = temp[:]
-            temp = np.copy(self.semi_surface_bool)
-            self.semi_surface_bool = np.zeros(shape_new, dtype=bool)
-            self.semi_surface_bool[slice_old] = temp[:]
-            temp = np.copy(self.surface_neighbors_bool)
-            self.surface_neighbors_bool = np.zeros(shape_new, dtype=int)
-            self.surface_neighbors_bool[slice_old] = temp[:]
-            temp = np.copy(self.ghosts_bool)
-            self.ghosts_bool = np.zeros(shape_new, dtype=bool)
-            self.ghosts_bool[slice_old] = temp[:]
+            temp = np.copy(self.cell_flags)
+            self.cell_flags = self.__allocate(shape_new, np.uint8)
+            self.cell_flags[slice_old] = temp[:]
             temp = np.copy(self.temperature)
-            self.temperature = np.zeros(shape_new)
+            self.temperature = self.__allocate(shape_new, np.float64)
             self.temperature[slice_old] = temp[:]
+            temp = np.copy(self.height_map)
+            self.height_map = np.full(shape_new[1:], -1, dtype=np.intc)
+            self.height_map[slice_old[1:]] = temp[:]
             if d_j > 0 or d_k > 0:
                 self.deposit[:self.substrate_height] = self.d_full_s
+                self.define_height_map()
                 self.define_surface()
                 self.precursor[np.logical_and(self.precursor == 0, self.surface_bool)] = self.precursor.max()
                 self.define_semi_surface()
                 self.define_surface_neighbors()
                 self.define_ghosts()
+            self.release_bricks()
         try:
             resize_all(True)
         except ValueError:
@@ -335,6 +666,23 @@ class Structure(BaseSolidStructure):
                       f'{e.args}')
                 raise e
 
+    def __extend_z(self, zdim):
+        for name in ('deposit', 'precursor', 'cell_flags', 'temperature'):
+            array = getattr(self, name)
+            buffer = self.__buffers.get(name)
+            if buffer is None or _get_owner(array) is not _get_owner(buffer) or buffer.shape[0] < zdim:
+                capacity = int(zdim * self.growth_factor)
+                buffer = self.__allocate((capacity,) + array.shape[1:], array.dtype)
+                if self.brick_size:
+                    self.__copy_bricks(array, buffer)
+                else:
+                    buffer[:array.shape[0]] = array
+                self.__buffers[name] = buffer
+            else:
+                layers = buffer[array.shape[0]:zdim]
+                layers[layers != 0] = 0  # new layers are empty, only written cells are cleared to keep them unallocated
+            setattr(self, name, buffer[:zdim])
+
     def fill_surface(self, nr: float):
         """
         Covers surface of the deposit with initial precursor density
@@ -469,17 +817,41 @@ class Structure(BaseSolidStructure):
         # Subtracting surface from that selection results in a "shell" around the surface
         # print(f'generating ghost cells index...', end='')
         roller = np.logical_or(self.surface_bool, self.semi_surface_bool)
-        self.ghosts_bool = np.copy(roller)
-        self.__stencil_3d(self.ghosts_bool, roller)
-        self.ghosts_bool[roller] = False
+        ghosts = np.copy(roller)
+        self.__stencil_3d(ghosts, roller)
+        ghosts[roller] = False
+        self.ghosts_bool = ghosts
         # print('done!', end=' ')
 
+    def define_height_map(self):
+        """
+        Find the highest solid cell in every column of the structure.
+
+        Afterwards, the height map is maintained by update_height_map as the cells are filled.
+
+        :return:
+        """
+        solid = self.deposit < 0
+        top = self.zdim - 1 - np.argmax(solid[::-1], axis=0)
+        self.height_map = np.where(solid.any(axis=0), top, -1).astype(np.intc)
+        self.max_height = self.height_map.max()
+
+    def update_height_map(self, cells):
+        """
+        Account for the newly filled cells in the height map.
+
+        :param cells: filled cells index
+        :return:
+        """
+        np.maximum.at(self.height_map, (cells[1], cells[2]), cells[0])
+        self.max_height = max(self.max_height, cells[0].max())
+
     def max_z(self):
         """
         Get the height of the structure.
-        :return: 0-axis index of the highest cell
+        :return: 0-axis index of the highest solid cell
         """
-        return self.deposit.nonzero()[0].max()
+        return self.max_height
 
     def save_to_vtk(self):
         import time
@@ -491,6 +863,7 @@ class Structure(BaseSolidStructure):
         grid.save('Deposit_' + time.strftime("%H:%M:%S", time.localtime()))
 
     def __stencil_3d(self, grid_out, grid_in):
+        grid_in = np.asarray(grid_in)  # cell masks are unpacked once
         grid_out[:, :, :-1] += grid_in[:, :, 1:]  # rolling forward (actually backwards)
         grid_out[:, :, -1] += grid_in[:, :, -1]  # taking care of edge values
         grid_out[:, :, 1:] += grid_in[:, :, :-1]  # rolling backwards
@@ -6,6 +6,7 @@ import math
 
 import numpy as np
 from febid.libraries.rolling import roll
+from febid.libraries.pde import tridiag
 
 
 # Diffusion is solved according to finite-difference explicit
@@ -15,6 +16,14 @@ from febid.libraries.rolling import roll
 # Algorithm works with 3-dimensional arrays, which represent a discretized space with a cubic cell.
 # A value held in a cell corresponds to the concentration in that point.
 
+# Surface cells can also be handled as a graph: a neighbor table lists the positions of the side neighbors
+# of every cell in the surface index. Then, the values of the surface cells are stored in flat arrays and
+# cells outside the surface do not take part in the exchange.
+
+# Alternatively, diffusion can be solved implicitly. Then the equation is split into three one-dimensional
+# equations, that are solved by backward Euler scheme one after another (locally one-dimensional method).
+# Such solution is unconditionally stable.
+
 def get_diffusion_stability_time(D, dx):
     """
     Get max stable time step for FTCS solution
@@ -60,6 +69,41 @@ def diffusion_ftcs(grid, surface, D, dt, cell_size, surface_index=None, flat=Tru
         return grid_out
 
 
+def diffusion_csr(values, D, dt, cell_size, rows, neighbors):
+    """
+    Calculate diffusion term for the selected surface cells using a neighbor table
+
+    :param values: flat precursor density array of the surface cells, normalized
+    :param D: diffusion coefficient, nm^2/s, a single value or an array with a value for each selected cell
+    :param dt: time interval over which diffusion term is calculated, s
+    :param cell_size: grid space step, nm
+    :param rows: positions of the selected cells in the values array
+    :param neighbors: neighbor table, see prepare_surface_neighbors
+    :return: 1d ndarray
+    """
+    out = laplace_term_csr(values, rows, neighbors)
+    out *= D * dt / (cell_size * cell_size)
+    return out
+
+
+def diffusion_ftcs_2d(grid, D, dt, cell_size):
+    """
+    Calculate diffusion term of a height field by the explicit Euler method.
+
+    Borders of the grid are treated as no-flow boundaries.
+
+    :param grid: 2D precursor coverage array
+    :param D: diffusion coefficient, a single value or an array of the same shape
+    :param dt: time step
+    :param cell_size: grid space step
+    :return: 2D ndarray
+    """
+    padded = np.pad(grid, 1, mode='edge')
+    grid_out = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:] - 4 * grid
+    grid_out *= D * dt / (cell_size * cell_size)
+    return grid_out
+
+
 def laplace_term_stencil(grid, surface_index):
     """
     Apply stencil operator to the selected cells in the grid.
@@ -73,6 +117,20 @@ def laplace_term_stencil(grid, surface_index):
     return grid_out
 
 
+def laplace_term_csr(values, rows, neighbors):
+    """
+    Apply Laplace operator to the selected cells using a neighbor table.
+
+    :param values: flat array with a value for each cell
+    :param rows: positions of the selected cells
+    :param neighbors: neighbor table, see prepare_surface_neighbors
+    :return: 1d ndarray
+    """
+    out = np.empty(rows.shape[0])
+    roll.laplace_csr(out, values, rows, *neighbors)
+    return out
+
+
 def prepare_surface_index(surface: np.ndarray):
     """
     Get a multiindex from the surface array
@@ -84,6 +142,146 @@ def prepare_surface_index(surface: np.ndarray):
     return np.intc(index[0]), np.intc(index[1]), np.intc(index[2])
 
 
+def diffusion_implicit(grid, D, dt, cell_size, surface_index, lines):
+    """
+    Solve diffusion for the surface cells over a time step using the implicit locally one-dimensional method.
+
+    Only the surface cells take part in diffusion, the cells outside reflect the value of the neighboring cell.
+
+    :param grid: 3D precursor density array, normalized, it is updated in place
+    :param D: diffusion coefficient, nm^2/s, a single value or an array with a value for each surface cell
+    :param dt: time step, s
+    :param cell_size: grid space step, nm
+    :param surface_index: a tuple of indices of surface cells for the 3 dimensions
+    :param lines: continuous lines of the surface cells along the three axes, see prepare_diffusion_lines
+    :return:
+    """
+    n = np.asarray(grid[surface_index], dtype=np.float64)
+    if type(D) is np.ndarray:
+        a = D * dt / (cell_size * cell_size)
+    else:
+        a = np.full(n.shape[0], D * dt / (cell_size * cell_size))
+    for index, bounds in lines:
+        tridiag.tridiag_lines(n, a, index, bounds)
+    grid[surface_index] = n
+
+
+def prepare_diffusion_lines(surface_index):
+    """
+    Collect continuous lines of cells along each axis.
+
+    Each line is defined by the positions of its cells in the surface index, that follow each other
+    along the line in the index array. Bounds array marks where each line starts in the index array.
+
+    :param surface_index: a tuple of indices of surface cells for the 3 dimensions
+    :return: a tuple of (index, bounds) pairs for the x, y and z axes
+    """
+    lines = []
+    for axis in (2, 1, 0):
+        others = [i for i in range(3) if i != axis]
+        # Sorting the cells so that neighbors along the axis follow each other
+        order = np.lexsort((surface_index[axis], surface_index[others[1]], surface_index[others[0]]))
+        coords = [index[order] for index in surface_index]
+        breaks = np.diff(coords[axis]) != 1
+        for i in others:
+            breaks |= np.diff(coords[i]) != 0
+        bounds = np.concatenate(([0], breaks.nonzero()[0] + 1, [order.shape[0]]))
+        lines.append((np.intc(order), np.intc(bounds)))
+    return tuple(lines)
+
+
+def prepare_surface_faces(surface_index, shape):
+    """
+    Find all pairs of neighboring cells.
+
+    :param surface_index: a tuple of indices of surface cells for the 3 dimensions
+    :param shape: shape of the indexed array
+    :return: positions of the first and the second cell of each pair in the surface index
+    """
+    linear_index = np.ravel_multi_index(surface_index, shape)
+    strides = (shape[1] * shape[2], shape[2], 1)
+    first = []
+    second = []
+    for axis in range(3):
+        cells = (surface_index[axis] < shape[axis] - 1).nonzero()[0]
+        neighbors = linear_index[cells] + strides[axis]
+        # The index is sorted, so that the neighbors can be looked up by binary search
+        pos = np.searchsorted(linear_index, neighbors)
+        pos[pos == linear_index.shape[0]] = 0
+        found = linear_index[pos] == neighbors
+        first.append(cells[found])
+        second.append(pos[found])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def prepare_surface_neighbors(surface_index, shape):
+    """
+    Collect side neighbors of every cell into a compressed sparse row table.
+
+    Neighbors of the i-th cell are found at indices[indptr[i]:indptr[i+1]].
+
+    :param surface_index: a tuple of indices of surface cells for the 3 dimensions
+    :param shape: shape of the indexed array
+    :return: indptr, indices
+    """
+    first, second = prepare_surface_faces(surface_index, shape)
+    n_cells = surface_index[0].shape[0]
+    rows = np.concatenate((first, second))
+    columns = np.concatenate((second, first))
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n_cells + 1, dtype=np.intc)
+    np.cumsum(np.bincount(rows, minlength=n_cells), out=indptr[1:])
+    return indptr, np.intc(columns[order])
+
+
+def steady_state_pcg(faces, coeff, rhs, x0, eps=1e-8, max_it=10000):
+    """
+    Solve a steady-state reaction-diffusion problem on a set of connected cells.
+
+    The system (L + diag(coeff)) x = rhs, where L is the Laplace matrix of the graph of the cells connected by faces,
+    is solved by the conjugate gradient method with Jacobi preconditioner.
+
+    :param faces: positions of the first and the second cell of each pair of neighbors, see prepare_surface_faces
+    :param coeff: non-negative diagonal term for each cell
+    :param rhs: right hand side vector
+    :param x0: initial guess
+    :param eps: desired relative residual
+    :param max_it: maximum number of iterations
+    :return: solution, number of iterations, relative residual
+    """
+    first, second = faces
+    n_cells = x0.shape[0]
+    diagonal = np.bincount(first, minlength=n_cells) + np.bincount(second, minlength=n_cells) + coeff
+
+    def matvec(v):
+        return diagonal * v - np.bincount(first, v[second], n_cells) - np.bincount(second, v[first], n_cells)
+
+    x = x0.copy()
+    norm_rhs = np.linalg.norm(rhs)
+    if norm_rhs == 0:
+        norm_rhs = 1
+    preconditioner = diagonal.copy()
+    preconditioner[preconditioner == 0] = 1  # isolated cells without a diagonal term keep their value
+    r = rhs - matvec(x)
+    z = r / preconditioner
+    p = z.copy()
+    rz = r.dot(z)
+    residual = np.linalg.norm(r) / norm_rhs
+    i = 0
+    while residual > eps and i < max_it:
+        q = matvec(p)
+        alpha = rz / p.dot(q)
+        x += alpha * p
+        r -= alpha * q
+        residual = np.linalg.norm(r) / norm_rhs
+        z = r / preconditioner
+        rz_next = r.dot(z)
+        p = z + p * (rz_next / rz)
+        rz = rz_next
+        i += 1
+    return x, i, residual
+
+
 def stencil_debug(grid_out, grid, z_index, y_index, x_index):
     xdim, ydim, zdim = grid.shape
     shape = (zdim, ydim, xdim)
@@ -13,4 +13,7 @@ def cache_numexpr_expressions():
     se_flux = np.arange(1, dtype=np.int64)
     ne.cache_expression("(k1+k4)/6 +(k2+k3)/3", 'rk4')
     ne.cache_expression("(F * (1 - n / n0) - n / tau - n * sigma * se_flux) * dt", 'precursor')
-    ne.cache_expression("F * dt * (1 - n / n0) - n * dt / tau - n * sigma * se_flux * dt", 'precursor_temp')
\ No newline at end of file
+    ne.cache_expression("F * dt * (1 - n / n0) - n * dt / tau - n * sigma * se_flux * dt", 'precursor_temp')
+    k, n_inf = np.arange(2, dtype=np.float64)
+    ne.cache_expression("n_inf + (n - n_inf) * exp(-k * dt)", 'precursor_exp')
+    ne.cache_expression("n_inf + (n - n_inf) * (1 - exp(-k * dt)) / (k * dt)", 'precursor_exp_mean')
@@ -64,6 +64,20 @@ def prepare_equation_values(precursor: dict, settings: dict):
         equation_values['heat_cond'] = precursor.get('thermal_conductivity')
         equation_values['cp'] = precursor.get('heat_capacity')
         equation_values['deposition_scaling'] = settings.get('deposition_scaling')
+        equation_values['skip_ahead'] = settings.get('skip_ahead', False)
+        equation_values['reaction_integrator'] = settings.get('reaction_integrator', 'rk4')
+        equation_values['diffusion_solver'] = settings.get('diffusion_solver', 'explicit')
+        equation_values['implicit_dt_factor'] = settings.get('implicit_dt_factor', 10)
+        equation_values['adaptive_time_step'] = settings.get('adaptive_time_step', False)
+        equation_values['time_step_tolerance'] = settings.get('time_step_tolerance', 1e-4)
+        equation_values['multirate'] = settings.get('multirate', False)
+        equation_values['multirate_levels'] = settings.get('multirate_levels', 5)
+        equation_values['active_set'] = settings.get('active_set', False)
+        equation_values['freeze_tolerance'] = settings.get('freeze_tolerance', 1e-4)
+        equation_values['local_equilibration'] = settings.get('local_equilibration', False)
+        equation_values['height_field'] = settings.get('height_field', False)
+        equation_values['single_precision'] = settings.get('single_precision', False)
+        equation_values['brick_size'] = settings.get('brick_size', 0)
     except KeyError as e:
         raise KeyError(f"Missing key in precursor or settings dictionary: {str(e)}")
     return equation_values
@@ -92,7 +106,9 @@ def prepare_ms_config(precursor: dict, settings: dict, structure: Structure):
                      'substrate_element': settings["substrate_element"],
                      'cell_size': structure.cell_size,
                      'e': precursor["SE_emission_activation_energy"], 'l': precursor["SE_mean_free_path"],
-                     'emission_fraction': settings['emission_fraction']}
+                     'emission_fraction': settings['emission_fraction'],
+                     'threads': settings.get('mc_threads', 1), 'seed': settings.get('mc_seed'),
+                     'record_trajectories': settings.get('mc_record_trajectories', False)}
     except KeyError as e:
         raise KeyError(f"Missing key in precursor or settings dictionary: {str(e)}")
     return mc_config
@@ -182,7 +198,7 @@ def print_all(path, process_obj, sim, run_flag):
     for x, y, step in path[start:]:
         process_obj.x0, process_obj.y0 = x, y
         beam_matrix = sim.run_simulation(y, x, process_obj.request_temp_recalc)
-        if beam_matrix.max() <= 1:
+        if beam_matrix[1].max(initial=0) <= 1:
             warnings.warn('No surface flux!', RuntimeWarning)
             process_obj.set_beam_matrix(1)
         else:
@@ -207,22 +223,29 @@ def print_step(y, x, dwell_time, pr: Process, sim, t):
 
     :return:
     """
+    pr.reset_dt()
     if dwell_time < pr.dt:
         warnings.warn('Dwell time is smaller that the time step!')
         pr.dt = dwell_time
     time_passed = 0
-    flag_dt = True
-    flag_resize = True
+    next_stats = pr.stats_freq
     # THE core loop.
     # Any changes to the events sequence are defined by or stem from this loop.
     # The FEBID process is 'constructed' here by arranging events like deposition(dissociated volume calculation),
     # precursor coverage recalculation, execution of the MC simulation, temperature profile recalculation and other.
     # If any additional calculations and to be included, they shall be run from this loop
-    while flag_dt:
-        if time_passed + pr.dt > dwell_time:  # stepping only for remaining dwell time to avoid accumulating of excess deposit
-            pr.dt = dwell_time - time_passed
-            flag_dt = False
-        pr.deposition()  # depositing on a selected area
+    # Deposition and precursor coverage are advanced by the Process until a cell is filled,
+    # thus every iteration of this loop corresponds either to a cell filling event or to a statistics gathering point.
+    while dwell_time - time_passed > dwell_time * 1e-9:  # tolerating floating point error
+        time_limit = min(dwell_time, next_stats) - time_passed
+        time_step = pr.advance(time_limit)  # depositing and recalculating precursor coverage
+        pr.t += time_step * pr.deposition_scaling
+        time_passed += time_step
+        t.update(time_step * pr.deposition_scaling * 1e6)
+        if time_step >= time_limit:  # reached either a statistics gathering point or the end of the dwell time
+            next_stats = time_passed + pr.stats_freq
+            pr.min_precursor_coverage = pr.precursor_min
+            pr.dep_vol = pr.deposited_vol
         if pr.check_cells_filled():
             flag_resize = pr.cell_filled_routine()  # updating surface on a selected area
             if flag_resize:  # update references if the allocated simulation volume was increased
@@ -230,7 +253,7 @@ def print_step(y, x, dwell_time, pr: Process, sim, t):
             start = timeit.default_timer()
             beam_matrix = sim.run_simulation(y, x, pr.request_temp_recalc)  # run MC sim. and retrieve SE surface flux
             print(f'Finished MC in {timeit.default_timer() - start} s')
-            if beam_matrix.max() <= 1:
+            if beam_matrix[1].max(initial=0) <= 1:
                 warnings.warn('No surface flux!', RuntimeWarning)
                 pr.set_beam_matrix(1)
                 continue
@@ -239,17 +262,6 @@ def print_step(y, x, dwell_time, pr: Process, sim, t):
             if pr.temperature_tracking:
                 pr.heat_transfer(sim.beam_heating)
                 pr.request_temp_recalc = False
-            if dwell_time >= pr.dt:
-                _ = pr.dt
-            else:
-                pr.dt = dwell_time
-        pr.precursor_density()  # recalculate precursor coverage
-        pr.t += pr.dt * pr.deposition_scaling
-        time_passed += pr.dt
-        t.update(pr.dt * pr.deposition_scaling * 1e6)
-        if time_passed % pr.stats_freq < pr.dt * 1.5:
-            pr.min_precursor_coverage = pr.precursor_min
-            pr.dep_vol = pr.deposited_vol
 
 
 def visualize_process(pr: Process, run_flag, show_process=False, frame_rate=1, displayed_data='precursor'):
@@ -353,8 +365,7 @@ def update_graphical(rn: vr.Render, pr: Process, time_spent, displayed_data='pre
             pr.redraw = False
         # Changing arrow position
         x, y, z = rn.arrow.GetPosition()
-        z_pos = pr.structure.deposit[:, int(pr.y0 / pr.cell_size), int(pr.x0 / pr.cell_size)].nonzero()[
-                    0].max() * pr.cell_size
+        z_pos = pr.structure.height_map[int(pr.y0 / pr.cell_size), int(pr.x0 / pr.cell_size)] * pr.cell_size
         if z_pos != z or pr.y0 != y or pr.x0 != x:
             rn.arrow.SetPosition(pr.x0, pr.y0, z_pos + 30)  # relative to the initial position
         # Calculating values to indicate
@@ -362,7 +373,7 @@ def update_graphical(rn: vr.Render, pr: Process, time_spent, displayed_data='pre
         i = len(pr.n_filled_cells) - 1
         time_real = str(datetime.timedelta(seconds=int(time_spent)))
         speed = pr.t / time_spent
-        height = (pr.max_z - pr.substrate_height) * pr.structure.cell_size
+        height = (pr.structure.max_z() + 1 - pr.substrate_height) * pr.structure.cell_size
         total_V = int(pr.dep_vol)
         delta_t = pr.t - pr.t_prev
         delta_V = total_V - pr.vol_prev
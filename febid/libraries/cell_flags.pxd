@@ -0,0 +1,7 @@
+# Bits of the cell flags array, mirror the constants in febid.Structure
+cdef enum:
+    SURFACE = 1
+    SEMI_SURFACE = 2
+    GHOST = 4
+    SURFACE_NEIGHBOR = 8
+    FROZEN = 16
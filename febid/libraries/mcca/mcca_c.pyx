@@ -0,0 +1,90 @@
+#cython: language_level=3
+#cython: cdivision=True
+"""
+Compiled rules of the mixed cell cellular automata
+"""
+
+import traceback
+cimport cython
+from cython cimport floating
+from febid.libraries.cell_flags cimport SURFACE, SEMI_SURFACE, GHOST
+
+
+# The rules are the same as in MixedCellCellularAutomata.get_converged_configuration(), but they are applied
+# directly to the provided arrays, cell by cell, without creating any views or temporary arrays.
+# Surface, semi-surface and ghost cells are marked by the bits of the cell flags array. Deposit and precursor arrays may be either double or
+# single precision, but both have to be of the same type.
+
+cpdef int converge_cells(floating[:,:,:] deposit, floating[:,:,:] precursor, unsigned char[:,:,:] flags,
+                         int[:] z, int[:] y, int[:] x, double[:] surplus, double[:] coverage) except -1:
+    """
+    Bring the configuration around the filled cells to a converged state.
+
+    Filled cells should be already marked as deposited. Excess deposit of every filled cell is distributed among
+    its new surface cells, while the new surface and semi-surface cells receive its precursor coverage.
+
+    :param deposit: deposit array
+    :param precursor: precursor coverage array
+    :param flags: cell flags array
+    :param z: first index of the filled cells
+    :param y: second index of the filled cells
+    :param x: third index of the filled cells
+    :param surplus: excess deposit of the filled cells
+    :param coverage: precursor coverage of the filled cells
+    :return:
+    """
+    try:
+        converge_cells_c(deposit, precursor, flags, z, y, x, surplus, coverage)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+    return 0
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void converge_cells_c(floating[:,:,:] deposit, floating[:,:,:] precursor, unsigned char[:,:,:] flags,
+                           int[:] z, int[:] y, int[:] x, double[:] surplus, double[:] coverage) nogil:
+    cdef:
+        int i, j, k, l, m, n, count, distance
+        int zdim = deposit.shape[0], ydim = deposit.shape[1], xdim = deposit.shape[2]
+        int new_surface[6][3]  # new surface cells of the current filled cell
+    for i in range(z.shape[0]):
+        count = 0
+        # Side neighbors that are not deposited become surface cells,
+        # edge neighbors that are not deposited and are not surface cells become semi-surface cells
+        for j in range(z[i] - 1, z[i] + 2):
+            for k in range(y[i] - 1, y[i] + 2):
+                for l in range(x[i] - 1, x[i] + 2):
+                    if j < 0 or j >= zdim or k < 0 or k >= ydim or l < 0 or l >= xdim:
+                        continue
+                    if deposit[j, k, l] != 0:
+                        continue
+                    distance = abs(j - z[i]) + abs(k - y[i]) + abs(l - x[i])
+                    if distance == 1:
+                        if not flags[j, k, l] & SURFACE:
+                            flags[j, k, l] = (flags[j, k, l] | SURFACE) & ~SEMI_SURFACE
+                            new_surface[count][0] = j
+                            new_surface[count][1] = k
+                            new_surface[count][2] = l
+                            count += 1
+                            if precursor[j, k, l] < 1e-6:
+                                precursor[j, k, l] = coverage[i]
+                    elif distance == 2 and not flags[j, k, l] & (SURFACE | SEMI_SURFACE):
+                        flags[j, k, l] |= SEMI_SURFACE
+                        if precursor[j, k, l] < 1e-6:
+                            precursor[j, k, l] = coverage[i]
+        # Redistributing excess deposit
+        for n in range(count):
+            deposit[new_surface[n][0], new_surface[n][1], new_surface[n][2]] += surplus[i] / count
+        # Ghost cells are redefined in the 2nd nearest neighbors
+        for j in range(z[i] - 2, z[i] + 3):
+            for k in range(y[i] - 2, y[i] + 3):
+                for l in range(x[i] - 2, x[i] + 3):
+                    if j < 0 or j >= zdim or k < 0 or k >= ydim or l < 0 or l >= xdim:
+                        continue
+                    if not flags[j, k, l] & (SURFACE | SEMI_SURFACE):
+                        flags[j, k, l] |= GHOST
+                    elif abs(j - z[i]) <= 1 and abs(k - y[i]) <= 1 and abs(l - x[i]) <= 1:
+                        flags[j, k, l] &= ~GHOST
@@ -0,0 +1,595 @@
+#cython: language_level=3
+#cython: cdivision=True
+"""
+Compiled time-stepping of the reaction-diffusion (continuum) model
+"""
+
+import traceback
+cimport cython
+from libc.stdlib cimport malloc, free
+from libc.math cimport exp, fabs, pow
+
+
+# The functions here advance the continuum model for many time steps in a single call.
+# Precursor coverage of the surface and semi-surface cells is passed as a flat array. Diffusion is calculated
+# on the graph of these cells, given by a neighbor table (diffusion.prepare_surface_neighbors), while
+# deposit of the irradiated cells is passed as another flat array.
+# The numerical scheme mirrors the Python path (Process.deposition and Process.precursor_density),
+# so that both produce the same result.
+# The reaction and diffusion terms are integrated either together by the Runge-Kutta method or,
+# operator-split, the reaction term by its exact exponential solution and the diffusion term by the Runge-Kutta method.
+
+# Butcher tableau of the Dormand-Prince method (see Process._DP_A and Process._DP_E), the last row are the weights
+# of the 5th order solution. The rows of the lower triangle follow each other.
+cdef double DP_A[21]
+DP_A[:] = [1. / 5,
+           3. / 40, 9. / 40,
+           44. / 45, -56. / 15, 32. / 9,
+           19372. / 6561, -25360. / 2187, 64448. / 6561, -212. / 729,
+           9017. / 3168, -355. / 33, 46732. / 5247, 49. / 176, -5103. / 18656,
+           35. / 384, 0, 500. / 1113, 125. / 192, -2187. / 6784, 11. / 84]
+cdef double DP_E[7]
+DP_E[:] = [71. / 57600, 0, -71. / 16695, 71. / 1920, -17253. / 339200, 22. / 525, -1. / 40]
+
+cpdef (double, int, int) run_until_filled(double[::1] n, double[::1] deposit,
+                                         int[:] rows, double[:] D, int[:] indptr, int[:] indices,
+                                         int[:] s_pos, double[:] s_flux, double[:] tau,
+                                         int[:] d_pos, double[:] d_flux, double[:] d_tau,
+                                         double F, double n0, double sigma, double k_dep, double cell_size,
+                                         double dt, double t_max, bint exponential=False):
+    """
+    Advance deposition and precursor coverage until a cell is filled or the time limit is reached.
+
+    A step, at which a cell got filled, is always completed.
+
+    :param n: precursor coverage of the surface and semi-surface cells
+    :param deposit: deposit of the irradiated cells
+    :param rows: positions of the solved surface and semi-surface cells in n
+    :param D: diffusion coefficient at the solved cells
+    :param indptr: start of the neighbors of every cell in indices
+    :param indices: positions of the neighbors in n
+    :param s_pos: positions of the solved surface cells in n
+    :param s_flux: SE flux at the surface cells
+    :param tau: residence time at the surface cells
+    :param d_pos: positions of the irradiated cells in n, -1 for the cells without precursor
+    :param d_flux: SE flux at the irradiated cells
+    :param d_tau: residence time at the irradiated cells
+    :param F: precursor flux
+    :param n0: maximum precursor coverage
+    :param sigma: dissociation cross-section
+    :param k_dep: deposit increment per unit of precursor coverage, SE flux and time
+    :param cell_size: grid space step
+    :param dt: time step
+    :param t_max: time limit
+    :param exponential: if True, integrate the reaction term by its exact solution, otherwise by Runge-Kutta method
+    :return: time passed, number of steps taken, 1 if a cell was filled or 0 otherwise
+    """
+    cdef:
+        double t = 0
+        int steps = 0, filled = 0
+    try:
+        filled = run_until_filled_c(n, deposit, rows, D, indptr, indices, s_pos, s_flux, tau,
+                                    d_pos, d_flux, d_tau, F, n0, sigma, k_dep, cell_size, dt, t_max,
+                                    exponential, &t, &steps)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+    if filled < 0:
+        raise MemoryError('Failed to allocate memory for the continuum model time-stepping.')
+    return t, steps, filled
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int run_until_filled_c(double[::1] n, double[::1] deposit,
+                            int[:] rows, double[:] D, int[:] indptr, int[:] indices,
+                            int[:] s_pos, double[:] s_flux, double[:] tau,
+                            int[:] d_pos, double[:] d_flux, double[:] d_tau,
+                            double F, double n0, double sigma, double k_dep, double cell_size,
+                            double dt, double t_max, bint exponential, double* t_out, int* steps_out) nogil:
+    cdef:
+        int i, filled = 0, last = 0, steps = 0
+        int n_s = s_pos.shape[0], n_a = rows.shape[0], n_d = d_pos.shape[0]
+        double t = 0, h, a, c
+        double cs2 = cell_size * cell_size
+        # Scratch arrays: initial coverage and Runge-Kutta terms
+        double * n_init = <double *> malloc(n_a * sizeof(double))
+        double * k1 = <double *> malloc(n_a * sizeof(double))
+        double * k2 = <double *> malloc(n_a * sizeof(double))
+        double * k3 = <double *> malloc(n_a * sizeof(double))
+        double * k4 = <double *> malloc(n_a * sizeof(double))
+        # Positions of the surface cells among the solved cells
+        int * s_row = <int *> malloc(n_s * sizeof(int))
+        int * row = <int *> malloc(n.shape[0] * sizeof(int))
+    if (n_a > 0 and (n_init == NULL or k1 == NULL or k2 == NULL or k3 == NULL or k4 == NULL) or
+            n_s > 0 and (s_row == NULL or row == NULL)):
+        free(n_init)
+        free(k1)
+        free(k2)
+        free(k3)
+        free(k4)
+        free(s_row)
+        free(row)
+        return -1
+    for i in range(n.shape[0]):
+        row[i] = -1
+    for i in range(n_a):
+        row[rows[i]] = i
+    for i in range(n_s):
+        s_row[i] = row[s_pos[i]]
+    free(row)
+    while not filled and not last:
+        h = dt
+        if t + dt >= t_max:  # stepping only for the remaining time to avoid accumulating of excess deposit
+            h = t_max - t
+            last = 1
+        if h <= 0:
+            break
+        # Deposition
+        for i in range(n_d):
+            if d_pos[i] < 0:
+                continue
+            c = n[d_pos[i]]
+            if exponential:  # coverage averaged over the step
+                a = F / n0 + 1 / d_tau[i] + sigma * d_flux[i]
+                c = F / a + (c - F / a) * (1 - exp(-a * h)) / (a * h)
+                deposit[i] += c * d_flux[i] * k_dep * h
+            else:  # trapezoidal rule, the second half is added after the step
+                deposit[i] += c * d_flux[i] * k_dep * h / 2
+        # Exact reaction term, the diffusion term is then calculated from the updated coverage
+        if exponential:
+            for i in range(n_s):
+                a = F / n0 + 1 / tau[i] + sigma * s_flux[i]
+                c = F / a
+                n[s_pos[i]] = c + (n[s_pos[i]] - c) * exp(-a * h)
+        # Runge-Kutta stages, the reaction term is included unless it has been already advanced exactly
+        for i in range(n_a):
+            n_init[i] = n[rows[i]]
+        laplace_csr_c(n, rows, indptr, indices, D, h / cs2, k1)
+        if not exponential:
+            reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, h, k1)
+        for i in range(n_a):
+            n[rows[i]] = n_init[i] + k1[i] / 2
+        laplace_csr_c(n, rows, indptr, indices, D, h / cs2, k2)
+        if not exponential:
+            reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, h, k2)
+        for i in range(n_a):
+            n[rows[i]] = n_init[i] + k2[i] / 2
+        laplace_csr_c(n, rows, indptr, indices, D, h / cs2, k3)
+        if not exponential:
+            reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, h, k3)
+        for i in range(n_a):
+            n[rows[i]] = n_init[i] + k3[i]
+        laplace_csr_c(n, rows, indptr, indices, D, h / cs2, k4)
+        if not exponential:
+            reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, h, k4)
+        for i in range(n_a):
+            n[rows[i]] = n_init[i] + (k1[i] + k4[i]) / 6 + (k2[i] + k3[i]) / 3
+        for i in range(n_d):
+            if d_pos[i] < 0:
+                continue
+            if not exponential:
+                deposit[i] += n[d_pos[i]] * d_flux[i] * k_dep * h / 2
+            if deposit[i] >= 1:
+                filled = 1
+        if last:
+            t = t_max
+        else:
+            t += h
+        steps += 1
+    free(n_init)
+    free(k1)
+    free(k2)
+    free(k3)
+    free(k4)
+    free(s_row)
+    t_out[0] = t
+    steps_out[0] = steps
+    return filled
+
+
+cpdef (double, int, int, double) run_adaptive_until_filled(double[::1] n, double[::1] deposit,
+                                                          int[:] rows, double[:] D, int[:] indptr, int[:] indices,
+                                                          int[:] s_pos, double[:] s_flux, double[:] tau,
+                                                          int[:] d_pos, double[:] d_flux,
+                                                          double F, double n0, double sigma, double k_dep,
+                                                          double cell_size, double dt, double dt_max, double t_max,
+                                                          double tolerance):
+    """
+    Advance deposition and precursor coverage with error-controlled time steps until a cell is filled
+    or the time limit is reached.
+
+    The steps are made by the Dormand-Prince method and retried with a smaller time step
+    until the local error meets the tolerance. A step, at which a cell got filled, is always completed.
+
+    :param n: precursor coverage of the surface and semi-surface cells
+    :param deposit: deposit of the irradiated cells
+    :param rows: positions of the solved surface and semi-surface cells in n
+    :param D: diffusion coefficient at the solved cells
+    :param indptr: start of the neighbors of every cell in indices
+    :param indices: positions of the neighbors in n
+    :param s_pos: positions of the solved surface cells in n
+    :param s_flux: SE flux at the surface cells
+    :param tau: residence time at the surface cells
+    :param d_pos: positions of the irradiated cells in n, -1 for the cells without precursor
+    :param d_flux: SE flux at the irradiated cells
+    :param F: precursor flux
+    :param n0: maximum precursor coverage
+    :param sigma: dissociation cross-section
+    :param k_dep: deposit increment per unit of precursor coverage, SE flux and time
+    :param cell_size: grid space step
+    :param dt: initial time step
+    :param dt_max: maximum time step
+    :param t_max: time limit
+    :param tolerance: relative error tolerance of a step
+    :return: time passed, number of steps taken, 1 if a cell was filled or 0 otherwise, next time step
+    """
+    cdef:
+        double t = 0
+        int steps = 0, filled = 0
+    try:
+        filled = run_adaptive_until_filled_c(n, deposit, rows, D, indptr, indices, s_pos, s_flux, tau,
+                                             d_pos, d_flux, F, n0, sigma, k_dep, cell_size, &dt, dt_max, t_max,
+                                             tolerance, &t, &steps)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+    if filled < 0:
+        raise MemoryError('Failed to allocate memory for the continuum model time-stepping.')
+    return t, steps, filled, dt
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int run_adaptive_until_filled_c(double[::1] n, double[::1] deposit,
+                                     int[:] rows, double[:] D, int[:] indptr, int[:] indices,
+                                     int[:] s_pos, double[:] s_flux, double[:] tau,
+                                     int[:] d_pos, double[:] d_flux,
+                                     double F, double n0, double sigma, double k_dep, double cell_size,
+                                     double* dt, double dt_max, double t_max, double tolerance,
+                                     double* t_out, int* steps_out) nogil:
+    cdef:
+        int i, j, c_i, stage, filled = 0, last = 0, steps = 0
+        int n_s = s_pos.shape[0], n_a = rows.shape[0], n_d = d_pos.shape[0]
+        double t = 0, h, h_next, y, error, scale, factor, c
+        double a = 1 / (cell_size * cell_size)
+        # Scratch arrays: initial coverage, coverage averaged over the step and the rates of change at the stages
+        double * n_init = <double *> malloc(n_a * sizeof(double))
+        double * n_mean = <double *> malloc(n_a * sizeof(double))
+        double * k = <double *> malloc(7 * n_a * sizeof(double))
+        # Positions of the surface and the irradiated cells among the solved cells
+        int * s_row = <int *> malloc(n_s * sizeof(int))
+        int * d_row = <int *> malloc(n_d * sizeof(int))
+        int * row = <int *> malloc(n.shape[0] * sizeof(int))
+    if (n_a > 0 and (n_init == NULL or n_mean == NULL or k == NULL) or n_s > 0 and s_row == NULL or
+            n_d > 0 and d_row == NULL or n.shape[0] > 0 and row == NULL):
+        free(n_init)
+        free(n_mean)
+        free(k)
+        free(s_row)
+        free(d_row)
+        free(row)
+        return -1
+    for i in range(n.shape[0]):
+        row[i] = -1
+    for i in range(n_a):
+        row[rows[i]] = i
+    for i in range(n_s):
+        s_row[i] = row[s_pos[i]]
+    for i in range(n_d):
+        d_row[i] = row[d_pos[i]] if d_pos[i] >= 0 else -1
+    free(row)
+    for i in range(n_a):
+        n_init[i] = n[rows[i]]
+    laplace_csr_c(n, rows, indptr, indices, D, a, k)
+    reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, 1, k)
+    while not filled and not last:
+        h = dt[0]
+        if t + h >= t_max:  # stepping only for the remaining time to avoid accumulating of excess deposit
+            h = t_max - t
+            last = 1
+        if h <= 0:
+            break
+        # Stages, the last one is evaluated at the solution
+        for i in range(n_a):
+            n_mean[i] = DP_A[15] * n_init[i]
+        j = 0
+        for stage in range(1, 7):
+            for i in range(n_a):
+                y = 0
+                for c_i in range(stage):
+                    if DP_A[j + c_i] != 0:
+                        y += DP_A[j + c_i] * k[c_i * n_a + i]
+                y = n_init[i] + h * y
+                n[rows[i]] = y
+                if stage < 6:
+                    n_mean[i] += DP_A[15 + stage] * y
+            laplace_csr_c(n, rows, indptr, indices, D, a, k + stage * n_a)
+            reaction_c(n, s_pos, s_row, s_flux, tau, F, n0, sigma, 1, k + stage * n_a)
+            j += stage
+        error = 0
+        for i in range(n_a):
+            y = 0
+            for stage in range(7):
+                y += DP_E[stage] * k[stage * n_a + i]
+            scale = tolerance * (max(fabs(n_init[i]), fabs(n[rows[i]])) + n0 * 1e-3)
+            error = max(error, fabs(h * y / scale))
+        # Standard step size controller with a safety factor and limited change
+        factor = 5 if error == 0 else min(5, max(0.2, 0.9 * pow(error, -0.2)))
+        h_next = min(h * factor, dt_max)
+        if error > 1:
+            dt[0] = h_next
+            last = 0
+            for i in range(n_a):
+                n[rows[i]] = n_init[i]
+            continue
+        if not last or h_next > dt[0]:  # a step only limited by the remaining time does not reduce the next one
+            dt[0] = h_next
+        for i in range(n_d):
+            if d_pos[i] < 0:
+                continue
+            c = n_mean[d_row[i]] if d_row[i] >= 0 else n[d_pos[i]]
+            deposit[i] += c * d_flux[i] * k_dep * h
+            if deposit[i] >= 1:
+                filled = 1
+        # The rate of change at the solution is the first stage of the next step
+        for i in range(n_a):
+            n_init[i] = n[rows[i]]
+            k[i] = k[6 * n_a + i]
+        if last:
+            t = t_max
+        else:
+            t += h
+        steps += 1
+    free(n_init)
+    free(n_mean)
+    free(k)
+    free(s_row)
+    free(d_row)
+    t_out[0] = t
+    steps_out[0] = steps
+    return filled
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void reaction_c(double[::1] n, int[:] s_pos, int * s_row, double[:] s_flux, double[:] tau,
+                     double F, double n0, double sigma, double h, double * out) nogil:
+    """
+    Add the reaction term of the surface cells to the increment of the solved cells.
+
+    :param n: coverage of every cell
+    :param s_pos: positions of the surface cells in n
+    :param s_row: positions of the surface cells among the solved cells
+    :param s_flux: SE flux at the surface cells
+    :param tau: residence time at the surface cells
+    :param F: precursor flux
+    :param n0: maximum precursor coverage
+    :param sigma: dissociation cross-section
+    :param h: time step
+    :param out: increment of the solved cells
+    :return:
+    """
+    cdef int i
+    for i in range(s_pos.shape[0]):
+        if s_row[i] >= 0:
+            out[s_row[i]] += (F - n[s_pos[i]] * (F / n0 + 1 / tau[i] + sigma * s_flux[i])) * h
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void reaction_2d_c(double[:,::1] precursor, double[:,::1] flux, double[:,::1] tau,
+                        double F, double n0, double sigma, double h, double * out) nogil:
+    """
+    Add the reaction term to the increment of a height field.
+
+    :param precursor: coverage of every column
+    :param flux: SE flux
+    :param tau: residence time
+    :param F: precursor flux
+    :param n0: maximum precursor coverage
+    :param sigma: dissociation cross-section
+    :param h: time step
+    :param out: increment of every column
+    :return:
+    """
+    cdef int y, x, xdim = precursor.shape[1]
+    for y in range(precursor.shape[0]):
+        for x in range(xdim):
+            out[y * xdim + x] += (F - precursor[y, x] * (F / n0 + 1 / tau[y, x] + sigma * flux[y, x])) * h
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void laplace_csr_c(double[::1] values, int[:] rows, int[:] indptr, int[:] indices, double[:] D, double a,
+                        double * out) nogil:
+    """
+    Apply Laplace operator on the graph of the cells and scale it by the diffusion coefficient.
+    Cells exchange only with their neighbors listed in the neighbor table.
+
+    :param values: coverage of every cell
+    :param rows: positions of the selected cells
+    :param indptr: start of the neighbors of every cell in indices
+    :param indices: positions of the neighbors
+    :param D: diffusion coefficient for each selected cell
+    :param a: time step divided by the squared grid step
+    :param out: output array
+    """
+    cdef:
+        int i, j, row
+        double cum_sum
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        cum_sum = 0
+        for j in range(indptr[row], indptr[row + 1]):
+            cum_sum += values[indices[j]]
+        out[i] = (cum_sum - values[row] * (indptr[row + 1] - indptr[row])) * D[i] * a
+
+
+cpdef (double, int, int) run_until_filled_2d(double[:,::1] precursor, double[:,::1] deposit, double[:,::1] flux,
+                                            double[:,::1] tau, double[:,::1] D,
+                                            double F, double n0, double sigma, double k_dep, double cell_size,
+                                            double dt, double t_max, bint exponential=False):
+    """
+    Advance deposition and precursor coverage of a height field until a cell is filled or the time limit is reached.
+
+    The arrays represent the surface cells on top of every column. The numerical scheme is the same as
+    in run_until_filled().
+
+    :param precursor: precursor coverage array
+    :param deposit: deposit array
+    :param flux: SE flux array
+    :param tau: residence time array
+    :param D: diffusion coefficient array
+    :param F: precursor flux
+    :param n0: maximum precursor coverage
+    :param sigma: dissociation cross-section
+    :param k_dep: deposit increment per unit of precursor coverage, SE flux and time
+    :param cell_size: grid space step
+    :param dt: time step
+    :param t_max: time limit
+    :param exponential: if True, integrate the reaction term by its exact solution, otherwise by Runge-Kutta method
+    :return: time passed, number of steps taken, 1 if a cell was filled or 0 otherwise
+    """
+    cdef:
+        double t = 0
+        int steps = 0, filled = 0
+    try:
+        filled = run_until_filled_2d_c(precursor, deposit, flux, tau, D, F, n0, sigma, k_dep, cell_size, dt, t_max,
+                                       exponential, &t, &steps)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+    if filled < 0:
+        raise MemoryError('Failed to allocate memory for the continuum model time-stepping.')
+    return t, steps, filled
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int run_until_filled_2d_c(double[:,::1] precursor, double[:,::1] deposit, double[:,::1] flux,
+                               double[:,::1] tau, double[:,::1] D,
+                               double F, double n0, double sigma, double k_dep, double cell_size,
+                               double dt, double t_max, bint exponential, double* t_out, int* steps_out) nogil:
+    cdef:
+        int i, y, x, filled = 0, last = 0, steps = 0
+        int ydim = precursor.shape[0], xdim = precursor.shape[1], n_a = ydim * xdim
+        double t = 0, h, a, n
+        double cs2 = cell_size * cell_size
+        # Scratch arrays: initial coverage and Runge-Kutta terms
+        double * n_init = <double *> malloc(n_a * sizeof(double))
+        double * k1 = <double *> malloc(n_a * sizeof(double))
+        double * k2 = <double *> malloc(n_a * sizeof(double))
+        double * k3 = <double *> malloc(n_a * sizeof(double))
+        double * k4 = <double *> malloc(n_a * sizeof(double))
+    if n_a > 0 and (n_init == NULL or k1 == NULL or k2 == NULL or k3 == NULL or k4 == NULL):
+        free(n_init)
+        free(k1)
+        free(k2)
+        free(k3)
+        free(k4)
+        return -1
+    while not filled and not last:
+        h = dt
+        if t + dt >= t_max:  # stepping only for the remaining time to avoid accumulating of excess deposit
+            h = t_max - t
+            last = 1
+        if h <= 0:
+            break
+        # Deposition
+        for y in range(ydim):
+            for x in range(xdim):
+                if flux[y, x] == 0:
+                    continue
+                n = precursor[y, x]
+                if exponential:  # coverage averaged over the step
+                    a = F / n0 + 1 / tau[y, x] + sigma * flux[y, x]
+                    n = F / a + (n - F / a) * (1 - exp(-a * h)) / (a * h)
+                    deposit[y, x] += n * flux[y, x] * k_dep * h
+                else:  # trapezoidal rule, the second half is added after the step
+                    deposit[y, x] += n * flux[y, x] * k_dep * h / 2
+        # Exact reaction term, the diffusion term is then calculated from the updated coverage
+        if exponential:
+            for y in range(ydim):
+                for x in range(xdim):
+                    a = F / n0 + 1 / tau[y, x] + sigma * flux[y, x]
+                    n = F / a
+                    precursor[y, x] = n + (precursor[y, x] - n) * exp(-a * h)
+        # Runge-Kutta stages, the reaction term is included unless it has been already advanced exactly
+        for y in range(ydim):
+            for x in range(xdim):
+                n_init[y * xdim + x] = precursor[y, x]
+        laplace_2d_c(precursor, D, h / cs2, k1)
+        if not exponential:
+            reaction_2d_c(precursor, flux, tau, F, n0, sigma, h, k1)
+        for i in range(n_a):
+            precursor[i // xdim, i % xdim] = n_init[i] + k1[i] / 2
+        laplace_2d_c(precursor, D, h / cs2, k2)
+        if not exponential:
+            reaction_2d_c(precursor, flux, tau, F, n0, sigma, h, k2)
+        for i in range(n_a):
+            precursor[i // xdim, i % xdim] = n_init[i] + k2[i] / 2
+        laplace_2d_c(precursor, D, h / cs2, k3)
+        if not exponential:
+            reaction_2d_c(precursor, flux, tau, F, n0, sigma, h, k3)
+        for i in range(n_a):
+            precursor[i // xdim, i % xdim] = n_init[i] + k3[i]
+        laplace_2d_c(precursor, D, h / cs2, k4)
+        if not exponential:
+            reaction_2d_c(precursor, flux, tau, F, n0, sigma, h, k4)
+        for i in range(n_a):
+            precursor[i // xdim, i % xdim] = n_init[i] + (k1[i] + k4[i]) / 6 + (k2[i] + k3[i]) / 3
+        for y in range(ydim):
+            for x in range(xdim):
+                if flux[y, x] == 0:
+                    continue
+                if not exponential:
+                    deposit[y, x] += precursor[y, x] * flux[y, x] * k_dep * h / 2
+                if deposit[y, x] >= 1:
+                    filled = 1
+        if last:
+            t = t_max
+        else:
+            t += h
+        steps += 1
+    free(n_init)
+    free(k1)
+    free(k2)
+    free(k3)
+    free(k4)
+    t_out[0] = t
+    steps_out[0] = steps
+    return filled
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void laplace_2d_c(double[:,::1] grid, double[:,::1] D, double a, double * out) nogil:
+    """
+    Apply Laplace operator to a 2D grid via stencil and scale it by the diffusion coefficient.
+    Neighbors, that are out of the bonds, reflect the value in the current cell.
+
+    :param grid: source array
+    :param D: diffusion coefficient for each cell
+    :param a: time step divided by the squared grid step
+    :param out: output array
+    """
+    cdef:
+        int y, x, ydim = grid.shape[0], xdim = grid.shape[1]
+        double cell, val
+    for y in range(ydim):
+        for x in range(xdim):
+            cell = grid[y, x]
+            val = -4 * cell
+            val += grid[y + 1, x] if y < ydim - 1 else cell
+            val += grid[y - 1, x] if y > 0 else cell
+            val += grid[y, x + 1] if x < xdim - 1 else cell
+            val += grid[y, x - 1] if x > 0 else cell
+            out[y * xdim + x] = val * D[y, x] * a
@@ -2,6 +2,7 @@
 Tridiagonal parallel matrix solver
 """
 
+import traceback
 import cython
 from libc.stdlib cimport malloc, free
 from cython.parallel cimport prange
@@ -170,3 +171,77 @@ cdef void tridiag_1d_c(double[:] d, double[:] x, double b, double c, double b0,
     free(gamma)
     free(rho)
 
+
+
+cpdef tridiag_lines(double[:] n, double[:] a, int[:] index, int[:] bounds):
+    """
+    Solve a diffusion equation along 1d lines of cells with backward Euler scheme.
+
+    Cells are stored in a flat array. The lines are defined by the index array, that lists the cells in the order
+    they follow in the lines, and the bounds array, that holds the position in the index array
+    where each line starts, followed by the end of the last line.
+    The ends of the lines have no flow boundary conditions.
+
+    :param n: solved quantity, updated in place
+    :param a: equation coefficient for each cell, proportional to diffusivity
+    :param index: flat cell indices, ordered line by line
+    :param bounds: line start positions in the index array
+    :return:
+    """
+    cdef int result
+    try:
+        result = tridiag_lines_c(n, a, index, bounds)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+    if result < 0:
+        raise MemoryError('Failed to allocate memory for the tridiagonal matrix solution.')
+
+
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int tridiag_lines_c(double[:] n, double[:] a, int[:] index, int[:] bounds) nogil:
+    cdef:
+        int i, j, k, start, end, length, max_length = 0
+        double m
+        double *gamma
+        double *rho
+    for j in range(bounds.shape[0] - 1):
+        length = bounds[j + 1] - bounds[j]
+        if length > max_length:
+            max_length = length
+    if max_length < 2:
+        return 0
+    gamma = <double*>malloc(max_length * sizeof(double))
+    rho = <double*>malloc(max_length * sizeof(double))
+    if gamma == NULL or rho == NULL:
+        free(gamma)
+        free(rho)
+        return -1
+    for j in range(bounds.shape[0] - 1):
+        start = bounds[j]
+        end = bounds[j + 1] - 1
+        if end <= start:
+            continue  # a single cell does not exchange along the line
+        # Row i: -a_i * n_(i-1) + (1 + 2 * a_i) * n_i - a_i * n_(i+1) = d_i
+        # End rows reflect the cell value: (1 + a_i) * n_i - a_i * n_(i+-1) = d_i
+        k = index[start]
+        m = 1 + a[k]
+        gamma[0] = -a[k] / m
+        rho[0] = n[k] / m
+        for i in range(1, end - start + 1):
+            k = index[start + i]
+            if start + i == end:
+                m = 1 + a[k] + a[k] * gamma[i - 1]
+            else:
+                m = 1 + 2 * a[k] + a[k] * gamma[i - 1]
+            gamma[i] = -a[k] / m
+            rho[i] = (n[k] + a[k] * rho[i - 1]) / m
+        i = end - start
+        n[index[end]] = rho[i]
+        for i in range(end - start - 1, -1, -1):
+            n[index[start + i]] = rho[i] - gamma[i] * n[index[start + i + 1]]
+    free(gamma)
+    free(rho)
+    return 0
@@ -0,0 +1,33 @@
+# Counter-based random number generator shared by the compiled MC modules
+from libc.stdint cimport uint64_t
+
+cdef struct RandomStream:
+    # Counter-based random number generator: n-th number of a stream is a hash of its key and n,
+    # thus every electron gets an independent reproducible stream regardless of the thread it is simulated in
+    uint64_t key
+    uint64_t counter
+
+cdef inline uint64_t mix64(uint64_t z) nogil noexcept:
+    # SplitMix64 finalizer
+    z = (z ^ (z >> 30)) * <uint64_t>0xBF58476D1CE4E5B9
+    z = (z ^ (z >> 27)) * <uint64_t>0x94D049BB133111EB
+    return z ^ (z >> 31)
+
+cdef inline RandomStream random_stream(uint64_t seed, uint64_t n) nogil noexcept:
+    """
+    Get an n-th random stream derived from the seed.
+    """
+    cdef RandomStream rng
+    rng.key = mix64(seed + mix64(n + 1))
+    rng.counter = 0
+    return rng
+
+cdef inline double rnd_next(RandomStream *rng) nogil noexcept:
+    """
+    Get the next random number of the stream in the range [0, 1).
+    """
+    rng.counter += 1
+    return (mix64(rng.key + rng.counter * <uint64_t>0x9E3779B97F4A7C15) >> 11) * (1.0 / 9007199254740992.0)
+
+cdef inline double rnd_uniform(RandomStream *rng, double min, double max) nogil noexcept:
+    return rnd_next(rng) * (max-min) + min
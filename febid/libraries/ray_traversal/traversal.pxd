@@ -0,0 +1,24 @@
+# Declarations of the SE emission kernel, shared with the streaming PE tracker
+from cython cimport floating
+from febid.libraries.random_stream cimport RandomStream
+
+cdef struct SEParams:
+    # Material constants of the SE emission, index 0 is the deposit and index 1 is the substrate
+    double e[2]
+    double lambda_escape[2]
+    double segment_min_length
+    double amplifying_factor
+    double se_E
+
+cdef struct Touched:
+    # Flat positions of the cells, that received their first contribution during a run of the SE kernel,
+    # the cells that do not fit into the capacity are only counted
+    Py_ssize_t *cells
+    Py_ssize_t capacity
+    Py_ssize_t count
+
+cdef double map_segment_c(double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, floating[:,:,:] grid, unsigned char[:,:,:] flags, int cell_dim, double *p0, double *pn, double dE, bint end, SEParams *params, RandomStream rng, bint heating, Touched *touched) nogil noexcept
+
+cdef void init_touched(Touched *touched, Py_ssize_t[::1] flux_cells, Py_ssize_t[::1] heat_cells)
+
+cdef void store_touched(Touched *touched, Py_ssize_t[::1] counts)
@@ -13,13 +13,40 @@
 #cython: embedsignature=True
 
 import cython
-from cython.parallel cimport prange
+from cython cimport floating
+from febid.libraries.cell_flags cimport SURFACE, SURFACE_NEIGHBOR
+from febid.libraries.random_stream cimport RandomStream, random_stream, rnd_next
+from cython.parallel cimport prange, parallel
 import numpy as np
 from libc.stdlib cimport malloc, realloc, free
-from libc.math cimport sqrt, log, cos, sin
+from libc.math cimport sqrt, log, cos, sin, ceil, pi, INFINITY
+from libc.stdint cimport uint64_t
 from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
 from cpython.array cimport array, clone
 
+cdef extern from *:
+    """
+    static inline void atomic_add(double *x, double v) {
+        #pragma omp atomic
+        *x += v;
+    }
+    static inline int atomic_add_first(double *x, double v) {
+        double old;
+        #pragma omp atomic capture
+        {old = *x; *x += v;}
+        return old == 0;
+    }
+    static inline Py_ssize_t atomic_increment(Py_ssize_t *x) {
+        Py_ssize_t old;
+        #pragma omp atomic capture
+        old = (*x)++;
+        return old;
+    }
+    """
+    void atomic_add(double *x, double v) nogil noexcept
+    bint atomic_add_first(double *x, double v) nogil noexcept
+    Py_ssize_t atomic_increment(Py_ssize_t *x) nogil noexcept
+
 
 
 
@@ -28,6 +55,10 @@ from cpython.array cimport array, clone
 # 2. Memoryview creation has bigger overhead than creating C-arrays or using malloc() due to a call to Python function
 # 3. Classes are created as Python objects, thus their usage is not possible without GIL
 # 4. Cython does not yet support VLAs(Variable Length Arrays), which were introduced in C99. That would be a preferred way instead of malloc()
+# 5. Structure grids are accepted both in double and single precision
+# 6. Surface cells are read from the bits of the cell flags array
+# 7. Parallel kernels accumulate into shared grids with atomic additions, thus memory does not depend on the number of threads
+# 8. The first addition to a cell records its position, so that the filled cells are found without scanning the grids
 cpdef double get_Eloss(double E, int Z, double rho, double A, double J, double step):
     return get_Eloss_c(E, Z, rho, A, J) * step
 
@@ -39,31 +70,31 @@ cpdef (float, float) get_alpha_and_lambda(double E, int Z, double rho, double A)
 cpdef (float, float, float) get_direction(double ctheta, double stheta, double psi, double cz, double cy, double cx):
     return get_direction_c(ctheta, stheta, psi, cz, cy, cx)
 
-cpdef unsigned char get_surface_solid_crossing(unsigned char[:,:,:] surface, double[:,:,:] grid, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord, double[:] coord1):
+cpdef unsigned char get_surface_solid_crossing(unsigned char[:,:,:] flags, floating[:,:,:] grid, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord, double[:] coord1):
     cdef unsigned char flag = 0
-    flag = get_surface_crossing_c(surface, cell_dim, p0, pn, direction, t, step_t, sign, coord)
+    flag = get_surface_crossing_c(flags, cell_dim, p0, pn, direction, t, step_t, sign, coord)
     if flag:
         return 2
     flag = get_solid_crossing_c(grid, cell_dim, p0, direction, t, step_t, sign, coord1)
     return flag
 
-cpdef unsigned char get_solid_crossing(double[:,:,:] grid, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
+cpdef unsigned char get_solid_crossing(floating[:,:,:] grid, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
     return get_solid_crossing_c(grid, cell_dim, p0, direction, t, step_t, sign, coord)
 
-cpdef void get_surface_crossing(unsigned char[:,:,:] surface, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
-    get_surface_crossing_c(surface, cell_dim, p0, pn, direction, t, step_t, sign, coord)
+cpdef void get_surface_crossing(unsigned char[:,:,:] flags, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
+    get_surface_crossing_c(flags, cell_dim, p0, pn, direction, t, step_t, sign, coord)
 
 cpdef void divide_segments(double[:] dEs, double[:,:] coords, int[:] num, double[:,:] delta, double[:,:] pieces, double[:] energies):
     divide_segments_c(dEs, coords, num, delta, pieces, energies)
 
 
-cpdef double generate_flux(double[:,:,:] flux, unsigned char[:,:,:] surface, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, signed char[:,:] index_corr, double[:,:] t, double[:,:] step_t, double[:] n_se, int max_count):
+cpdef double generate_flux(double[:,:,:] flux, unsigned char[:,:,:] flags, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, signed char[:,:] index_corr, double[:,:] t, double[:,:] step_t, double[:] n_se, int max_count, int num_threads=1):
     """
     Wrapper for Cython function.
     Generate surface SE flux. 
 
     :param flux: array to accumulate SEs
-    :param surface: array describing surface
+    :param flags: cell flags array describing surface
     :param cell_dim: size of a grid cell
     :param p0: starting points
     :param pn: end-points
@@ -72,56 +103,91 @@ cpdef double generate_flux(double[:,:,:] flux, unsigned char[:,:,:] surface, int
     :param step_t: increments of t value
     :param n_se: number of SEs emitted 
     :param max_count: maximum number of crossing events per emission
+    :param num_threads: number of threads
     :return: total SE yield
     """
+    return generate_flux_c(flux, flags, cell_dim, p0, pn, direction, index_corr, t, step_t, n_se, n_se.shape[0], max_count, num_threads)
 
-    return generate_flux_c(flux, surface, cell_dim, p0, pn, direction, index_corr, t, step_t, n_se, n_se.shape[0], max_count)
-
-cpdef double traverse_segment(double[:,:,:] energies, double[:,:,:] grid, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, double[:,:] t, double[:,:] step_t, double[:] dEs, int max_count):
+cpdef double traverse_segment(double[:,:,:] energies, floating[:,:,:] grid, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, double[:,:] t, double[:,:] step_t, double[:] dEs, int max_count, int num_threads=1):
     """
     Wrapper for Cython function.
     Deposits energies to the structure based on the energy losses.
     
-    :param L: distances between segment points
-    :param cell_dim: size of a cell
-    :param dEs: energies lost on segments
-    :param direction: segment pointing direction
     :param energies: structured array of deposited energies
     :param grid: surface array
+    :param cell_dim: size of a cell
     :param p0: starting points of segments
-    :param pn: c of segments
-    :param step_t: increments of t value
+    :param pn: end-points of segments
+    :param direction: segment pointing direction
     :param t: arbitrary values to detect crossing
-    :param N: number of segments
+    :param step_t: increments of t value
+    :param dEs: energies lost on segments per unit length
+    :param max_count: maximum number of crossing events per segment
+    :param num_threads: number of threads
     :return: total deposited energy
     """
+    return traverse_segment_c(energies, grid, cell_dim, p0, pn, direction, t, step_t, dEs, dEs.shape[0], max_count, num_threads)
 
-    return traverse_segment_c(energies, grid, cell_dim, p0, pn, direction, t, step_t, dEs, dEs.shape[0], max_count)
+cpdef double map_se(double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, Py_ssize_t[::1] flux_cells, Py_ssize_t[::1] heat_cells, Py_ssize_t[::1] counts, floating[:,:,:] grid, unsigned char[:,:,:] flags, int cell_dim, double[:,:,::1] segments, double[:] dEs, unsigned char[:] ends, double[:] e, double[:] lambda_escape, double segment_min_length, double amplifying_factor, double se_E, uint64_t seed=0, int num_threads=1):
+    """
+    Wrapper for Cython function.
+    Generate surface SE flux and heat sources from PE trajectory segments in a single pass.
 
-# cpdef float[:,:] traverse_cells(double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, int N):
-#     """
-#     Wrapper for Cython function.
-#     Get a collection of points where ray crossed the cells
-#
-#     :param p0: starting point
-#     :param pn: end-point
-#     :param direction: pointing direction
-#     :param t: arbitrary values to detect crossing
-#     :param step_t: increment of t value
-#     :param N: size of output array
-#     :return: array of points
-#     """
-#     cdef:
-#         # float[:,:] crossings = np.empty((N,3))
-#         float ** crossings = <float**> malloc(N * sizeof(float *))
-#     for i in range(N):
-#         crossings[i] = <float *> malloc(3 * sizeof(float))
-#
-#     traverse_cells_c(p0, pn, direction, t, step_t, crossings, N)
-#
-#     return crossings
+    Segments are subdivided into SE emission points. Points in the surface proximity emit an SE vector in a random
+    direction, that yields SEs to the first surface cell it crosses, while the energy of SEs is deposited as heat.
+    Results are added to the accumulation arrays, that are shared by all threads.
 
+    :param flux: array to accumulate SEs
+    :param pe_heat: array to accumulate energy deposited by PEs; None skips heating
+    :param se_heat: array to accumulate energy of SEs; None skips heating
+    :param flux_cells: array to record flat positions of the cells, that received SEs
+    :param heat_cells: array to record flat positions of the cells, that received heat
+    :param counts: receives the number of the cells, that received SEs and heat,
+        the arrays are filled only if the numbers do not exceed their lengths
+    :param grid: structure grid
+    :param flags: cell flags array describing surface and its proximity
+    :param cell_dim: size of a grid cell
+    :param segments: start- and end-points of PE trajectory segments, (N, 2, 3)
+    :param dEs: energy lost on segments, eV
+    :param ends: marks segments that end a trajectory, they emit one more SE vector from the end-point
+    :param e: SE emission activation energy of the deposit and the substrate, eV
+    :param lambda_escape: SE mean free escape path of the deposit and the substrate, nm
+    :param segment_min_length: segment subdivision length
+    :param amplifying_factor: artificial increase of the SE yield
+    :param se_E: average SE energy, eV
+    :param seed: random seed, every segment gets its own random stream derived from it
+    :param num_threads: number of threads
+    :return: total SE yield
+    """
+    cdef SEParams params
+    cdef Touched touched[2]
+    cdef int i
+    cdef double total_flux
+    for i in range(2):
+        params.e[i] = e[i]
+        params.lambda_escape[i] = lambda_escape[i]
+    params.segment_min_length = segment_min_length
+    params.amplifying_factor = amplifying_factor
+    params.se_E = se_E
+    init_touched(touched, flux_cells, heat_cells)
+    total_flux = map_se_c(flux, pe_heat, se_heat, grid, flags, cell_dim, segments, dEs, ends, &params, seed, num_threads, pe_heat is not None, touched)
+    store_touched(touched, counts)
+    return total_flux
+
+cdef void init_touched(Touched *touched, Py_ssize_t[::1] flux_cells, Py_ssize_t[::1] heat_cells):
+    """
+    Prepare recording of the cells, that receive SEs (first) and heat (second).
+    """
+    touched[0].cells = &flux_cells[0] if flux_cells.shape[0] > 0 else NULL
+    touched[0].capacity = flux_cells.shape[0]
+    touched[0].count = 0
+    touched[1].cells = &heat_cells[0] if heat_cells.shape[0] > 0 else NULL
+    touched[1].capacity = heat_cells.shape[0]
+    touched[1].count = 0
 
+cdef void store_touched(Touched *touched, Py_ssize_t[::1] counts):
+    counts[0] = touched[0].count
+    counts[1] = touched[1].count
 
 cpdef double det_1d(double[:] vector):
     """
@@ -201,7 +267,7 @@ cdef inline double get_Eloss_c(double E, int Z, double rho, double A, double J):
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef unsigned char get_solid_crossing_c(double[:,:,:] grid, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
+cdef unsigned char get_solid_crossing_c(floating[:,:,:] grid, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
     cdef:
         char ind
         int i
@@ -232,7 +298,7 @@ cdef unsigned char get_solid_crossing_c(double[:,:,:] grid, int cell_dim, double
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] surface, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
+cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] flags, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord):
     cdef:
         char ind
         int i
@@ -253,7 +319,7 @@ cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] surface, int cell
             index[i] = <unsigned int> (coord[i]/cell_dim)
         # index[ind] = <unsigned int> (index[ind] + sign[ind])
         # print(f'Coord: {[coord[0], coord[1], coord[2]]} , Index: {index}, Sign: {sign[ind]}, T, ind: {next_t, ind}')
-        if surface[index[0], index[1], index[2]]:
+        if flags[index[0], index[1], index[2]] & SURFACE:
             # print('')
             return False
         t[ind] = t[ind] + step_t[ind]  # going to the next wall
@@ -272,144 +338,303 @@ cdef void divide_segments_c(double[:] dEs, double[:,:] coords, int[:] num, doubl
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef double generate_flux_c(double[:,:,:] flux, unsigned char[:,:,:] surface, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, signed char[:,:] index_corr, double[:,:] t, double[:,:] step_t, double[:] n_se, int N, int max_count) nogil:
+cdef double generate_flux_c(double[:,:,:] flux, unsigned char[:,:,:] flags, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, signed char[:,:] index_corr, double[:,:] t, double[:,:] step_t, double[:] n_se, int N, int max_count, int num_threads) nogil:
     cdef:
-        char ind
-        int i, q, r, cond = 0, count = 0
-        double next_t, total_flux=0
-        # Allocating memory, the size corresponds to the length of SE trajectory
-        float ** crossings = <float**> malloc(max_count * sizeof(float *))
-        int ** coords = <int**> malloc(max_count * sizeof(int *))
-        int zdim_abs = surface.shape[0]
-        int ydim_abs = surface.shape[1]
-        int xdim_abs = surface.shape[2]
-    for i in range(max_count):
-        crossings[i] = <float *> malloc(3 * sizeof(float))
-        coords[i] = <int *> malloc(3 * sizeof(int))
-
-    for q in prange(N):
-        # Traversing cells
-        count = traverse_cells_c(p0[q], pn[q], direction[q], t[q], step_t[q], crossings, max_count)
-        if count>max_count:
-            with gil:
-                print(f'Overflow in generate_flux_c: \n'
-                      f'Length: {det_c_debug(direction[q])}, \n'
-                      f'Direction: {direction[q,0],direction[q,1],direction[q,2]} \n'
-                      f'p0: {p0[q,0],p0[q,1],p0[q,2]} \n'
-                      f'pn: {pn[q,0],pn[q,1],pn[q,2]} \n'
-                      f't: {t[q,0],t[q,1],t[q,2]} \n'
-                      f'step_t: {step_t[q,0],step_t[q,1],step_t[q,2]} \n'
-                      f'Count, max: {count}, {max_count}')
+        int q
+        double total_flux = 0
+        float ** crossings
+    with parallel(num_threads=num_threads):
+        # Every thread has its own memory for crossings, the size corresponds to the length of SE trajectory
+        crossings = alloc_crossings(max_count)
+        for q in prange(N, schedule='dynamic'):
+            total_flux += yield_se_c(flux, flags, cell_dim, p0[q], pn[q], direction[q], index_corr[q], t[q], step_t[q], n_se[q], crossings, max_count)
+        # Freeing memory before exiting function
+        free_crossings(crossings, max_count)
+    return total_flux
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef double yield_se_c(double[:,:,:] flux, unsigned char[:,:,:] flags, int cell_dim, double[:] p0, double[:] pn, double[:] direction, signed char[:] index_corr, double[:] t, double[:] step_t, double n_se, float ** crossings, int max_count) nogil noexcept:
+    """
+    Traverse cells along an SE vector and yield SEs to the first surface cell on the way.
+
+    :return: number of SEs collected
+    """
+    cdef:
+        int i, r, count
+        int coord[3]
+    count = traverse_cells_c(p0, pn, direction, t, step_t, crossings, max_count)
+    for i in range(count):
         # Getting coordinates
-        for i in range(count):
-            for r in range(3):
-                coords[i][r] = (<int> crossings[i][r]) / cell_dim + index_corr[q,i]
-        # Yielding SEs
-        for i in range(count):
-            #Bounds check
-            cond = cond + (coords[i][0]<zdim_abs)
-            cond = cond + (coords[i][1]<ydim_abs)
-            cond = cond + (coords[i][2]<xdim_abs)
-            cond = cond + (coords[i][0]>=0)
-            cond = cond + (coords[i][1]>=0)
-            cond = cond + (coords[i][2]>=0)
-            if cond == 6:
-                # Checking if the cell is a surface cell
-                if surface[coords[i][0], coords[i][1], coords[i][2]]:
-                    # Yielding SEs
-                    flux[coords[i][0], coords[i][1], coords[i][2]] += n_se[q]
-                    total_flux += n_se[q]
-                    cond = 0
-                    break # An SE may cross a wall of a surface cell and end in it.
-                    # Both positions are recorded by the algorithm,
-                    # which would artificially double the yield. This Break line prevents it.
-            cond = 0
-        count = 0
-    # Freeing memory before exiting function
-    # It has to be done in reverse to the allocation process
-    for i in range(max_count):
-        if crossings[i] != NULL: # Trying to free already empty memory may result in exception
-            free(crossings[i])
-        else: raise MemoryError("Trying to free an empty memory block").with_traceback()
-        crossings[i] = NULL
-        if coords[i] != NULL:
-            free(coords[i])
-        else: raise MemoryError("Trying to free an empty memory block").with_traceback()
-        coords[i] = NULL
-    free(coords)
-    coords = NULL
-    free(crossings)
-    crossings = NULL
+        for r in range(3):
+            coord[r] = (<int> crossings[i][r]) / cell_dim + index_corr[r]
+        if inside_c(coord, flags.shape) and flags[coord[0], coord[1], coord[2]] & SURFACE:
+            atomic_add(&flux[coord[0], coord[1], coord[2]], n_se)
+            return n_se # An SE may cross a wall of a surface cell and end in it.
+            # Both positions are recorded by the algorithm, which would artificially double the yield.
+    return 0
 
-    return total_flux
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef double traverse_segment_c(double[:,:,:] energies, floating[:,:,:] grid, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, double[:,:] t, double[:,:] step_t, double[:] dEs, int N, int max_count, int num_threads) nogil:
+    cdef:
+        int q
+        double total_energy = 0
+        float ** crossings
+    with parallel(num_threads=num_threads):
+        # Every thread has its own memory for crossings, the size corresponds to the longest segment
+        crossings = alloc_crossings(max_count)
+        for q in prange(N, schedule='dynamic'):  # go through segments, from here segment -> ray
+            total_energy += deposit_crossings_c(energies, grid, cell_dim, p0[q], pn[q], direction[q], t[q], step_t[q], dEs[q], crossings, max_count)
+        # Freeing memory before exiting function
+        free_crossings(crossings, max_count)
+    return total_energy
 
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef double traverse_segment_c(double[:,:,:] energies, double[:,:,:] grid, int cell_dim, double[:,:] p0, double[:,:] pn, double[:,:] direction, double[:,:] t, double[:,:] step_t, double[:] dEs, int N, int max_count) nogil:
+cdef double deposit_crossings_c(double[:,:,:] energies, floating[:,:,:] grid, int cell_dim, double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, double dE, float ** crossings, int max_count) nogil noexcept:
+    """
+    Deposit energy lost on a segment to the solid cells it traverses proportionally to the traversed length.
+
+    :return: deposited energy
+    """
     cdef:
-        char ind
-        int i, q, r, count = 0
-        double next_t = 0, total_energy = 0
-        # Allocating memory, the size corresponds to the longest segment
-        float ** crossings = <float**> malloc(max_count * sizeof(float *)) #crossings[1000][3]
-        int ** coords = <int**> malloc(max_count * sizeof(int *))
-        float ** deltas = <float**> malloc(max_count * sizeof(float *))
-
-    for i in range(max_count):
-        crossings[i] = <float *> malloc(3 * sizeof(float))
-        deltas[i] = <float *> malloc(3 * sizeof(float))
-        coords[i] = <int *> malloc(3 * sizeof(int))
-    for q in prange(N):  # go through segments, from here segment -> ray
-        # Traversing cells
-        count = traverse_cells_c(p0[q], pn[q], direction[q], t[q], step_t[q], crossings, max_count)
-        count -= 1 # Because we calculate distances between points
-        with gil:
-            if count>0:
-                if count>max_count:
-                    print(f'Overflow in traverse_segment_c \n'
-                          f'Length: {det_c_debug(direction[q])}, \n'
-                          f'Direction: {direction[q,0],direction[q,1],direction[q,2]} \n'
-                          f'p0: {p0[q,0],p0[q,1],p0[q,2]} \n'
-                          f'pn: {pn[q,0],pn[q,1],pn[q,2]} \n'
-                          f't: {t[q,0],t[q,1],t[q,2]} \n'
-                          f'step_t: {step_t[q,0],step_t[q,1],step_t[q,2]} \n'
-                          f'E: {dEs[q]}, Count, max: {count}, {max_count}')
+        int i, r, count
+        int coord[3]
+        float delta[3]
+        double energy, total_energy = 0
+    count = traverse_cells_c(p0, pn, direction, t, step_t, crossings, max_count) - 1 # Because we calculate distances between points
+    for i in range(count):
         # Getting distances between crossings and crossing coordinates
-        for i in range(count):
-            for r in range(3):
-                deltas[i][r] = crossings[i + 1][r] - crossings[i][r]
-                coords[i][r] = <int>(crossings[i + 1][r] / cell_dim)
-        # Depositing energy
-        for i in range(count):
-            if grid[coords[i][0], coords[i][1], coords[i][2]] <= -1:
-                next_t = det_c(deltas[i]) * dEs[q]
-                energies[coords[i][0], coords[i][1], coords[i][2]] += next_t
-                total_energy += next_t
-        count = 0
-    # Freeing memory before exiting function
-    # It has to be done in reverse to the allocation process
-    for i in range(max_count):
+        for r in range(3):
+            delta[r] = crossings[i + 1][r] - crossings[i][r]
+            coord[r] = <int>(crossings[i + 1][r] / cell_dim)
+        if inside_c(coord, grid.shape) and grid[coord[0], coord[1], coord[2]] <= -1:
+            energy = det_c(delta) * dE
+            atomic_add(&energies[coord[0], coord[1], coord[2]], energy)
+            total_energy += energy
+    return total_energy
+
+
+cdef float ** alloc_crossings(int n) nogil noexcept:
+    """
+    Allocate memory for n crossing coordinates.
+    """
+    cdef int i
+    cdef float ** crossings = <float**> malloc(n * sizeof(float *))
+    for i in range(n):
+        crossings[i] = <float *> malloc(3 * sizeof(float))
+    return crossings
+
+
+cdef void free_crossings(float ** crossings, int n) nogil noexcept:
+    """
+    Free memory allocated by alloc_crossings.
+    It has to be done in reverse to the allocation process.
+    """
+    cdef int i
+    for i in range(n):
         free(crossings[i])
-        crossings[i]=NULL
-    # for i in range(count_prev):
-        free(coords[i])
-        coords[i] = NULL
-        free(deltas[i])
-        deltas[i] = NULL
-    free(coords)
-    coords = NULL
-    free(deltas)
-    deltas = NULL
     free(crossings)
-    crossings = NULL
 
-    return total_energy
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef double map_se_c(double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, floating[:,:,:] grid, unsigned char[:,:,:] flags, int cell_dim, double[:,:,::1] segments, double[:] dEs, unsigned char[:] ends, SEParams *params, uint64_t seed, int num_threads, bint heating, Touched *touched) nogil:
+    cdef:
+        int q
+        double total_flux = 0
+    for q in prange(dEs.shape[0], schedule='dynamic', num_threads=num_threads):
+        total_flux += map_segment_c(flux, pe_heat, se_heat, grid, flags, cell_dim, &segments[q, 0, 0], &segments[q, 1, 0], dEs[q], ends[q], params, random_stream(seed, q), heating, touched)
+    return total_flux
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef double map_segment_c(double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, floating[:,:,:] grid, unsigned char[:,:,:] flags, int cell_dim, double *p0, double *pn, double dE, bint end, SEParams *params, RandomStream rng, bint heating, Touched *touched) nogil noexcept:
+    """
+    Deposit the energy of a segment and emit SEs from it.
+
+    NOTE: because SE vectors are emitted from the first point of the subdivided segment, the end-point
+     has no emitted SE. An additional SE vector is emitted from the end-point of the last segment of a trajectory
+     to mitigate the underestimation of the SE yield at the PE exit points.
+    """
+    cdef:
+        int i, j, num = 1
+        double L, de, total_flux = 0
+        double direction[3]
+        double p[3]
+    for i in range(3):
+        direction[i] = pn[i] - p0[i]
+    L = det_d(direction)
+    if heating:
+        deposit_segment_c(pe_heat, grid, cell_dim, p0, direction, dE, &touched[1])
+    # Segments longer than the subdivision length are divided into even parts that become SE emission centers
+    if L > params.segment_min_length:
+        num = <int> ceil(L / params.segment_min_length)
+    de = dE / num
+    for j in range(num):
+        for i in range(3):
+            p[i] = p0[i] + direction[i] * j / num
+        total_flux += emit_se_c(flux, se_heat, grid, flags, cell_dim, p, de, params, &rng, heating, touched)
+    if end:
+        total_flux += emit_se_c(flux, se_heat, grid, flags, cell_dim, pn, params.segment_min_length / L * dE, params, &rng, heating, touched)
+    return total_flux
 
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef int traverse_cells_c(double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, float ** crossings, int max) nogil:
+cdef double emit_se_c(double[:,:,:] flux, double[:,:,:] se_heat, floating[:,:,:] grid, unsigned char[:,:,:] flags, int cell_dim, double *p, double dE, SEParams *params, RandomStream *rng, bint heating, Touched *touched) nogil noexcept:
+    """
+    Emit SEs from a point. Only points in the surface proximity emit SEs, they are collected by the first
+    surface cell crossed by a vector of a random direction and escape path length. Energy of the emitted SEs
+    is also turned into heat at the emission point.
+
+    :return: number of SEs collected by the surface
+    """
+    cdef:
+        int i, m
+        int index[3]
+        double e, length, n_se, cz, r, phi
+        double direction[3]
+    for i in range(3):
+        index[i] = <int> (p[i] / cell_dim)
+    if not inside_c(index, flags.shape):
+        return 0
+    m = <int> -grid[index[0], index[1], index[2]] - 1 # material index, negative for void cells
+    if 0 <= m <= 1:
+        e = params.e[m]
+        length = params.lambda_escape[m] * 2 + 0.00001
+    else:
+        e = 1000000
+        length = 0.00002
+    if not flags[index[0], index[1], index[2]] & SURFACE_NEIGHBOR:
+        return 0
+    if heating and m >= 0:
+        accumulate_c(se_heat, index, params.se_E * dE / e, &touched[1])
+    n_se = dE / e * params.amplifying_factor  # number of generated SEs, usually ~0.1
+    # Spherically uniform random direction
+    cz = 2 * rnd_next(rng) - 1
+    phi = 2 * pi * rnd_next(rng)
+    r = sqrt(1 - cz * cz)
+    direction[0] = cz * length
+    direction[1] = r * cos(phi) * length
+    direction[2] = r * sin(phi) * length
+    return trace_se_c(flux, flags, cell_dim, p, direction, n_se, &touched[0])
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef double trace_se_c(double[:,:,:] flux, unsigned char[:,:,:] flags, int cell_dim, double *p0, double *direction, double n_se, Touched *touched) nogil noexcept:
+    """
+    Traverse cells along an SE vector and yield SEs to the first surface cell on the way.
+
+    :return: number of SEs collected
+    """
+    cdef:
+        char ind
+        int index[3]
+        int step[3]
+        double t[3]
+        double step_t[3]
+    init_ray_c(p0, direction, cell_dim, index, step, t, step_t)
+    while inside_c(index, flags.shape):
+        if flags[index[0], index[1], index[2]] & SURFACE:
+            accumulate_c(flux, index, n_se, touched)
+            return n_se
+        ind = argmin_c(t)
+        if t[ind] > 1: # finish if the vector ends inside a cell
+            break
+        index[ind] += step[ind]
+        t[ind] += step_t[ind]
+    return 0
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef void deposit_segment_c(double[:,:,:] energies, floating[:,:,:] grid, int cell_dim, double *p0, double *direction, double dE, Touched *touched) nogil noexcept:
+    """
+    Deposit energy lost on a segment to the solid cells it traverses proportionally to the traversed length.
+    """
+    cdef:
+        char ind
+        int index[3]
+        int step[3]
+        double next_t, prev_t = 0
+        double t[3]
+        double step_t[3]
+    init_ray_c(p0, direction, cell_dim, index, step, t, step_t)
+    while inside_c(index, grid.shape):
+        ind = argmin_c(t)
+        next_t = t[ind] if t[ind] < 1 else 1
+        if grid[index[0], index[1], index[2]] <= -1:
+            accumulate_c(energies, index, (next_t - prev_t) * dE, touched)
+        if next_t >= 1:
+            break
+        prev_t = next_t
+        index[ind] += step[ind]
+        t[ind] += step_t[ind]
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef inline void accumulate_c(double[:,:,:] grid, int *index, double value, Touched *touched) nogil noexcept:
+    """
+    Add a value to a cell of a shared grid and record the cell, if it was empty.
+    """
+    cdef Py_ssize_t i
+    if atomic_add_first(&grid[index[0], index[1], index[2]], value):
+        i = atomic_increment(&touched.count)
+        if i < touched.capacity:
+            touched.cells[i] = (index[0] * grid.shape[1] + index[1]) * grid.shape[2] + index[2]
+
+
+cdef inline void init_ray_c(double *p0, double *direction, int cell_dim, int *index, int *step, double *t, double *step_t) nogil noexcept:
+    """
+    Prepare ray traversal: get the cell of the ray origin, t-values of the first crossed walls and their increments.
+    t-value is the fraction of the ray vector traveled.
+    """
+    cdef int i
+    for i in range(3):
+        index[i] = <int> (p0[i] / cell_dim)
+        if direction[i] > 0:
+            step[i] = 1
+            t[i] = ((index[i] + 1) * cell_dim - p0[i]) / direction[i]
+            step_t[i] = cell_dim / direction[i]
+        elif direction[i] < 0:
+            step[i] = -1
+            t[i] = (index[i] * cell_dim - p0[i]) / direction[i]
+            step_t[i] = -cell_dim / direction[i]
+        else:
+            step[i] = 0
+            t[i] = INFINITY
+            step_t[i] = INFINITY
+
+
+cdef inline bint inside_c(int *index, Py_ssize_t *shape) nogil noexcept:
+    return 0 <= index[0] < shape[0] and 0 <= index[1] < shape[1] and 0 <= index[2] < shape[2]
+
+
+cdef inline char argmin_c(double *x) nogil noexcept:
+    if x[0] >= x[1]:
+        if x[1] >= x[2]:
+            return 2
+        return 1
+    if x[0] >= x[2]:
+        return 2
+    return 0
+
+
+cdef inline double det_d(double *vec) nogil noexcept:
+    return sqrt(vec[0] * vec[0] + vec[1] * vec[1] + vec[2] * vec[2])
+
+
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int traverse_cells_c(double[:] p0, double[:] pn, double[:] direction, double[:] t, double[:] step_t, float ** crossings, int max) nogil noexcept:
     """
     Get coordinates, where the ray crosses walls of grid cells including end coordinates of the ray.
     AABB Ray-Voxel traversal algorithm taken from https://www.shadertoy.com/view/XddcWn#
@@ -419,13 +644,9 @@ cdef int traverse_cells_c(double[:] p0, double[:] pn, double[:] direction, doubl
     :param direction: vector of the ray
     :param t: arbitrary value indicating a crossing event
     :param step_t: increment of t value, component-wise
-    :param crossings: output array for coordinates; the length of the array has to be bigger than the resulting count
-    :param max: length of output array
+    :param crossings: output array for coordinates
+    :param max: length of output array, the ray is cut short if it crosses more walls
     :return: count of the crossing coordinates
-    
-    If array has less capacity than the resulting count, it would result in memory 
-    leakage and corruption, which is not detected on spot, but only upon garbage collection. 
-    Usually Segmentation violation 11 error is emitted.
     """
     cdef:
         char ind
@@ -435,22 +656,12 @@ cdef int traverse_cells_c(double[:] p0, double[:] pn, double[:] direction, doubl
     for i in range(3):
         crossings[count][i] = <float> p0[i]
     count +=1
-    while True:  # iterating until all the cells are traversed by the ray
+    while count < max:  # iterating until all the cells are traversed by the ray
         next_t, ind = arr_min(t)  # minimal t-value corresponds to the box wall crossed; 2x faster than t.min() !!
         if next_t > 1:  # finish if trajectory ends inside a cell (t>1)
             for i in range(3):
                 crossings[count][i] = <float> pn[i]
             count += 1
-            ###Enable for debugging ###
-            # if count-1>= max:
-            #     with gil:
-            #         print(f'TC Length: {det_c_debug(direction)}, \n'
-            #               f'Direction: {direction[0],direction[1],direction[2]} \n'
-            #               f'p0: {p0[0],p0[1],p0[2]} \n'
-            #               f'pn: {pn[0],pn[1],pn[2]} \n'
-            #               f't: {t[0],t[1],t[2]} \n'
-            #               f'step_t: {step_t[0],step_t[1],step_t[2]} \n'
-            #               f'Crossing: {crossings[count][0],crossings[count][1],crossings[count][2]} ')
             break
         for i in range(3):
             crossings[count][i] = <float> (p0[i] + next_t * direction[i])
@@ -461,7 +672,7 @@ cdef int traverse_cells_c(double[:] p0, double[:] pn, double[:] direction, doubl
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef inline (double, char) arr_min(double[:] x) nogil:
+cdef inline (double, char) arr_min(double[:] x) nogil noexcept:
     """
     Find the minimum value in the array(vector).
     
@@ -481,7 +692,7 @@ cdef inline (double, char) arr_min(double[:] x) nogil:
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef inline double det_c(float* vec) nogil:
+cdef inline double det_c(float* vec) nogil noexcept:
     """
     Find the length of a vector.
     
@@ -493,7 +704,7 @@ cdef inline double det_c(float* vec) nogil:
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef inline double det_c_debug(double[:] vec) nogil:
+cdef inline double det_c_debug(double[:] vec) nogil noexcept:
     cdef double length = sqrt(vec[0] * vec[0] + vec[1] * vec[1] + vec[2] * vec[2])
     return length
 
@@ -86,6 +86,25 @@ cpdef int stencil(double[:,:,::1] grid_out, double[:,:,::1] grid, int[:] z, int[
         raise ex
 
 
+cpdef int laplace_csr(double[:] out, const double[:] values, int[:] rows, int[:] indptr, int[:] indices) except -1:
+    """
+    Graph Laplace operator. Sums all the neighbors of the selected cells and subtracts the cell's value
+    for every neighbor. Cells without a neighbor on a side do not exchange through it.
+
+    :param out: output array, one value for each selected cell
+    :param values: value of every cell
+    :param rows: positions of the selected cells
+    :param indptr: start of the neighbors of every cell in indices
+    :param indices: positions of the neighbors
+    :return:
+    """
+    try:
+        laplace_csr_cy(out, values, rows, indptr, indices)
+    except Exception as ex:
+        traceback.print_exc()
+        raise ex
+
+
 cpdef void rolling_3d(double[:,:,:] arr, const double[:,:,:] brr):
     """
     Analog of the np.roll for 3d arrays
@@ -157,6 +176,20 @@ cdef int stencil_cy(double[:,:,::1] grid_out, double[:,:,::1] grid, int[:] z_ind
         grid_out[z, y, x] += cum_sum + grid[z, y, x] * zero_count
 
 
+@cython.initializedcheck(False) # turn off initialization check for memoryviews
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef int laplace_csr_cy(double[:] out, const double[:] values, int[:] rows, int[:] indptr, int[:] indices) nogil except -1:
+    cdef int i, j, row
+    cdef double cum_sum
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        cum_sum = 0
+        for j in range(indptr[row], indptr[row + 1]):
+            cum_sum += values[indices[j]]
+        out[i] = cum_sum - values[row] * (indptr[row + 1] - indptr[row])
+
+
 @cython.initializedcheck(False) # turn off initialization check for memoryviews
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
@@ -1,6 +1,7 @@
 import numpy as np
 
 from slice_trics import get_3d_slice, get_boundary_indices
+from febid.libraries.mcca.mcca_c import converge_cells
 
 
 class MixedCellCellularAutomata:
@@ -87,6 +88,25 @@ class MixedCellCellularAutomata:
 
         return neighbors_2nd, surface_view, semi_surface_view, ghosts_view
 
+    def converge_cells(self, cells, deposit, precursor, flags, surplus, coverage):
+        """
+        Bring the configuration around several filled cells to a converged state.
+
+        Follows the same rules as get_converged_configuration(), but processes the cells one after another
+        directly in the provided arrays. Excess deposit of every filled cell is distributed among its new surface cells,
+        while the new surface and semi-surface cells receive its precursor coverage.
+
+        :param cells: filled cells index, the cells should be already marked as deposited
+        :param deposit: deposit array
+        :param precursor: precursor coverage array
+        :param flags: cell flags array, marking surface, semi-surface and ghost cells
+        :param surplus: excess deposit of the filled cells
+        :param coverage: precursor coverage of the filled cells
+        :return:
+        """
+        z, y, x = (np.asarray(index, dtype=np.intc) for index in cells)
+        converge_cells(deposit, precursor, flags, z, y, x, np.asarray(surplus, dtype=np.float64), np.asarray(coverage, dtype=np.float64))
+
     def __get_utils(self):
         # Kernels for choosing cells
         self.__neibs_sides = np.array([[[0, 0, 0],  # chooses side neighbors
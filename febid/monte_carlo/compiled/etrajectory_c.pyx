@@ -5,11 +5,15 @@
 import traceback
 
 import cython
-from cython.parallel cimport prange
+from cython cimport floating
+from febid.libraries.cell_flags cimport SURFACE
+from febid.libraries.random_stream cimport RandomStream, random_stream, rnd_next, rnd_uniform
+from febid.libraries.ray_traversal.traversal cimport SEParams, Touched, map_segment_c, init_touched, store_touched
+from cython.parallel cimport prange, threadid
 import numpy as np
 cimport numpy as np
-from libc.stdlib cimport rand, srand, RAND_MAX, malloc, realloc, free
-from libc.time cimport time
+from libc.stdlib cimport malloc, realloc, free
+from libc.stdint cimport uint64_t
 
 from libc.math cimport fabs, sqrt, log, cos, sin, pi, NAN, isnan
 from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
@@ -46,6 +50,8 @@ from libcpp.vector cimport vector
 # to become a self-consistent object that supports addition, modification and removal of the data.
 # The described routine is used only after the simulation has concluded
 # and arrays for every trajectory are collected in a list.
+# The main simulation routine does not use it anymore: trajectories are merged from the thread buffers into flat
+# Numpy arrays of all points, energies and masks along with the offsets of every trajectory.
 # Simulation itself uses nested vectors: vector[vector[double]] for all three types of records: point, energy and mark.
 # It is important to point out here, that point components (z,y,x) of a trajectory are recorded in the same row.
 # This layout allows the use of 'strides' in the buffer protocol (in the BuffVector class), which basically tells Numpy
@@ -62,19 +68,19 @@ cdef struct Coordinate:
     double y
     double x
 
-cdef Coordinate coordinate(double z, double y, double x):
+cdef Coordinate coordinate(double z, double y, double x) nogil noexcept:
     cdef Coordinate c
     c.z = z
     c.y = y
     c.x = x
     return c
 
-cdef void push_back_coordinate(vector[double] *v, Coordinate c):
+cdef void push_back_coordinate(vector[double] *v, Coordinate c) nogil noexcept:
     v.push_back(c.z)
     v.push_back(c.y)
     v.push_back(c.x)
 
-cdef Coordinate from_mv(double[:] x):
+cdef Coordinate from_array(double *x) nogil noexcept:
     cdef Coordinate c
     c.z = x[0]
     c.y = x[1]
@@ -140,170 +146,192 @@ cdef class BuffVector:
         pass
 
 
-cdef class Electron:
-    cdef:
-        Coordinate point
-        Coordinate point_prev
-        Coordinate direction
-        double E
-        double ctheta
-        double stheta
-        double psi
-
-    def __cinit__(self, Coordinate point, double E):
-        self.point = point
-        self.E = E
-        self.direction = coordinate(1,0,0)
-        
-    cdef void set_point(self, double z, double y, double x):
-        self.point.z = z
-        self.point.y = y
-        self.point.x = x
-        
-    cdef void set_point_prev(self, double z, double y, double x):
-        self.point_prev.z = z
-        self.point_prev.y = y
-        self.point_prev.x = x
-        
-    cdef void add_point(self, Coordinate point):
-        self.point_prev = self.point
-        self.point = point
-
-    cdef (int, int, int) get_indices(self, int cell_dim):
-        return <int>(self.point.z/cell_dim), <int>(self.point.y/cell_dim), <int>(self.point.x/cell_dim)
-
-    cdef void get_angles(self, double a):
-        """
-        Generates cos and sin of lateral angle and the azimuthal angle
-
-        :param a: alpha at the current step
-        :return:
-        """
-
-        # Important note_: the equation for ctheta is unstable and oscillates, producing values a bit below -1.
-        # In the next line, it produces a negative value under the sqrt() and eventually leading to a nan value.
-        # After that the program will ultimately crash
-        # This is fixed by truncating the digits(double->float) that carry the error (~e-12)
-        # For analysis, check the function for alpha
-        cdef double rnd1 = rnd_uniform(0, 1)
-        cdef double rnd2 = rnd_uniform(0, 1)
-        self.ctheta = <float>(1.0 - 2.0 * a * rnd1 / (1.0 + a - rnd1))  # scattering angle cosines , 0 <= angle <= 180˚, it produces an angular distribution that is obtained experimentally (more chance for low angles)
-        self.stheta = sqrt(1.0 - self.ctheta * self.ctheta)  # scattering angle sinus
-        self.psi = 2.0 * pi * rnd2  # azimuthal scattering angle
-        if isnan(self.ctheta) or isnan(self.stheta) or isnan(self.psi):
-            print(f'ctheta, stheta, psi: {self.ctheta, self.stheta, self.psi}')
-            print(f'rnd1, rnd2, a, E: {rnd1, rnd2, a, self.E}')
+cdef struct Electron:
+    Coordinate point
+    Coordinate point_prev
+    Coordinate direction
+    double E
+    double ctheta
+    double stheta
+    double psi
+
+cdef Electron electron(Coordinate point, double E) nogil noexcept:
+    cdef Electron e
+    e.point = point
+    e.E = E
+    e.direction = coordinate(1,0,0)
+    return e
+
+cdef inline void set_point(Electron *e, double z, double y, double x) nogil noexcept:
+    e.point.z = z
+    e.point.y = y
+    e.point.x = x
+
+cdef inline void set_point_prev(Electron *e, double z, double y, double x) nogil noexcept:
+    e.point_prev.z = z
+    e.point_prev.y = y
+    e.point_prev.x = x
+
+cdef inline void add_point(Electron *e, Coordinate point) nogil noexcept:
+    e.point_prev = e.point
+    e.point = point
+
+cdef inline (int, int, int) get_indices(Electron *e, int cell_dim) nogil noexcept:
+    return <int>(e.point.z/cell_dim), <int>(e.point.y/cell_dim), <int>(e.point.x/cell_dim)
+
+cdef int get_angles(Electron *e, double a, RandomStream *rng) nogil except -1:
+    """
+    Generates cos and sin of lateral angle and the azimuthal angle
+
+    :param a: alpha at the current step
+    :param rng: random stream of the electron
+    :return:
+    """
+
+    # Important note_: the equation for ctheta is unstable and oscillates, producing values a bit below -1.
+    # In the next line, it produces a negative value under the sqrt() and eventually leading to a nan value.
+    # After that the program will ultimately crash
+    # This is fixed by truncating the digits(double->float) that carry the error (~e-12)
+    # For analysis, check the function for alpha
+    cdef double rnd1 = rnd_uniform(rng, 0, 1)
+    cdef double rnd2 = rnd_uniform(rng, 0, 1)
+    e.ctheta = <float>(1.0 - 2.0 * a * rnd1 / (1.0 + a - rnd1))  # scattering angle cosines , 0 <= angle <= 180˚, it produces an angular distribution that is obtained experimentally (more chance for low angles)
+    e.stheta = sqrt(1.0 - e.ctheta * e.ctheta)  # scattering angle sinus
+    e.psi = 2.0 * pi * rnd2  # azimuthal scattering angle
+    if isnan(e.ctheta) or isnan(e.stheta) or isnan(e.psi):
+        with gil:
+            print(f'ctheta, stheta, psi: {e.ctheta, e.stheta, e.psi}')
+            print(f'rnd1, rnd2, a, E: {rnd1, rnd2, a, e.E}')
             raise ValueError('NAN encountered in angles!')
+    return 0
+
+cdef void get_direction(Electron *e) nogil noexcept:
+    cdef float cc, cb, ca, AM, AN, V1, V2, V3, V4
+    # if cz == 0.0: cz = 0.00001
+    # Coefficients for calculating direction cosines
+    if e.direction.z == 0:
+        e.direction.z = 0.00001
+    AM = - e.direction.x / e.direction.z
+    AN = 1.0 / sqrt(1.0 + AM ** 2)
+    V1 = AN * e.stheta
+    V2 = AN * AM * e.stheta
+    V3 = cos(e.psi)
+    V4 = sin(e.psi)
+    # New direction cosines
+    # On every step a sum of squares of the direction cosines is always a unity
+    ca = e.direction.x * e.ctheta + V1 * V3 + e.direction.y * V2 * V4
+    cb = e.direction.y * e.ctheta + V4 * (e.direction.z * V1 - e.direction.x * V2)
+    cc = e.direction.z * e.ctheta + V2 * V3 - e.direction.y * V1 * V4
+    if ca == 0:
+        ca = 0.0000001
+    if cb == 0:
+        cb = 0.0000001
+    if cc == 0:
+        cc = 0.0000001
+    e.direction = coordinate(cc, cb, ca)
+
+cdef int get_next_point(Electron *e, double a, double step, RandomStream *rng) nogil except -1:
+    get_angles(e, a, rng)
+    get_direction(e)
+    add_point(e, e.point)
+    e.point.z = e.point.z - e.direction.z * step
+    e.point.y = e.point.y + e.direction.y * step
+    e.point.x = e.point.x + e.direction.x * step
+    return 0
+
+cdef Coordinate check_boundaries(Electron *e, Shape dims) nogil noexcept:
+    """
+    Check if the given (z,y,x) position is inside the simulation chamber.
+    If bounds are crossed, return corrected position
 
-    cdef void get_direction(self):
-        cdef float cc, cb, ca, AM, AN, V1, V2, V3, V4
-        # if cz == 0.0: cz = 0.00001
-        # Coefficients for calculating direction cosines
-        if self.direction.z == 0:
-            self.direction.z = 0.00001
-        AM = - self.direction.x / self.direction.z
-        AN = 1.0 / sqrt(1.0 + AM ** 2)
-        V1 = AN * self.stheta
-        V2 = AN * AM * self.stheta
-        V3 = cos(self.psi)
-        V4 = sin(self.psi)
-        # New direction cosines
-        # On every step a sum of squares of the direction cosines is always a unity
-        ca = self.direction.x * self.ctheta + V1 * V3 + self.direction.y * V2 * V4
-        cb = self.direction.y * self.ctheta + V4 * (self.direction.z * V1 - self.direction.x * V2)
-        cc = self.direction.z * self.ctheta + V2 * V3 - self.direction.y * V1 * V4
-        if ca == 0:
-            ca = 0.0000001
-        if cb == 0:
-            cb = 0.0000001
-        if cc == 0:
-            cc = 0.0000001
-        self.direction = coordinate(cc, cb, ca)
-
-    cdef (double, double, double) get_next_point(self, double a, double step):
-        cdef double z, y, x
-        self.get_angles(a)
-        self.get_direction()
-        self.add_point(self.point)
-        self.point.z = self.point.z - self.direction.z * step
-        self.point.y = self.point.y + self.direction.y * step
-        self.point.x = self.point.x + self.direction.x * step
-
-    cdef Coordinate check_boundaries(self, Shape dims):
-        """
-        Check if the given (z,y,x) position is inside the simulation chamber.
-        If bounds are crossed, return corrected position
-
-        :param z:
-        :param y:
-        :param x:
-        :return:
-        """
-        cdef double z, y, x, min
-        cdef unsigned char flag = 1
-        z = self.point.z
-        y = self.point.y
-        x = self.point.x
-        # If the border value is not zero, coordinates have to be checked against it, not against zero
-        min = 1e-6
-        if min <= x < dims.x:
-            pass
-        else:
-            flag = 0
-            if x < min:
-                x = 0.000001
-            else:
-                x = dims.x - 0.0000001
-
-        if min <= y < dims.y:
-            pass
+    :param z:
+    :param y:
+    :param x:
+    :return:
+    """
+    cdef double z, y, x, min
+    cdef unsigned char flag = 1
+    z = e.point.z
+    y = e.point.y
+    x = e.point.x
+    # If the border value is not zero, coordinates have to be checked against it, not against zero
+    min = 1e-6
+    if min <= x < dims.x:
+        pass
+    else:
+        flag = 0
+        if x < min:
+            x = 0.000001
         else:
-            flag = 0
-            if y < min:
-                y = 0.000001
-            else:
-                y = dims.y - 0.000001
-
-        if min <= z < dims.z:
-            pass
+            x = dims.x - 0.0000001
+
+    if min <= y < dims.y:
+        pass
+    else:
+        flag = 0
+        if y < min:
+            y = 0.000001
         else:
-            flag = 0
-            if z < min:
-                z = 0.000001
-            else:
-                z = dims.z - 0.000001
-        if flag:
-            return coordinate(NAN, NAN, NAN)
+            y = dims.y - 0.000001
+
+    if min <= z < dims.z:
+        pass
+    else:
+        flag = 0
+        if z < min:
+            z = 0.000001
         else:
-            return coordinate(z, y, x)
+            z = dims.z - 0.000001
+    if flag:
+        return coordinate(NAN, NAN, NAN)
+    else:
+        return coordinate(z, y, x)
 
 
 cdef class SimulationVolume:
     cdef:
         double[:,:,:] grid
-        unsigned char[:,:,:] surface
+        float[:,:,:] grid_single  # used instead of 'grid' if the structure is stored in single precision
+        bint single
+        unsigned char[:,:,:] flags  # cell flags, marking the surface
+        int[:,:] height_map
         int cell_dim
         int z_top
         Shape shape
         Shape shape_abs
 
-    def __cinit__(self, double[:,:,:] grid, unsigned char[:,:,:] surface, int cell_dim):
-        self.grid = grid
-        self.surface = surface
+    def __cinit__(self, grid, unsigned char[:,:,:] flags, int[:,:] height_map, int cell_dim):
+        self.single = grid.dtype == np.float32
+        if self.single:
+            self.grid_single = grid
+        else:
+            self.grid = grid
+        self.flags = flags
+        self.height_map = height_map
         self.cell_dim = cell_dim
         self.set_shape()
         self.get_z_top()
 
+    cdef inline double cell(self, int i, int j, int k) nogil noexcept:
+        if self.single:
+            return self.grid_single[i, j, k]
+        return self.grid[i, j, k]
+
     cdef void set_shape(self):
-        self.shape.z = self.grid.shape[0]
-        self.shape.y = self.grid.shape[1]
-        self.shape.x = self.grid.shape[2]
+        self.shape.z = self.flags.shape[0]
+        self.shape.y = self.flags.shape[1]
+        self.shape.x = self.flags.shape[2]
         self.shape_abs.z = self.shape.z * self.cell_dim
         self.shape_abs.y = self.shape.y * self.cell_dim
         self.shape_abs.x = self.shape.x * self.cell_dim
 
     cdef void get_z_top(self):
-        self.z_top = (np.nonzero(self.surface)[0].max() - 1) * self.cell_dim
+        cdef int j, k, top = 0
+        for j in range(self.height_map.shape[0]):
+            for k in range(self.height_map.shape[1]):
+                if self.height_map[j, k] > top:
+                    top = self.height_map[j, k]
+        self.z_top = top * self.cell_dim
 
 
 ####################################################################################
@@ -329,160 +357,266 @@ cpdef vector[Element] get_materials(list materials_py):
 ####################################################################################
 ################## Main algorithm ##################################################
 ####################################################################################
-cpdef list start_sim(double E0, double Emin, double[:] y0, double[:] x0, int cell_dim, double[:,:,:] grid, unsigned char[:,:,:] surface, list materials_py):
+cpdef tuple start_sim(double E0, double Emin, double[:] y0, double[:] x0, int cell_dim, grid, unsigned char[:,:,:] flags, int[:,:] height_map, list materials_py, uint64_t seed=0, int num_threads=1):
+    """
+    Simulate primary electron trajectories.
+
+    Trajectories are returned in a flat layout: points, energies and masks of all trajectories are concatenated
+    and offsets array marks where each trajectory starts. Trajectory i has points and energies
+    [offsets[i]:offsets[i+1]] and, having one segment less than points, masks [offsets[i]-i:offsets[i+1]-i-1].
+
+    :return: points, energies, masks, offsets
+    """
     cdef:
         vector[Element] materials
         vector[vector[double]] t, e, m
+        Py_ssize_t[:,:] records = np.empty((x0.shape[0], 4), dtype=np.intp)
         SimulationVolume vol
-        list passes
     print('Caching materials...', end='')
     materials = get_materials(materials_py)
     print('Getting volume parameters...', end='')
-    vol = SimulationVolume.__new__(SimulationVolume, grid, surface, cell_dim)
+    vol = SimulationVolume.__new__(SimulationVolume, grid, flags, height_map, cell_dim)
     # print('Initialized Elements and Volume successfully...')
     # print(vol.cell_dim, vol.shape, vol.shape_abs, vol.z_top)
     try:
-        map_trajectory_c(&t, &e, &m, y0, x0, E0, Emin, vol, materials)
+        map_trajectory_c(&t, &e, &m, records, y0, x0, E0, Emin, vol, materials, seed, num_threads)
     except Exception as ex:
         print(f'An error occurred in \'start_sim\': {ex.args}')
         traceback.print_exc()
         raise ex
 
-    return trajectory_vector_to_np_list(t, e, m)
+    return trajectory_vectors_to_np(t, e, m, records)
 
-cdef int map_trajectory_c(vector[vector[double]] *trajectories, vector[vector[double]] *energies, vector[vector[double]] *masks, double[:] y0, double[:] x0, double E0, double Emin, SimulationVolume grid, vector[Element] materials) except -1:
+cdef int map_trajectory_c(vector[vector[double]] *trajectories, vector[vector[double]] *energies, vector[vector[double]] *masks, Py_ssize_t[:,:] records, double[:] y0, double[:] x0, double E0, double Emin, SimulationVolume grid, vector[Element] materials, uint64_t seed, int num_threads) except -1:
+    """
+    Simulate electrons in parallel. Every thread appends trajectories to its own buffers
+    and every electron records the thread, the position of its trajectory in the buffers and its length.
+    """
+    cdef int g, thread, n = x0.shape[0]
+    # Every electron has its own random stream, thus electrons are simulated independently
+    trajectories.resize(num_threads)
+    energies.resize(num_threads)
+    masks.resize(num_threads)
+    for g in prange(n, nogil=True, schedule='dynamic', num_threads=num_threads):
+        thread = threadid()
+        records[g, 0] = thread
+        records[g, 1] = energies[0][thread].size()
+        records[g, 2] = masks[0][thread].size()
+        follow_electron(&trajectories[0][thread], &energies[0][thread], &masks[0][thread], y0[g], x0[g], E0, Emin,
+                        grid, &materials[0], random_stream(seed, g))
+        records[g, 3] = energies[0][thread].size() - records[g, 1]
+    return 1
+
+cpdef double stream_sim(double E0, double Emin, double[:] y0, double[:] x0, int cell_dim, grid, unsigned char[:,:,:] flags, int[:,:] height_map, list materials_py, double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, Py_ssize_t[::1] flux_cells, Py_ssize_t[::1] heat_cells, Py_ssize_t[::1] counts, double[:] e, double[:] lambda_escape, double segment_min_length, double amplifying_factor, double se_E, uint64_t seed=0, uint64_t se_seed=0, int num_threads=1):
+    """
+    Simulate primary electron trajectories and tally surface SE flux and heat sources on the fly.
+
+    Trajectories are not stored: every thread keeps only the trajectory of the electron being simulated,
+    that is passed to the SE emission kernel right after the electron stops. Given the same seed,
+    the trajectories are the same as the ones produced by 'start_sim'.
+    Results are added to the accumulation arrays, that are shared by all threads.
+
+    :param flux: array to accumulate SEs
+    :param pe_heat: array to accumulate energy deposited by PEs; None skips heating
+    :param se_heat: array to accumulate energy of SEs; None skips heating
+    :param flux_cells: array to record flat positions of the cells, that received SEs
+    :param heat_cells: array to record flat positions of the cells, that received heat
+    :param counts: receives the number of the cells, that received SEs and heat,
+        the arrays are filled only if the numbers do not exceed their lengths
+    :param e: SE emission activation energy of the deposit and the substrate, eV
+    :param lambda_escape: SE mean free escape path of the deposit and the substrate, nm
+    :param segment_min_length: segment subdivision length
+    :param amplifying_factor: artificial increase of the SE yield
+    :param se_E: average SE energy, eV
+    :param seed: random seed of the PE trajectories
+    :param se_seed: random seed of the SE emission
+    :return: total SE yield
+    """
     cdef:
-        vector[double] energy
-        vector[double] trajectory
-        vector[double] mask
-        double delta[3], c[3], c1[3]
-        double[:] vec = delta
-        double[:] crossing = c
-        double[:] crossing1 = c1
+        vector[Element] materials
+        SimulationVolume vol
+        SEParams params
+        Touched touched[2]
+        int i
+        double total_flux
+    for i in range(2):
+        params.e[i] = e[i]
+        params.lambda_escape[i] = lambda_escape[i]
+    params.segment_min_length = segment_min_length
+    params.amplifying_factor = amplifying_factor
+    params.se_E = se_E
+    materials = get_materials(materials_py)
+    vol = SimulationVolume.__new__(SimulationVolume, grid, flags, height_map, cell_dim)
+    init_touched(touched, flux_cells, heat_cells)
+    total_flux = stream_trajectory_c(y0, x0, E0, Emin, vol, materials, flux, pe_heat, se_heat, &params, pe_heat is not None, seed, se_seed, num_threads, touched)
+    store_touched(touched, counts)
+    return total_flux
+
+cdef double stream_trajectory_c(double[:] y0, double[:] x0, double E0, double Emin, SimulationVolume grid, vector[Element] materials, double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, SEParams *params, bint heating, uint64_t seed, uint64_t se_seed, int num_threads, Touched *touched) except? -1:
+    """
+    Simulate electrons in parallel. Every thread reuses its own buffers for the trajectory of the current electron.
+    """
+    cdef:
+        int g, thread, n = x0.shape[0]
+        double total_flux = 0
+        vector[vector[double]] trajectories, energies, masks
+    trajectories.resize(num_threads)
+    energies.resize(num_threads)
+    masks.resize(num_threads)
+    for g in prange(n, nogil=True, schedule='dynamic', num_threads=num_threads):
+        thread = threadid()
+        trajectories[thread].clear()
+        energies[thread].clear()
+        masks[thread].clear()
+        follow_electron(&trajectories[thread], &energies[thread], &masks[thread], y0[g], x0[g], E0, Emin,
+                        grid, &materials[0], random_stream(seed, g))
+        total_flux += tally_trajectory(&trajectories[thread], &energies[thread], &masks[thread], flux, pe_heat, se_heat,
+                                       grid, params, random_stream(se_seed, g).key, heating, touched)
+    return total_flux
+
+cdef double tally_trajectory(vector[double] *trajectory, vector[double] *energy, vector[double] *mask, double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, SimulationVolume grid, SEParams *params, uint64_t key, bint heating, Touched *touched) nogil noexcept:
+    """
+    Emit SEs and deposit heat from the segments of a trajectory.
+
+    Segments are selected the same way as in 'process_trajectories': the first segment is always discarded
+    along with the segments traversing void. The last selected segment ends the trajectory.
+    """
+    cdef:
+        Py_ssize_t i, last = -1, n = energy.size()
+        double total_flux = 0
+        double *points = trajectory.data()
+    for i in range(1, n - 1):
+        if mask[0][i] == 0:
+            continue
+        if points[3*i] == points[3*i+3] and points[3*i+1] == points[3*i+4] and points[3*i+2] == points[3*i+5]:
+            continue # duplicate points, the segment has no length and no energy loss
+        if last >= 0:
+            total_flux += tally_segment(points, energy, last, flux, pe_heat, se_heat, grid, params, key, False, heating, touched)
+        last = i
+    if last >= 0:
+        total_flux += tally_segment(points, energy, last, flux, pe_heat, se_heat, grid, params, key, True, heating, touched)
+    return total_flux
+
+cdef inline double tally_segment(double *points, vector[double] *energy, Py_ssize_t i, double[:,:,:] flux, double[:,:,:] pe_heat, double[:,:,:] se_heat, SimulationVolume grid, SEParams *params, uint64_t key, bint end, bint heating, Touched *touched) nogil noexcept:
+    cdef double dE = (energy[0][i] - energy[0][i+1]) * 1000
+    if grid.single:
+        return map_segment_c(flux, pe_heat, se_heat, grid.grid_single, grid.flags, grid.cell_dim,
+                             &points[3*i], &points[3*i+3], dE, end, params, random_stream(key, i), heating, touched)
+    return map_segment_c(flux, pe_heat, se_heat, grid.grid, grid.flags, grid.cell_dim,
+                         &points[3*i], &points[3*i+3], dE, end, params, random_stream(key, i), heating, touched)
+
+cdef int follow_electron(vector[double] *trajectory, vector[double] *energy, vector[double] *mask, double y0, double x0, double E0, double Emin, SimulationVolume grid, Element *materials, RandomStream rng) nogil except -1:
+    cdef:
+        double delta[3]
+        double crossing[3]
+        double crossing1[3]
         Coordinate coord, check
         Electron e
-        Element material
+        Element material = materials[0]
         unsigned char flag = 0
-        int g, i, j, k
+        int i, j, k
         double a, step
 
-    srand(time(NULL))
-    for g in range(x0.shape[0]):
-        flag = 0
-        coord = coordinate(grid.shape_abs.z - 0.001, y0[g], x0[g]) # the very first point is at the top of the volume
-        e = Electron.__new__(Electron, coord, E0)
-        push_back_coordinate(&trajectory, e.point)
-        # print(f'\nEntry, Recorded point, energy: {e.point, e.E}')
+    coord = coordinate(grid.shape_abs.z - 0.001, y0, x0) # the very first point is at the top of the volume
+    e = electron(coord, E0)
+    push_back_coordinate(trajectory, e.point)
+    # print(f'\nEntry, Recorded point, energy: {e.point, e.E}')
+    energy.push_back(e.E)
+    add_point(&e, coord)
+
+    # coord = coordinate(grid.z_top - 0.001, y0, x0) # the incident point is sunk into the solid a tiny bit
+    # add_point(&e, coord)
+    # push_back_coordinate(trajectory, e.point)
+    # energy.push_back(e.E)
+
+    i, j, k = get_indices(&e, grid.cell_dim)
+    if grid.cell(i, j, k) > -1:
+        e.point.z = max(grid.height_map[j, k], 0) * grid.cell_dim + grid.cell_dim - 0.001
+        push_back_coordinate(trajectory, e.point)
         energy.push_back(e.E)
-        e.add_point(coord)
-
-        # coord = coordinate(grid.z_top - 0.001, y0[g], x0[g]) # the incident point is sunk into the solid a tiny bit
-        # e.add_point(coord)
-        # push_back_coordinate(&trajectory, e.point)
-        # energy.push_back(e.E)
-
-        i, j, k = e.get_indices(grid.cell_dim)
-        if grid.grid[i,j,k] > -1:
-            e.point.z = max_index_less_double(grid.grid[:,j,k], 0) * grid.cell_dim + grid.cell_dim - 0.001
-            push_back_coordinate(&trajectory, e.point)
+        # print(f'Incident, Recorded point, energy: {e.point, e.E}')
+        mask.push_back(0.0)
+        if e.point.z == grid.cell_dim:
+            return 0
+        material = materials[0]
+
+    while e.E > Emin:
+        a = get_alpha(e.E, material.Z)
+        step = get_step(e.E, &material, a, &rng)
+        get_next_point(&e, a, step, &rng)
+        check = check_boundaries(&e, grid.shape_abs)
+        if not isnan(check.z):
+            flag = 1
+            e.point = check
+            delta[0] = e.point.z - e.point_prev.z
+            delta[1] = e.point.y - e.point_prev.y
+            delta[2] = e.point.x - e.point_prev.x
+            step = det_c(delta)
+        i, j, k = get_indices(&e, grid.cell_dim)
+        if grid.cell(i, j, k) < 0:
+            e.E = e.E + get_Eloss_c(e.E,&material) * step
+            push_back_coordinate(trajectory, e.point)
             energy.push_back(e.E)
-            # print(f'Incident, Recorded point, energy: {e.point, e.E}')
-            mask.push_back(0.0)
-            if e.point.z == grid.cell_dim:
-                trajectories.push_back(trajectory)
-                energies.push_back(energy)
-                masks.push_back(mask)
-                trajectory.clear()
-                energy.clear()
-                mask.clear()
-                continue
-            material = materials[0]
-
-        while e.E > Emin:
-            a = get_alpha(e.E, material.Z)
-            step = get_step(e.E, &material, a)
-            e.get_next_point(a, step)
-            check = e.check_boundaries(grid.shape_abs)
-            if not isnan(check.z):
-                flag = 1
-                e.point = check
-                delta[0] = e.point.z - e.point_prev.z
-                delta[1] = e.point.y - e.point_prev.y
-                delta[2] = e.point.x - e.point_prev.x
-                step = det_c(delta)
-            i, j, k = e.get_indices(grid.cell_dim)
-            if grid.grid[i, j, k] < 0:
-                e.E = e.E + get_Eloss_c(e.E,&material) * step
-                push_back_coordinate(&trajectory, e.point)
-                energy.push_back(e.E)
+            mask.push_back(1.0)
+            # print(f'Solid, Recorded point, energy: {e.point, e.E}, exiting: {flag}')
+            if grid.cell(i, j, k) != material.mark:
+                if grid.cell(i, j, k) == -2:
+                    material = materials[0]
+                if grid.cell(i, j, k) == -1:
+                    material = materials[1]
+        else:
+            flag = get_next_crossing(e.point_prev, e.direction, grid, crossing, crossing1, &rng)
+            # print(f'Got crossings: {c, c1}')
+            e.point = from_array(crossing)
+            delta[0] = e.point.z - e.point_prev.z
+            delta[1] = e.point.y - e.point_prev.y
+            delta[2] = e.point.x - e.point_prev.x
+            e.E = e.E + get_Eloss_c(e.E,&material) * det_c(delta)
+            push_back_coordinate(trajectory, e.point)
+            energy.push_back(e.E)
+            # print(f'Void, Recorded point, energy: {e.point, e.E}')
+            if flag == 2:
+                # print('Missed surface!')
+                mask.push_back(0.0)
+            if flag < 2:
                 mask.push_back(1.0)
-                # print(f'Solid, Recorded point, energy: {e.point, e.E}, exiting: {flag}')
-                if grid.grid[i, j, k] != material.mark:
-                    if grid.grid[i, j, k] == -2:
-                        material = materials[0]
-                    if grid.grid[i, j, k] == -1:
-                        material = materials[1]
-            else:
-                flag = get_next_crossing(e.point_prev, e.direction, grid, crossing, crossing1)
-                # print(f'Got crossings: {c, c1}')
-                e.point = from_mv(crossing)
-                delta[0] = e.point.z - e.point_prev.z
-                delta[1] = e.point.y - e.point_prev.y
-                delta[2] = e.point.x - e.point_prev.x
-                e.E = e.E + get_Eloss_c(e.E,&material) * det_c(delta)
-                push_back_coordinate(&trajectory, e.point)
+                add_point(&e, from_array(crossing1))
+                push_back_coordinate(trajectory, e.point)
                 energy.push_back(e.E)
-                # print(f'Void, Recorded point, energy: {e.point, e.E}')
-                if flag == 2:
-                    # print('Missed surface!')
-                    mask.push_back(0.0)
-                if flag < 2:
-                    mask.push_back(1.0)
-                    e.add_point(from_mv(crossing1))
-                    push_back_coordinate(&trajectory, e.point)
-                    energy.push_back(e.E)
-                    mask.push_back(0.0)
-                    # print(f'Void, exiting, Recorded point, energy: {e.point, e.E}')
-            if flag > 0:
-                flag = 0
-                break
-        trajectories.push_back(trajectory)
-        energies.push_back(energy)
-        masks.push_back(mask)
-        trajectory.clear()
-        energy.clear()
-        mask.clear()
-
-    return 1
+                mask.push_back(0.0)
+                # print(f'Void, exiting, Recorded point, energy: {e.point, e.E}')
+        if flag > 0:
+            break
+    return 0
 
 
 ####################################################################################
 ################## Physical formulas ###############################################
 ####################################################################################
 
-cdef double get_alpha(double E, double Z):
+cdef double get_alpha(double E, double Z) nogil noexcept:
     # Alpha can take values in a range [0.0001: 0.84]
     # assuming energy may vary from 0.1 (cut-off) to 30 keV
     # and element number varying from 1 to 116
     return 3.4E-3*Z**0.67/E
 
-cdef double get_step(double E, Element *material, double a):
-    cdef float rnd = rand() / (RAND_MAX * 1.00011) + 0.00001 # produces a random number in range[1E-5, 0.9999] with slight overlap (~1E-8)
+cdef double get_step(double E, Element *material, double a, RandomStream *rng) nogil noexcept:
+    cdef float rnd = rnd_next(rng) / 1.00011 + 0.00001 # produces a random number in range[1E-5, 0.9999] with slight overlap (~1E-8)
     return -log(rnd) * get_lambda_el(E, material.Z, material.rho, material.A, a)
 
-cdef double get_Eloss_c(double E, Element *material):
+cdef double get_Eloss_c(double E, Element *material) nogil noexcept:
     return -7.85E-3 * material.rho * material.Z / (material.A * E) * log(1.166 * (E / material.J + 0.85))
 
-cdef inline double get_sigma(double E, double Z, double a):
+cdef inline double get_sigma(double E, double Z, double a) nogil noexcept:
     return 5.21E-7 * Z ** 2 / E ** 2 * 4.0 * 3.14159 / (a * (1.0 + a)) * (
                 (E + 511.0) / (E + 1022.0)) ** 2
 
-cdef inline double get_lambda_el(double E, double Z, double rho, double A, double a):
+cdef inline double get_lambda_el(double E, double Z, double rho, double A, double a) nogil noexcept:
     cdef float sigma = get_sigma(E, Z, a)
     return A / (6.022141E23 * rho * 1.0E-21 * sigma)
 
 
-cdef inline float get_j(double Z):
+cdef inline float get_j(double Z) nogil noexcept:
     return (9.76 * Z + 58.5 / Z ** 0.19) * 1.0E-3
 
 ####################################################################################
@@ -490,22 +624,22 @@ cdef inline float get_j(double Z):
 ####################################################################################
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationVolume grid, double[:] crossing, double[:] crossing1) except -1:
+cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationVolume grid, double *crossing, double *crossing1, RandomStream *rng) nogil except -1:
     # 'c' in the end of the names stands for C-arrays
     cdef:
         double p0c[3]
         double pnc[3], directionc[3], tc[3], step_tc[3], deltac[3]
         signed char signc[3]
         unsigned char temp[3], temp1[3]
-        double[:] p0=p0c
-        double[:] pn=pnc
-        double[:] direction=directionc
-        double[:] t=tc
-        double[:] step_t = step_tc
-        double[:] delta=deltac
+        double *p0=p0c
+        double *pn=pnc
+        double *direction=directionc
+        double *t=tc
+        double *step_t = step_tc
+        double *delta=deltac
         int step[3]
         double t_min, min = 1e-6
-        signed char[:] sign = signc
+        signed char *sign = signc
         unsigned char flag
         int i = 0
 
@@ -523,7 +657,7 @@ cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationV
 
     sign_double(direction, sign)
     # print(f'sign{signc[0], signc[1], signc[2]}')
-    for i in range(sign.shape[0]):
+    for i in range(3):
         if sign[i] == 1:
             temp[i] = 1
         else:
@@ -548,7 +682,7 @@ cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationV
     # print(f'dir: {directionc}')
     for i in range(3):
         if directionc[i] == 0:
-            directionc[i] = rnd_uniform(-0.000001, 0.000001)
+            directionc[i] = rnd_uniform(rng, -0.000001, 0.000001)
         step[i] = sign[i] * grid.cell_dim
 
     # print(f'step: {step}')
@@ -558,7 +692,7 @@ cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationV
     for i in range(3):
         deltac[i] = -(p0[i]%grid.cell_dim)
     # print(f'delta: {deltac}')
-    for i in range(delta.shape[0]):
+    for i in range(3):
         if delta[i] == 0:
             temp1[i] = 1
         else:
@@ -570,7 +704,7 @@ cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationV
             signc[i] = 0
     # print(f't: {tc}')
     # print(f'(sign==1)=0: {signc[0], signc[1], signc[2]}')
-    flag = get_surface_crossing_c(grid.surface, grid.cell_dim, p0, direction, t, step_t, sign, crossing)
+    flag = get_surface_crossing_c(grid.flags, grid.cell_dim, p0, direction, t, step_t, sign, crossing)
     if flag:
         # i,j,k = int(p0[0]/grid.cell_dim), int(p0[1]/grid.cell_dim), int(p0[2]/grid.cell_dim)
         # print(f'\nMissed surface: {i,j,k}, cell: {grid.grid[i,j,k]} \n'
@@ -588,18 +722,21 @@ cdef signed char get_next_crossing(Coordinate point, Coordinate vec, SimulationV
     crossing[0] -= sign[0] * 0.001 # pusing the scattering point a tiny bit into the solid
     crossing[1] -= sign[1] * 0.001
     crossing[2] -= sign[2] * 0.001
-    flag = get_solid_crossing_c(grid.grid, grid.cell_dim, p0, direction, t, step_t, sign, crossing1)
+    if grid.single:
+        flag = get_solid_crossing_c(grid.grid_single, grid.cell_dim, p0, direction, t, step_t, sign, crossing1)
+    else:
+        flag = get_solid_crossing_c(grid.grid, grid.cell_dim, p0, direction, t, step_t, sign, crossing1)
     if flag:
         crossing1 = pnc
     else:
         crossing1[0] += sign[0] * 0.001 # pusing the scattering point a tiny bit into the solid
-        crossing1[0] += sign[0] * 0.001
-        crossing1[0] += sign[0] * 0.001
+        crossing1[1] += sign[1] * 0.001
+        crossing1[2] += sign[2] * 0.001
     return flag
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef unsigned char get_solid_crossing_c(double[:,:,:] grid, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord) nogil except -1:
+cdef unsigned char get_solid_crossing_c(floating[:,:,:] grid, int cell_dim, double *p0, double *direction, double *t, double *step_t, signed char *sign, double *coord) nogil except -1:
     cdef:
         char ind
         int i
@@ -620,17 +757,12 @@ cdef unsigned char get_solid_crossing_c(double[:,:,:] grid, int cell_dim, double
             index[i] = <unsigned int> (coord[i]/cell_dim)
         # index[ind] = <unsigned int> (index[ind] + sign[ind])
         if grid[index[0], index[1], index[2]]<=-1:
-            if coord[1] == 0 or coord[2] == 0:
-                with gil:
-                    print(f'Coords: {coord[0], coord[1], coord[2]}')
-                    print(f'Index: {index[0], index[1], index[2]}')
-                    print(f'Grid: {grid[index[0], index[1], index[2]]}')
             return False
         t[ind] = t[ind] + step_t[ind]  # going to the next wall
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] surface, int cell_dim, double[:] p0, double[:] direction, double[:] t, double[:] step_t, signed char[:] sign, double[:] coord) nogil except -1:
+cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] flags, int cell_dim, double *p0, double *direction, double *t, double *step_t, signed char *sign, double *coord) nogil except -1:
     cdef:
         char ind
         int i
@@ -651,7 +783,7 @@ cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] surface, int cell
             index[i] = <unsigned int> (coord[i]/cell_dim)
         # index[ind] = <unsigned int> (index[ind] + sign[ind])
         # print(f'Coord: {[coord[0], coord[1], coord[2]]} , Index: {index}, Sign: {sign[ind]}, T, ind: {next_t, ind}')
-        if surface[index[0], index[1], index[2]]:
+        if flags[index[0], index[1], index[2]] & SURFACE:
             # print('')
             return False
         t[ind] = t[ind] + step_t[ind]  # going to the next wall
@@ -661,7 +793,7 @@ cdef unsigned char get_surface_crossing_c(unsigned char[:,:,:] surface, int cell
 ####################################################################################
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef inline (double, char) arr_min(double[:] x) nogil:
+cdef inline (double, char) arr_min(double *x) nogil noexcept:
     """
     Find the minimum value in the array(vector).
 
@@ -670,7 +802,7 @@ cdef inline (double, char) arr_min(double[:] x) nogil:
     """
     cdef int i, n=0,
     cdef double min=x[0]
-    for i in range(x.shape[0]):
+    for i in range(3):
         if x[i] < min:
             min = x[i]
             n = i
@@ -706,9 +838,9 @@ cdef int sign_int(double[:] x, signed char[:] c) nogil except -1:
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef int sign_double(double[:] x, signed char[:] c) nogil except -1:
+cdef int sign_double(double *x, signed char *c) nogil except -1:
     cdef int i
-    for i in range(x.shape[0]):
+    for i in range(3):
         if x[i]>0:
             c[i] = 1
         elif x[i]<0:
@@ -758,9 +890,9 @@ cdef int max_index_less_double(double[:] x, double val) nogil except -1:
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef int sub_double(double[:] x, double[:] y, double[:] c) nogil except -1:
+cdef int sub_double(double *x, double *y, double *c) nogil except -1:
     cdef int i
-    for i in range(x.shape[0]):
+    for i in range(3):
         c[i] = x[i] - y[i]
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
@@ -786,7 +918,7 @@ cdef int div_double(double[:] x, double[:] y, double[:] c) nogil except -1:
 
 @cython.boundscheck(False) # turn off bounds-checking for entire function
 @cython.wraparound(False)  # turn off negative index wrapping for entire function
-cdef inline double det_c(double* vec) nogil except -1:
+cdef inline double det_c(double* vec) nogil noexcept:
     """
     Find the length of a vector.
 
@@ -800,13 +932,47 @@ cdef inline double det_c(double* vec) nogil except -1:
 cdef inline double det_c_debug(double[:] vec) nogil except -1:
     return sqrt(vec[0] * vec[0] + vec[1] * vec[1] + vec[2] * vec[2])
 
-cdef double rnd_uniform(double min, double max) nogil except -1:
-    return rand() / (RAND_MAX * 1.0)*(max-min) + min
 
 
 ####################################################################################
 ################## Memory management ###############################################
 ####################################################################################
+@cython.boundscheck(False) # turn off bounds-checking for entire function
+@cython.wraparound(False)  # turn off negative index wrapping for entire function
+cdef tuple trajectory_vectors_to_np(vector[vector[double]] &ts, vector[vector[double]] &es, vector[vector[double]] &ms, Py_ssize_t[:,:] records):
+    """
+    Merge trajectories from the thread buffers into flat arrays in the order of electrons.
+    """
+    cdef:
+        Py_ssize_t n = records.shape[0]
+        Py_ssize_t g, i, thread, start, mask_start, length, offset, mask_offset
+        np.ndarray offsets_np = np.zeros(n + 1, dtype=np.intp)
+        Py_ssize_t[:] offsets = offsets_np
+    for g in range(n):
+        offsets[g + 1] = offsets[g] + records[g, 3]
+    points_np = np.empty((offsets[n], 3))
+    energies_np = np.empty(offsets[n])
+    masks_np = np.empty(offsets[n] - n)
+    cdef double[:,:] points = points_np
+    cdef double[:] energies = energies_np
+    cdef double[:] masks = masks_np
+    with nogil:
+        for g in range(n):
+            thread = records[g, 0]
+            start = records[g, 1]
+            mask_start = records[g, 2]
+            length = records[g, 3]
+            offset = offsets[g]
+            mask_offset = offset - g
+            for i in range(length):
+                points[offset + i, 0] = ts[thread][(start + i) * 3]
+                points[offset + i, 1] = ts[thread][(start + i) * 3 + 1]
+                points[offset + i, 2] = ts[thread][(start + i) * 3 + 2]
+                energies[offset + i] = es[thread][start + i]
+            for i in range(length - 1):
+                masks[mask_offset + i] = ms[thread][mask_start + i]
+    return points_np, energies_np, masks_np, offsets_np
+
 cdef list trajectory_vector_to_np_list(vector[vector[double]] ts, vector[vector[double]] es, vector[vector[double]] ms):
     cdef list passes = []
     cdef int i, j
@@ -28,6 +28,8 @@ class MC_Simulation(MC_Sim_Base):
         self.pe_sim.setParameters(structure, mc_params)
         self.se_sim = map3d.ETrajMap3d()
         self.se_sim.setParametrs(structure, mc_params, 0.3)
+        # Trajectories are only needed for debugging and plotting, otherwise SE flux and heat are tallied on the fly
+        self.record_trajectories = mc_params.get('record_trajectories', False)
 
         self.se_surface_flux = None
         self.beam_heating = None
@@ -40,10 +42,11 @@ class MC_Simulation(MC_Sim_Base):
         :return:
         """
         self.pe_sim.grid = self.se_sim.grid = structure.deposit
-        self.pe_sim.surface = self.se_sim.surface = structure.surface_bool
+        self.pe_sim.flags = self.se_sim.flags = structure.cell_flags
+        self.pe_sim.height_map = structure.height_map
         self.se_sim.s_neighb = structure.surface_neighbors_bool
-        self.se_surface_flux = np.zeros(structure.shape, dtype=np.int32)
-        self.beam_heating = np.zeros(structure.shape)
+        self.se_surface_flux = None
+        self.beam_heating = None  # recalculated by the next simulation with heating
 
     def run_simulation(self, y0, x0, heat, N=None):
         """
@@ -52,7 +55,7 @@ class MC_Simulation(MC_Sim_Base):
         :param y0: spot y-coordinate
         :param x0: spot x-coordinate
         :param heat: if True, calculate beam heating
-        :return: SE surface flux
+        :return: SE surface flux: index of the irradiated cells and flux values in them
         """
         if not N:
             if heat:
@@ -60,12 +63,19 @@ class MC_Simulation(MC_Sim_Base):
             else:
                 N = self.pe_sim.N
         norm_factor = self.pe_sim.get_norm_factor(N)
-        self.pe_sim.map_wrapper_cy(y0, x0, N)
-        self.se_sim.map_follow(self.pe_sim.passes, heat)
+        if self.record_trajectories:
+            self.pe_sim.map_wrapper_cy(y0, x0, N)
+            self.se_sim.map_follow(self.pe_sim.trajectories, heat)
+        else:
+            self.pe_sim.map_wrapper_stream(y0, x0, self.se_sim, heat, N)
         const = norm_factor / self.se_sim.amplifying_factor / self.pe_sim.cell_size ** 2 / self.se_sim.segment_min_length
         if heat:
             self.beam_heating = self.se_sim.heat * norm_factor / self.pe_sim.cell_size ** 3
-        self.se_surface_flux = np.int32(self.se_sim.flux * const)
+        # Only the cells that received a noticeable flux are passed on
+        index = self.se_sim.flux_index
+        flux = np.int32(self.se_sim.flux[index] * const)
+        irradiated = (flux > 0).nonzero()[0]
+        self.se_surface_flux = (tuple(np.intc(i[irradiated]) for i in index), flux[irradiated])
         return self.se_surface_flux
 
     def plot(self, primary_e=True, secondary_flux=True, secondary_e=False, heat_total=False,
@@ -77,13 +87,13 @@ class MC_Simulation(MC_Sim_Base):
         """
         render = vr.Render(self.pe_sim.cell_size)
         kwargs = {}
-        if primary_e:
+        if primary_e and self.pe_sim.trajectories is not None:
             pe_trajectories = np.asarray(self.pe_sim.passes, dtype='object')
             kwargs['pe_traj'] = pe_trajectories
         if secondary_flux:
             kwargs['surface_flux'] = self.se_sim.flux
-        if secondary_e:
-            kwargs['se_traj'] = self.se_sim.coords
+        if secondary_e and self.pe_sim.trajectories is not None:
+            kwargs['se_traj'] = self.se_sim.get_se_vectors(self.pe_sim.trajectories)
         if heat_total:
             kwargs['heat_t'] = self.se_sim.heat
         if heat_pe:
@@ -101,7 +111,9 @@ class MC_Simulation(MC_Sim_Base):
 
     def plot_flux_2d(self):
         import matplotlib.pyplot as plt
-        summed = np.sum(self.se_surface_flux, 0)
+        index, flux = self.se_surface_flux
+        summed = np.zeros(self.pe_sim.grid.shape[1:])
+        np.add.at(summed, index[1:], flux)
         x, y = np.mgrid[0:summed.shape[1] + 1,
                0:summed.shape[0] + 1]  # +1 because 'shading=flat' requires dropping last column and row
         fig, ax = plt.subplots()
@@ -132,7 +144,8 @@ def run_mc_simulation(structure, E0=20, sigma=5, n=1, N=100, pos='center', precu
                  'I0': 1e-10, 'sigma': sigma, 'n': n,
                  'N': N, 'substrate_element': 'Au',
                  'cell_size': structure.cell_size,
-                 'emission_fraction': emission_fraction}
+                 'emission_fraction': emission_fraction,
+                 'record_trajectories': True}
     if type(precursor) is not str:
         precursor_config = {'name': precursor["deposit"],
                      'Z': precursor["average_element_number"],
@@ -22,6 +22,36 @@ from febid.monte_carlo.compiled import etrajectory_c
 from febid.monte_carlo.mc_base import MC_Sim_Base
 
 
+def split_trajectories(points, energies, masks, offsets):
+    """
+    Split flat trajectories into a list of separate trajectories.
+
+    :param points: consequent scattering points of all trajectories
+    :param energies: remaining energy at each point
+    :param masks: marks segments that lie outside of solid
+    :param offsets: index of the first point of each trajectory, the last element is the total number of points
+    :return: list of (points, energies, mask) of each trajectory
+    """
+    mask_offsets = offsets - np.arange(offsets.shape[0])  # a trajectory has one mask less than points
+    return [(points[offsets[i]:offsets[i + 1]], energies[offsets[i]:offsets[i + 1]],
+             masks[mask_offsets[i]:mask_offsets[i + 1]]) for i in range(offsets.shape[0] - 1)]
+
+
+def join_trajectories(passes):
+    """
+    Concatenate a list of trajectories into flat arrays.
+
+    :param passes: list of (points, energies, mask) of each trajectory
+    :return: points, energies, masks and offsets of all trajectories
+    """
+    points = np.concatenate([np.asarray(p[0], dtype=np.float64).reshape(-1, 3) for p in passes])
+    energies = np.concatenate([np.asarray(p[1], dtype=np.float64) for p in passes])
+    masks = np.concatenate([np.asarray(p[2], dtype=np.float64) for p in passes])
+    offsets = np.zeros(len(passes) + 1, dtype=np.intp)
+    offsets[1:] = np.cumsum([len(p[1]) for p in passes])
+    return points, energies, masks, offsets
+
+
 class Electron():
     """
     A class representing a single electron with its properties and methods to define its scattering vector.
@@ -225,7 +255,8 @@ class ETrajectory(MC_Sim_Base):
     A class responsible for the generation and scattering of electron trajectories
     """
     def __init__(self):
-        self.passes = [] # keeps the last result of the electron trajectory simulation
+        self.trajectories = None # keeps the last result of the electron trajectory simulation: points, energies, masks and offsets
+        self.passes = [] # the same trajectories as a list, split from the flat arrays on demand
 
         rnd.seed()
 
@@ -235,6 +266,8 @@ class ETrajectory(MC_Sim_Base):
         self.sigma = 0 # standard Gaussian deviation
         self.n = 0 # power of the super Gaussian distribution
         self.N = 0 # number of electron trajectories to simulate
+        self.threads = 1 # number of threads simulating electrons in parallel
+        self.rng = np.random.default_rng() # source of the seeds for the random streams of the electrons
 
         # Solid structure properties
         self.material = None # material in the current point
@@ -246,6 +279,19 @@ class ETrajectory(MC_Sim_Base):
 
         self.norm_factor = 0 # a ratio of the actual number of electrons emitted to the number of electrons simulated
 
+    @property
+    def passes(self):
+        """
+        Trajectories of the last simulation as a list of (points, energies, mask) of each electron
+        """
+        if self.__passes is None and self.trajectories is not None:
+            self.__passes = split_trajectories(*self.trajectories)
+        return self.__passes
+
+    @passes.setter
+    def passes(self, passes):
+        self.__passes = passes
+
     def setParameters(self, structure, params, stat=1000):
         """
         Initialise the instance and set all the necessary parameters
@@ -260,12 +306,15 @@ class ETrajectory(MC_Sim_Base):
         self.Emin = params['Emin']
         self.I0 = params['I0']
         self.grid = structure.deposit
-        self.surface = structure.surface_bool
+        self.flags = structure.cell_flags  # cell flags, marking the surface
+        self.height_map = structure.height_map
         self.s_neghib = structure.surface_neighbors_bool
         self.cell_size = params['cell_size']
         self.sigma = params['sigma']
         self.n = params.get('n', 1)
         self.N = stat
+        self.threads = params.get('threads', 1)
+        self.rng = np.random.default_rng(params.get('seed'))
         self.norm_factor = (self.I0 / self.elementary_charge) / self.N
 
         self.deponat = params['deponat']
@@ -279,7 +328,7 @@ class ETrajectory(MC_Sim_Base):
         self.zdim, self.ydim, self.xdim = self.grid.shape
         self.zdim_abs, self.ydim_abs, self.xdim_abs = self.zdim * self.cell_size, self.ydim * self.cell_size, self.xdim * self.cell_size
         self.chamber_dim = np.asarray([self.zdim_abs, self.ydim_abs, self.xdim_abs])
-        self.ztop = np.nonzero(self.surface)[0].max() + 1  # highest point of the structure
+        self.ztop = self.height_map.max() + 2  # highest point of the structure
 
     def get_norm_factor(self, N=None):
         """
@@ -318,7 +367,7 @@ class ETrajectory(MC_Sim_Base):
         def super_gauss_2d(x, y, st_dev, n):
             return 1 / sqrt(2 * pi) / st_dev * e ** (-0.5 * (((x - x0) ** 2 + (y - y0) ** 2) / (st_dev ** 2)) ** n)
         if N == 0: N = self.N
-        rnd = np.random.default_rng()
+        rnd = self.rng
         # Boundaries of the distribution
         bonds = self.sigma * 5
         x_all = np.array([0])
@@ -414,7 +463,8 @@ class ETrajectory(MC_Sim_Base):
         print(f'finished. \t {dt() - start}')
         if not len(self.passes) > 0:
             raise ValueError('Zero trajectories generated!')
-        return self.passes
+        self.trajectories = join_trajectories(self.passes)
+        return self.trajectories
 
     def map_wrapper_cy(self, y0, x0, N=0):
         """
@@ -431,13 +481,47 @@ class ETrajectory(MC_Sim_Base):
         print('Running \'map trajectory\'...', end='')
         start = dt()
         try:
-            self.passes = etrajectory_c.start_sim(self.E0, self.Emin, y0, x0, self.cell_size, self.grid, self.surface.view(dtype=np.uint8), [self.substrate, self.deponat])
+            seed = int(self.rng.integers(2 ** 63))
+            self.trajectories = etrajectory_c.start_sim(self.E0, self.Emin, y0, x0, self.cell_size, self.grid,
+                                                        self.flags, self.height_map, [self.substrate, self.deponat],
+                                                        seed, self.threads)
         except Exception as e:
             raise RuntimeError(f'An error occurred while generating trajectories: {e.args}')
+        self.passes = None
         print(f'finished. \t {dt() - start}')
-        if not len(self.passes) > 0:
+        if not self.trajectories[3].shape[0] > 1:
             raise ValueError('Zero trajectories generated!')
-        return self.passes
+        return self.trajectories
+
+    def map_wrapper_stream(self, y0, x0, se_sim, heating=False, N=0):
+        """
+        Create normally distributed electron positions and run trajectory mapping in Cython,
+        tallying SE surface flux and heat sources on the fly without storing the trajectories
+
+        :param y0: y-position of the beam, nm
+        :param x0: x-position of the beam, nm
+        :param se_sim: ETrajMap3d instance, that receives the results
+        :param heating: True will calculate collective heat effect from PEs and SEs
+        :param N: number of electrons to create
+        :return:
+        """
+        if N == 0:
+            N = self.N
+        x0, y0 = self.rnd_super_gauss(x0, y0, N) # generate gauss-distributed beam positions
+        print('Running \'stream trajectory\'...', end='')
+        start = dt()
+        accumulators = se_sim.prepare_accumulators(heating)
+        try:
+            seed = int(self.rng.integers(2 ** 63))
+            etrajectory_c.stream_sim(self.E0, self.Emin, y0, x0, self.cell_size, self.grid, self.flags,
+                                     self.height_map, [self.substrate, self.deponat], *accumulators,
+                                     *se_sim.se_parameters(), seed, se_sim.get_seed(), self.threads)
+        except Exception as e:
+            raise RuntimeError(f'An error occurred while generating trajectories: {e.args}')
+        self.trajectories = None
+        self.passes = None
+        se_sim.collect_accumulators(*accumulators)
+        print(f'finished. \t {dt() - start}')
 
     def map_trajectory(self, x0, y0):
         """
@@ -448,7 +532,7 @@ class ETrajectory(MC_Sim_Base):
         :return:
         """
         self.passes = []
-        self.ztop = np.nonzero(self.surface)[0].max()
+        self.ztop = self.height_map.max() + 1
         count = -1
         print('\nStarting PE trajectories mapping...')
         for x,y in zip(x0,y0):
@@ -471,7 +555,7 @@ class ETrajectory(MC_Sim_Base):
             if self.grid[i, j, k] > -1:  # if current cell is not deposit or substrate, electron flies straight to the surface
                 coords.point_prev[0] = coords.z_prev = coords.z
                 # Finding the highest solid cell
-                coords.point[0] = coords.z = np.amax((self.grid[:, j, k]<0).nonzero()[0], initial=0) * self.cell_size + self.cell_size # addition here is required to position at the top of the incident solid cell
+                coords.point[0] = coords.z = max(self.height_map[j, k], 0) * self.cell_size + self.cell_size # addition here is required to position at the top of the incident solid cell
                 trajectories.append(coords.coordinates)  # saving current point
                 energies.append(coords.E)
                 mask.append(0)
@@ -580,7 +664,7 @@ class ETrajectory(MC_Sim_Base):
         """
         print('Starting PE simulation...')
         self.passes = []
-        self.ztop = np.nonzero(self.surface)[0].max()
+        self.ztop = self.height_map.max() + 1
         i = -1
         for x, y in zip(x0, y0):
             i +=1
@@ -607,8 +691,7 @@ class ETrajectory(MC_Sim_Base):
                 print(f'Setting z-coordinate as previous one: {coords.z} <— {coords.z_prev}')
                 coords.point_prev[0] = coords.z_prev = coords.z
                 # Finding the highest solid cell
-                coords.point[0] = coords.z = np.amax((self.grid[:, j, k] < 0).nonzero()[0],
-                                                     initial=0) * self.cell_size + self.cell_size  # addition here is required to position at the top of the incident solid cell
+                coords.point[0] = coords.z = max(self.height_map[j, k], 0) * self.cell_size + self.cell_size  # addition here is required to position at the top of the incident solid cell
                 print(f'Got new z coordinate at the surface: {coords.z}')
                 print(f'Recording coordinates: {coords.coordinates}')
                 trajectories.append(coords.coordinates)  # saving current point
@@ -761,7 +844,7 @@ class ETrajectory(MC_Sim_Base):
         t = np.abs((delta + (step == self.cell_size) * self.cell_size + (delta == 0) * step) / direction)
         sign[sign == 1] = 0
         crossing = np.empty(3)
-        traversal.get_surface_crossing(self.surface.view(dtype=np.uint8), self.cell_size, p0, direction, t, step_t, sign, curr_material, crossing)
+        traversal.get_surface_crossing(self.flags, self.cell_size, p0, direction, t, step_t, sign, curr_material, crossing)
         if not crossing.any():
             return pn
         return crossing
@@ -794,7 +877,7 @@ class ETrajectory(MC_Sim_Base):
         sign[sign == 1] = 0
         crossing = np.ones(3)
         crossing1 = np.ones(3)
-        flag = traversal.get_surface_solid_crossing(self.surface.view(dtype=np.uint8), self.grid, self.cell_size, p0,
+        flag = traversal.get_surface_solid_crossing(self.flags, self.grid, self.cell_size, p0,
                                                     pn, direction, t, step_t, sign, crossing, crossing1)
         if flag != 0:
             if flag == 2:
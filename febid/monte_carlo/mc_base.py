@@ -37,7 +37,7 @@ class Element:
 class MC_Sim_Base(ABC):
     cell_size:int
     grid: np.ndarray
-    surface: np.ndarray
+    flags: np.ndarray
     s_neighb: np.ndarray
     deponat: Element
     substrate:Element
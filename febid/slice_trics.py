@@ -151,3 +151,20 @@ def get_center_view(array, n=1):
     view_slice = tuple(view_slice)
     center_view = array[view_slice]
     return center_view
+
+
+def get_neighbors_index(cells, offsets, shape):
+    """
+    Get indices of the neighbors of several cells, that are within the array.
+
+    :param cells: cells indices, a tuple of arrays
+    :param offsets: neighbors positions relative to the cell, (M, 3) array
+    :param shape: array shape
+    :return: neighbors index, index of the cell each neighbor belongs to
+    """
+    cells = np.stack(cells, axis=1)
+    neighbors = cells[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    valid = np.all((neighbors >= 0) & (neighbors < np.array(shape)), axis=2)
+    source = np.nonzero(valid)[0]
+    neighbors = neighbors[valid]
+    return (neighbors[:, 0], neighbors[:, 1], neighbors[:, 2]), source
@@ -28,27 +28,41 @@ print(f'Platform: {platform, openMP_arg}')
 # Add include/link dirs, and modify the stdlib to libc++
 ext_modules = [
              Extension("febid.monte_carlo.compiled.etrajectory_c", ['febid/monte_carlo/compiled/etrajectory_c.pyx'],
+                         # include_dirs=["/usr/local/opt/llvm/include"],
+                         # library_dirs=["/usr/local/opt/llvm/lib"],
+                         extra_compile_args=['-fopenmp'] if 'darwin' not in platform else [],
+                         libraries=libraries,
+                         extra_link_args=[openMP_arg]
+                         ),
+               Extension("febid.libraries.ray_traversal.traversal", ['febid/libraries/ray_traversal/traversal.pyx'],
+                         # include_dirs=["/usr/local/opt/llvm/include"],
+                         # library_dirs=["/usr/local/opt/llvm/lib"],
+                         extra_compile_args=['-fopenmp'] if 'darwin' not in platform else [],
+                         libraries=libraries,
+                         extra_link_args=[openMP_arg]
+                         ),
+               Extension("febid.libraries.rolling.roll", ['febid/libraries/rolling/roll.pyx'],
                          # include_dirs=["/usr/local/opt/llvm/include"],
                          # library_dirs=["/usr/local/opt/llvm/lib"],
                          # extra_compile_args=["-w", '-fopenmp'],
                          # libraries=libraries,
                          # extra_link_args=[openMP_arg]
                          ),
-               Extension("febid.libraries.ray_traversal.traversal", ['febid/libraries/ray_traversal/traversal.pyx'],
+              Extension("febid.libraries.pde.tridiag", ['febid/libraries/pde/tridiag.pyx'],
                          # include_dirs=["/usr/local/opt/llvm/include"],
                          # library_dirs=["/usr/local/opt/llvm/lib"],
-                         # extra_compile_args=["-w", '-fopenmp'],
+                         # extra_compile_args=["-w", "-fopenmp"],
                          # libraries=libraries,
                          # extra_link_args=[openMP_arg]
                          ),
-               Extension("febid.libraries.rolling.roll", ['febid/libraries/rolling/roll.pyx'],
+              Extension("febid.libraries.pde.reaction_diffusion", ['febid/libraries/pde/reaction_diffusion.pyx'],
                          # include_dirs=["/usr/local/opt/llvm/include"],
                          # library_dirs=["/usr/local/opt/llvm/lib"],
-                         # extra_compile_args=["-w", '-fopenmp'],
+                         # extra_compile_args=["-w", "-fopenmp"],
                          # libraries=libraries,
                          # extra_link_args=[openMP_arg]
                          ),
-              Extension("febid.libraries.pde.tridiag", ['febid/libraries/pde/tridiag.pyx'],
+              Extension("febid.libraries.mcca.mcca_c", ['febid/libraries/mcca/mcca_c.pyx'],
                          # include_dirs=["/usr/local/opt/llvm/include"],
                          # library_dirs=["/usr/local/opt/llvm/lib"],
                          # extra_compile_args=["-w", "-fopenmp"],
@@ -69,8 +83,9 @@ setuptools.setup(
     project_urls = {},
     license='MIT',
     packages=['febid', 'febid.monte_carlo', 'febid.monte_carlo.compiled', 'febid.ui', 'febid.libraries.vtk_rendering',
-              'febid.libraries.rolling', 'febid.libraries.ray_traversal', 'febid.libraries.pde'],
-    package_data = {'': ['*.pyx']},
+              'febid.libraries.rolling', 'febid.libraries.ray_traversal', 'febid.libraries.pde',
+              'febid.libraries.mcca'],
+    package_data = {'': ['*.pyx', '*.pxd']},
     include_package_data=True,
     install_requires=['numpy<1.23.0', 'pyvista', 'pandas', 'ruamel.yaml', 'cython', 'openpyxl', 'tqdm', 'pyqt5', 'pyaml',
                       'numexpr_mod'],
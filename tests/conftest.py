@@ -0,0 +1,89 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'febid'))  # Process imports some of the modules as top-level
+EXAMPLES = os.path.join(ROOT, 'Examples')
+
+PRECURSOR = dict(F=1700, n0=2.7, V=0.05, sigma=0.022, tau=1e-2, D=1e5, heat_cond=0, deposition_scaling=1)
+
+
+def make_structure(size=30, pillar=True):
+    """
+    Create a small structure, optionally with a pillar on the substrate
+
+    :param size: lateral size of the grid in cells
+    :param pillar: if True, put a pillar in the center to make the surface 3D
+    :return: structure
+    """
+    from febid.Structure import Structure
+    structure = Structure()
+    structure.create_from_parameters(cell_size=5, width=size, length=size, height=20, substrate_height=4, nr=0)
+    if pillar:
+        c = size // 2
+        structure.deposit[4:7, c - 3:c + 3, c - 3:c + 3] = -1
+        structure.precursor[structure.deposit < 0] = 0
+        structure.cell_flags[...] = 0
+        structure.define_surface()
+        structure.define_semi_surface()
+        structure.define_surface_neighbors(1)
+        structure.define_ghosts()
+        structure.define_height_map()
+    return structure
+
+
+def make_process(size=30, flux=1e6, pillar=True, temp_tracking=False, **settings):
+    """
+    Create a small process with a pillar on the substrate under a gaussian beam
+
+    :param size: lateral size of the grid in cells
+    :param flux: SE flux in the center of the beam
+    :param pillar: if True, put a pillar in the center to make the surface 3D
+    :param temp_tracking: enable temperature tracking
+    :param settings: equation values replacing the default ones
+    :return: process, structure
+    """
+    pytest.importorskip('febid.libraries.pde.reaction_diffusion')
+    from febid.Process import Process
+    structure = make_structure(size, pillar)
+    equation_values = dict(PRECURSOR, **settings)
+    process = Process(structure, equation_values, temp_tracking=temp_tracking)
+    process.max_neib = 1  # set by the simulation from the SE escape depth
+    y, x = np.mgrid[0:size, 0:size]
+    gauss = (flux * np.exp(-((y - size / 2) ** 2 + (x - size / 2) ** 2) / 8)).astype(np.int32)
+    beam_matrix = np.zeros(structure.shape, dtype=np.int32)
+    surface = np.asarray(structure.surface_bool)
+    for z in range(structure.shape[0]):
+        beam_matrix[z][surface[z]] = gauss[surface[z]]
+    process.set_beam_matrix(beam_matrix)
+    return process, structure
+
+
+def run(process, time, dt=None):
+    """
+    Advance the process for the given time, optionally with a fixed time step
+
+    :return: precursor coverage and deposit arrays
+    """
+    t = 0
+    while t < time:
+        if dt is not None:
+            process.dt = dt
+        t += process.advance(time - t)
+    return np.array(process.structure.precursor), np.array(process.structure.deposit)
+
+
+def fill_cells(process, cells):
+    """
+    Fill the cells and update the process as after a deposition step
+
+    :param process: process
+    :param cells: cells index in the structure
+    :return: True if the structure was resized
+    """
+    process.structure.deposit[cells] = 1
+    return process.cell_filled_routine()
@@ -0,0 +1,124 @@
+"""
+Memory footprint of the Monte Carlo SE flux and heat accumulation
+"""
+import math
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+import pytest
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, 'febid'))  # Process imports some of the modules as top-level
+
+pytest.importorskip('febid.monte_carlo.compiled.etrajectory_c')
+pytest.importorskip('febid.libraries.ray_traversal.traversal')
+
+from febid.Structure import Structure
+from febid import febid_core
+from febid.monte_carlo.etraj3d import MC_Simulation
+from febid.monte_carlo.etrajmap3d import process_trajectories
+from febid.libraries.ray_traversal import traversal
+
+EXAMPLES = os.path.join(ROOT, 'Examples')
+
+
+def get_simulation(threads, record_trajectories=False):
+    with open(os.path.join(EXAMPLES, 'Parameters.yml')) as f:
+        settings = yaml.safe_load(f)
+    with open(os.path.join(EXAMPLES, 'Me3PtCpMe.yml')) as f:
+        precursor = yaml.safe_load(f)
+    settings.update(mc_threads=threads, mc_seed=0, mc_record_trajectories=record_trajectories)
+    structure = Structure()
+    structure.create_from_parameters(cell_size=5, width=30, length=30, height=40, substrate_height=4)
+    sim = MC_Simulation(structure, febid_core.prepare_ms_config(precursor, settings, structure))
+    max_neib = math.ceil(max(sim.deponat.lambda_escape, sim.substrate.lambda_escape) / structure.cell_size)
+    structure.define_surface_neighbors(max_neib)
+    return sim
+
+
+def peak_memory(sim, heat):
+    sim.run_simulation(75., 75., heat, 2000)  # warm up
+    tracemalloc.start()
+    sim.run_simulation(75., 75., heat, 2000)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+@pytest.mark.parametrize('record_trajectories', [False, True])
+@pytest.mark.parametrize('heat', [False, True])
+def test_memory_does_not_grow_with_threads(heat, record_trajectories):
+    sims = [get_simulation(threads, record_trajectories) for threads in (1, 4)]
+    peaks = [peak_memory(sim, heat) for sim in sims]
+    grid_size = np.zeros(sims[0].se_sim.grid.shape).nbytes  # a single per-thread copy of an accumulator
+    assert peaks[1] - peaks[0] < grid_size
+
+
+def test_accumulators_are_reused():
+    sim, reference = get_simulation(1), get_simulation(1)
+    for s in (sim, reference):
+        s.run_simulation(75., 75., True, 2000)
+    flux, heat = sim.se_sim.flux, sim.se_sim.DE
+    reference.se_sim.flux = reference.se_sim.DE = np.zeros(0)  # forces new arrays
+    for s in (sim, reference):
+        s.run_simulation(75., 75., True, 2000)
+    assert sim.se_sim.flux is flux and sim.se_sim.DE is heat
+    assert np.allclose(sim.se_sim.flux, reference.se_sim.flux)
+    assert np.allclose(sim.se_sim.heat, reference.se_sim.heat)
+
+
+@pytest.mark.parametrize('record_trajectories', [False, True])
+def test_filled_cells_are_recorded(record_trajectories):
+    sim = get_simulation(4, record_trajectories)
+    for capacity in (1, None):  # the cells that did not fit are found by scanning the accumulators
+        if capacity:
+            sim.se_sim.flux_cells = np.empty(capacity, dtype=np.intp)
+            sim.se_sim.heat_cells = np.empty(capacity, dtype=np.intp)
+        sim.run_simulation(75., 75., True, 2000)
+        se_sim = sim.se_sim
+        assert np.array_equal(np.array(se_sim.flux_index), np.array(se_sim.flux.nonzero()))
+        heat_index = np.logical_or(se_sim.DE, se_sim.wasted_se).nonzero()
+        assert np.array_equal(np.array(se_sim.heat_index), np.array(heat_index))
+
+
+def ray_parameters(p0, pn, cell_size):
+    """
+    Get initial t-values and their increments for the ray traversal kernels
+    """
+    direction = pn - p0
+    step = np.sign(direction) * cell_size
+    delta = -(p0 % cell_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.abs((delta + np.maximum(step, 0) + (delta == 0) * step) / direction)
+        step_t = step / direction
+    return direction, t, step_t
+
+
+def test_ray_traversal_kernels_do_not_depend_on_threads():
+    sim = get_simulation(4, record_trajectories=True)
+    sim.run_simulation(75., 75., True, 500)
+    se_sim, cell_size = sim.se_sim, sim.se_sim.cell_size
+    segments, dEs, _ = process_trajectories(*sim.pe_sim.trajectories)
+    vectors = se_sim.get_se_vectors(sim.pe_sim.trajectories)
+    assert vectors.shape[0] > 0
+    energies, fluxes = [], []
+    for threads in (1, 4):
+        p0, pn = np.ascontiguousarray(segments[:, 0]), np.ascontiguousarray(segments[:, 1])
+        direction, t, step_t = ray_parameters(p0, pn, cell_size)
+        L = np.linalg.norm(direction, axis=1)
+        energies.append(np.zeros(se_sim.grid.shape))
+        traversal.traverse_segment(energies[-1], se_sim.grid, cell_size, p0, pn, direction, t, step_t, dEs / L,
+                                   int(L.max() / cell_size * 2) + 10, threads)
+        p0, pn = np.ascontiguousarray(vectors[:, 0]), np.ascontiguousarray(vectors[:, 1])
+        direction, t, step_t = ray_parameters(p0, pn, cell_size)
+        index_corr = -np.int8(((p0 % cell_size) == 0) & (direction > 0))
+        fluxes.append(np.zeros(se_sim.grid.shape))
+        traversal.generate_flux(fluxes[-1], se_sim.flags, cell_size, p0, pn, direction, index_corr, t, step_t,
+                                np.ones(p0.shape[0]), int(np.linalg.norm(direction, axis=1).max() / cell_size * 2) + 5,
+                                threads)
+    assert np.allclose(energies[0], energies[1]) and np.allclose(fluxes[0], fluxes[1])
+    assert fluxes[0].sum() > 0
+    assert np.isclose(energies[0].sum(), se_sim.DE.sum(), rtol=1e-2)  # the same energy as deposited by map_se
@@ -0,0 +1,277 @@
+"""
+Equivalence of the continuum model solution modes on a small grid
+"""
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import make_process, make_structure, run, fill_cells, PRECURSOR
+
+
+def exact_coverage(n, flux, time):
+    """
+    Exact solution of the reaction term for a fixed SE flux
+    """
+    k = PRECURSOR['F'] / PRECURSOR['n0'] + 1 / PRECURSOR['tau'] + PRECURSOR['sigma'] * flux
+    n_inf = PRECURSOR['F'] / k
+    return n_inf + (n - n_inf) * np.exp(-k * time)
+
+
+def test_rk4_reaction_matches_exact_solution():
+    # Without diffusion, every surface cell follows the exact solution of the reaction term
+    for compiled in (True, False):
+        process, structure = make_process(pillar=False, D=0)
+        process.set_beam_matrix(1e6)
+        process.compiled_stepping = compiled
+        surface = np.asarray(structure.surface_bool)
+        n = structure.precursor[surface].copy()
+        precursor, _ = run(process, 1e-3)
+        assert np.allclose(precursor[surface], exact_coverage(n, 1e6, 1e-3), rtol=1e-6)
+
+
+def test_compiled_kernel_matches_python():
+    results = []
+    for compiled in (True, False):
+        process, structure = make_process()
+        process.compiled_stepping = compiled
+        results.append(run(process, 2e-3))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-10, atol=1e-12)
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-10, atol=1e-12)
+
+
+
+def test_exponential_and_rk4_converge():
+    # Both reaction integrators converge to the same solution with a reduced time step.
+    # Operator splitting makes the exponential integrator only first order accurate in coverage.
+    process, _ = make_process(flux=1e7)
+    precursor_rk4, deposit_rk4 = run(process, 5e-3, process.dt / 4)
+    filled = deposit_rk4 > 0
+    errors = []
+    for fraction in (4, 16):
+        process, _ = make_process(flux=1e7, reaction_integrator='exponential')
+        precursor, deposit = run(process, 5e-3, process.dt / fraction)
+        assert np.isclose(deposit[filled].sum(), deposit_rk4[filled].sum(), rtol=1e-4)
+        errors.append(np.abs(precursor - precursor_rk4).max())
+    assert errors[1] < errors[0] / 3
+
+
+def test_implicit_diffusion_converges_to_explicit():
+    # With fast diffusion, the implicit solution takes much longer steps.
+    # The reaction and diffusion terms are split, thus the error grows in proportion to the step.
+    process, _ = make_process(flux=1e5, D=1e6, reaction_integrator='exponential')
+    dt_explicit = process.dt
+    precursor_explicit, deposit_explicit = run(process, 2e-3)
+    filled = deposit_explicit > 0
+    errors = []
+    for factor in (1, 10):
+        process, _ = make_process(flux=1e5, D=1e6, reaction_integrator='exponential', diffusion_solver='implicit',
+                                  implicit_dt_factor=factor)
+        dt_implicit = process.dt
+        precursor, deposit = run(process, 2e-3)
+        errors.append(abs(deposit[filled].sum() / deposit_explicit[filled].sum() - 1))
+        if factor == 1:
+            assert np.allclose(precursor, precursor_explicit, rtol=2e-2, atol=1e-3)
+    assert dt_implicit > 5 * dt_explicit
+    assert errors[0] < 1e-2
+    assert errors[0] < errors[1] / 5
+
+
+def test_adaptive_matches_rk4():
+    # The compiled kernel makes the same steps as the Python solution, both converge to the rk4 solution
+    results = []
+    for compiled in (True, False):
+        process, _ = make_process(adaptive_time_step=True)
+        process.compiled_stepping = compiled
+        results.append(run(process, 2e-3))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-10, atol=1e-12)
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-10, atol=1e-12)
+    process, _ = make_process()
+    precursor_rk4, deposit_rk4 = run(process, 2e-3, process.dt / 8)
+    filled = deposit_rk4 > 0
+    assert np.isclose(results[0][1][filled].sum(), deposit_rk4[filled].sum(), rtol=1e-4)
+    assert np.allclose(results[0][0], precursor_rk4, rtol=1e-4, atol=1e-5)
+
+
+def test_multirate_matches_regular():
+    # With a reduced time step, cells far from the beam are sorted into the slower classes
+    process, _ = make_process()
+    dt = process.dt / 8
+    precursor_regular, deposit_regular = run(process, 2e-3, dt)
+    filled = deposit_regular > 0
+    for levels in (1, 4):
+        process, _ = make_process(multirate=True, multirate_levels=levels)
+        precursor, deposit = run(process, 2e-3, dt)
+        assert np.isclose(deposit[filled].sum(), deposit_regular[filled].sum(), rtol=1e-3)
+        assert np.allclose(precursor, precursor_regular, rtol=1e-2, atol=1e-2)
+
+
+def test_height_field_falls_back_to_3d():
+    # On a flat substrate the 2D solution is the same as the 3D one until a column grows two cells higher
+    results = []
+    for height_field in (True, False):
+        process, structure = make_process(pillar=False, height_field=height_field)
+        precursor, deposit = run(process, 1e-3)
+        results.append((process, structure, precursor, deposit))
+    (process, structure, precursor, deposit), (process_3d, _, precursor_3d, deposit_3d) = results
+    assert process._Process__height_field
+    assert np.allclose(deposit, deposit_3d, rtol=1e-6, atol=1e-12)
+    assert np.allclose(precursor, precursor_3d, rtol=1e-6, atol=1e-9)
+    c = structure.shape[1] // 2
+    for z in (4, 5):
+        for p in (process, process_3d):
+            fill_cells(p, (z, c, c))
+        if z == 4:
+            assert process._Process__height_field
+    assert not process._Process__height_field
+    precursor, deposit = run(process, 1e-3)
+    precursor_3d, deposit_3d = run(process_3d, 1e-3)
+    filled = deposit_3d > 0
+    assert np.isclose(deposit[filled].sum(), deposit_3d[filled].sum(), rtol=1e-2)
+    assert np.allclose(precursor, precursor_3d, rtol=2e-2, atol=1e-2)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='brick storage is only available on Linux')
+def test_brick_storage_matches_dense():
+    # Only the storage differs, the solution is the same through filled cells and extension of the volume
+    results = []
+    for brick_size in (0, 4):
+        process, structure = make_process(brick_size=brick_size)
+        run(process, 1e-3)
+        c = structure.shape[1] // 2
+        fill_cells(process, (7, c, c))
+        process.extend_structure()
+        results.append((structure, *run(process, 1e-3)))
+    (dense, precursor_dense, deposit_dense), (bricks, precursor, deposit) = results
+    assert bricks.brick_size == 4096 and dense.brick_size == 0
+    assert bricks.shape == dense.shape
+    assert np.array_equal(deposit, deposit_dense)
+    assert np.array_equal(precursor, precursor_dense)
+    assert np.array_equal(bricks.cell_flags, dense.cell_flags)
+    # Releasing the empty bricks after the arrays were written as a whole keeps the cells
+    bricks.precursor[...] = bricks.precursor.copy()
+    bricks.release_bricks()
+    assert np.array_equal(bricks.precursor, precursor_dense)
+
+
+def test_skip_ahead_matches_stepping():
+    # Under steady coverage, the time to the next filled cell is skipped in a single step
+    results = []
+    for skip_ahead in (True, False):
+        process, _ = make_process(skip_ahead=skip_ahead)
+        results.append(run(process, 2e-2))
+        if skip_ahead:
+            assert process._Process__steady_state
+    (precursor, deposit), (precursor_regular, deposit_regular) = results
+    assert np.allclose(deposit, deposit_regular, rtol=1e-6, atol=1e-12)
+    assert np.allclose(precursor, precursor_regular, rtol=1e-6, atol=1e-9)
+
+
+def test_active_set_matches_regular():
+    # Cells far from the beam reach steady coverage and are excluded from the solution
+    results = []
+    for active_set in (True, False):
+        process, _ = make_process(active_set=active_set)
+        results.append(run(process, 1e-2))
+        if active_set:
+            assert process._frozen.any()
+    (precursor, deposit), (precursor_regular, deposit_regular) = results
+    assert np.allclose(deposit, deposit_regular, rtol=1e-4, atol=1e-12)
+    assert np.allclose(precursor, precursor_regular, rtol=1e-4, atol=1e-9)
+
+
+def test_equilibrate_matches_time_stepping():
+    # The steady state found directly is the one reached by advancing the coverage in time
+    process, structure = make_process()
+    iterations, residual = process.equilibrate()
+    assert residual < 1e-8
+    precursor = np.array(structure.precursor)
+    process, structure = make_process()
+    precursor_steady, _ = run(process, 5e-2)
+    surface = np.asarray(structure.surface_bool) | np.asarray(structure.semi_surface_bool)
+    assert np.allclose(precursor[surface], precursor_steady[surface], rtol=1e-6)
+
+
+def test_local_equilibration_matches_global():
+    # Coverage around a filled cell is brought close to the steady state found with the whole surface solved
+    results = []
+    for equilibration in ('local', 'global', None):
+        process, structure = make_process(local_equilibration=equilibration == 'local')
+        process.equilibrate()
+        c = structure.shape[1] // 2
+        fill_cells(process, (7, c, c))
+        if equilibration == 'global':
+            process.equilibrate()
+        results.append(np.array(structure.precursor))
+    precursor, precursor_global, precursor_filled = results
+    around = np.s_[6:10, c - 2:c + 3, c - 2:c + 3]
+    error = np.abs(precursor[around] - precursor_global[around]).max()
+    assert error < np.abs(precursor_filled[around] - precursor_global[around]).max() / 10
+    assert np.allclose(precursor, precursor_global, rtol=5e-3, atol=2e-3)
+
+
+def test_cell_indices_follow_filled_cells():
+    # Indices updated around the filled cells are the same as the ones found in the whole volume
+    process, structure = make_process()
+    c = structure.shape[1] // 2
+    for cells in [(7, c, c), (5, c, c + 3), (4, c - 6, c)], [(7, c, c + 1), (8, c, c)]:
+        for cell in cells:
+            structure.deposit[cell] = 1
+        process.cell_filled_routine()
+    indices = [getattr(process, '_Process__' + name) for name in ('surface_cells', 'semi_surface_cells',
+                                                                   'surface_all_cells')]
+    solid_index = process._solid_index
+    process._Process__index_surface_cells()
+    indices_full = [getattr(process, '_Process__' + name) for name in ('surface_cells', 'semi_surface_cells',
+                                                                        'surface_all_cells')]
+    for index, index_full in zip(indices, indices_full):
+        for i, i_full in zip(index, index_full):
+            assert np.array_equal(i, i_full)
+    for i, i_full in zip(solid_index, process._get_solid_index()):
+        assert np.array_equal(i, i_full)
+    height_map, max_z = structure.height_map.copy(), structure.max_z()
+    structure.define_height_map()
+    assert np.array_equal(height_map, structure.height_map)
+    assert max_z == structure.max_z() == 8
+
+
+def test_csr_diffusion_matches_stencil():
+    # The neighbor table connects the same cells as the stencil
+    pytest.importorskip('febid.libraries.pde.reaction_diffusion')
+    from febid import diffusion
+    structure = make_structure()
+    surface = np.asarray(structure.surface_bool) | np.asarray(structure.semi_surface_bool)
+    grid = np.zeros(structure.shape)
+    grid[surface] = np.random.default_rng(0).uniform(0.1, 1, np.count_nonzero(surface))
+    index = surface.nonzero()
+    stencil = diffusion.diffusion_ftcs(grid, surface, 1e5, 1e-7, 5)
+    neighbors = diffusion.prepare_surface_neighbors(tuple(np.intc(i) for i in index), structure.shape)
+    csr = diffusion.diffusion_csr(grid[index], 1e5, 1e-7, 5, np.arange(index[0].shape[0], dtype=np.intc), neighbors)
+    assert np.allclose(csr, stencil, rtol=1e-12, atol=1e-15)
+
+
+def test_sparse_flux_matches_dense():
+    # Flux given only for the irradiated cells is the same as the full-size flux matrix
+    process, structure = make_process()
+    beam_matrix = process.beam_matrix
+    index = beam_matrix.nonzero()
+    results = []
+    for flux in (beam_matrix, (index, beam_matrix[index])):
+        process, structure = make_process()
+        process.set_beam_matrix(flux)
+        assert np.array_equal(process.beam_matrix, beam_matrix)
+        results.append(run(process, 2e-3))
+    assert np.array_equal(results[0][0], results[1][0])
+    assert np.array_equal(results[0][1], results[1][1])
+
+
+def test_single_precision_matches_double():
+    # Rounding of the deposit in the single precision arrays is carried over between the steps
+    results = []
+    for single_precision in (True, False):
+        process, structure = make_process(single_precision=single_precision)
+        assert structure.deposit.dtype == (np.float32 if single_precision else np.float64)
+        results.append(run(process, 2e-3))
+    (precursor, deposit), (precursor_double, deposit_double) = results
+    assert np.allclose(deposit, deposit_double, rtol=1e-5, atol=1e-8)
+    assert np.allclose(precursor, precursor_double, rtol=1e-5, atol=1e-6)
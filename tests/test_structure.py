@@ -0,0 +1,132 @@
+"""
+Equivalence of the structure storage and cell configuration modes on a small grid
+"""
+import numpy as np
+import pytest
+
+from conftest import make_structure
+
+
+def test_cell_mask_matches_bool_array():
+    # Masks stored as bits of the flags array are indexed and assigned like boolean arrays
+    from febid.Structure import CellMask
+    rng = np.random.default_rng(0)
+    flags = rng.integers(0, 256, (6, 7, 8), dtype=np.uint8)
+    mask = CellMask(flags, 0b100)
+    reference = flags & 0b100 != 0
+    index = (rng.integers(0, 6, 20), rng.integers(0, 7, 20), rng.integers(0, 8, 20))
+    value = rng.random((6, 7, 8)) > 0.5
+    for key, assigned in [(np.s_[1:4, :, 2:], True), (np.s_[2, 3:], False), (index, True), (index, False),
+                          (np.s_[...], value), (reference, False), (np.s_[:, 1], value[:, 1])]:
+        other = flags & ~np.uint8(0b100)
+        mask[key] = assigned
+        reference[key] = assigned
+        assert np.array_equal(np.asarray(mask), reference)
+        assert np.array_equal(flags & ~np.uint8(0b100), other)  # other bits are kept
+        assert np.array_equal(np.asarray(mask[key]), reference[key])
+    assert np.array_equal(~mask, ~reference)
+    assert mask.sum() == np.count_nonzero(reference)
+    for i, i_reference in zip(mask.nonzero(), reference.nonzero()):
+        assert np.array_equal(i, i_reference)
+
+
+def converge_reference(structure, cell):
+    """
+    Converge the configuration around a filled cell with the Python rules
+
+    :param structure: structure, the cell has to be filled with a deposit above unity
+    :param cell: filled cell
+    :return:
+    """
+    from febid.mcca import MixedCellCellularAutomata
+    deposit, precursor = structure.deposit, structure.precursor
+    surface = np.asarray(structure.surface_bool)
+    semi_surface = np.asarray(structure.semi_surface_bool)
+    ghosts = np.asarray(structure.ghosts_bool)
+    surplus_deposit = deposit[cell] - 1
+    precursor_cov = precursor[cell]
+    deposit[cell] = -1
+    precursor[cell] = 0
+    ghosts[cell] = True
+    surface[cell] = False
+    semi_surface[cell] = False
+    updated_slice, surface_kern, semi_surface_kern, ghosts_kern = \
+        MixedCellCellularAutomata().get_converged_configuration(cell, deposit.astype(bool), surface, semi_surface,
+                                                               ghosts)
+    surf_diff = surface[updated_slice] ^ surface_kern
+    semi_s_diff = semi_surface[updated_slice] ^ semi_surface_kern
+    surface[updated_slice] = surface_kern
+    semi_surface[updated_slice] = semi_surface_kern
+    ghosts[updated_slice] = ghosts_kern
+    deposit_kern = deposit[updated_slice]
+    precursor_kern = precursor[updated_slice]
+    deposit_kern[surf_diff] += surplus_deposit / np.count_nonzero(surf_diff)
+    precursor_kern[(semi_s_diff | surf_diff) & (precursor_kern < 1e-6)] = precursor_cov
+    structure.surface_bool = surface
+    structure.semi_surface_bool = semi_surface
+    structure.ghosts_bool = ghosts
+
+
+def test_compiled_cellular_automata_matches_python():
+    # On the top and at the side of the pillar and on the substrate
+    pytest.importorskip('febid.libraries.mcca.mcca_c')
+    from febid.mcca import MixedCellCellularAutomata
+    from febid.Structure import SURFACE, SEMI_SURFACE, GHOST
+    structures = []
+    for _ in range(2):
+        structure = make_structure()
+        structure.precursor[np.asarray(structure.surface_bool)] = 0.5
+        c = structure.shape[1] // 2
+        cells = (np.array([7, 5, 4]), np.array([c, c, 3]), np.array([c, c + 3, 3]))
+        structure.deposit[cells] = 1.3
+        structure.precursor[cells] = [0.2, 0.3, 0.4]
+        structures.append(structure)
+    structure, reference = structures
+    for cell in zip(*cells):
+        converge_reference(reference, cell)
+    surplus = structure.deposit[cells] - 1
+    coverage = structure.precursor[cells]
+    structure.deposit[cells] = -1
+    structure.precursor[cells] = 0
+    structure.cell_flags[cells] = structure.cell_flags[cells] & ~np.uint8(SURFACE | SEMI_SURFACE) | GHOST
+    MixedCellCellularAutomata().converge_cells(cells, structure.deposit, structure.precursor, structure.cell_flags,
+                                               surplus, coverage)
+    assert np.allclose(structure.deposit, reference.deposit, rtol=1e-12, atol=0)
+    assert np.array_equal(structure.precursor, reference.precursor)
+    assert np.array_equal(structure.cell_flags, reference.cell_flags)
+
+
+def test_height_map_follows_filled_cells():
+    # The height map updated with the filled cells is the same as the one found in the whole volume
+    structure = make_structure()
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        cells = (rng.integers(4, 12, 10), rng.integers(0, 30, 10), rng.integers(0, 30, 10))
+        structure.deposit[cells] = -1
+        structure.update_height_map(cells)
+    height_map, max_z = structure.height_map.copy(), structure.max_z()
+    structure.define_height_map()
+    assert np.array_equal(height_map, structure.height_map)
+    assert max_z == structure.max_z()
+
+
+def test_growth_within_capacity_matches_exact_resize():
+    # Extension in height within the spare height gives the same arrays as allocating the exact height
+    structures = []
+    for growth_factor in (1.5, 1):
+        structure = make_structure()
+        structure.growth_factor = growth_factor
+        shared = []
+        for i in range(3):
+            deposit = structure.deposit
+            structure.resize_structure(50)
+            shared.append(np.shares_memory(deposit, structure.deposit))
+            structure.deposit[-1, i, i] = 0.5
+            structure.precursor[-5:] = i + 1
+            structure.surface_bool[-3:, i] = True
+        assert shared == ([False, True, False] if growth_factor > 1 else [False, False, False])
+        structures.append(structure)
+    structure, reference = structures
+    assert structure.shape == reference.shape == (54, 30, 30)
+    for name in ('deposit', 'precursor', 'cell_flags', 'temperature'):
+        assert np.array_equal(getattr(structure, name), getattr(reference, name))